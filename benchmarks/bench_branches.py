@@ -0,0 +1,97 @@
+'''
+Benchmark the recent branch discovery for '!OUTSTANDING' reports
+against a synthetic repository with many branches.
+
+Usage: python benchmarks/bench_branches.py [-b BRANCHES] [-d DEPTH] [-r RECENT]
+'''
+
+import argparse
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+import pygit2
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from testion.cache import git as gitcache  # noqa: E402
+
+
+def make_repo(path, num_branches, depth, num_recent, now):
+    repo = pygit2.init_repository(str(path), bare=True)
+    tree = repo.TreeBuilder().write()
+    base_time = int(now) - 30 * 86400
+
+    def commit(parents, t, msg):
+        sig = pygit2.Signature('bench', 'bench@example.com', t, 0)
+        return repo.create_commit(None, sig, sig, msg, tree, parents)
+
+    head = commit([], base_time, 'root')
+    for i in range(depth):
+        head = commit([head], base_time + i, 'trunk {}'.format(i))
+    for b in range(num_branches):
+        parent = head
+        recent = b < num_recent
+        for i in range(depth // 10 + 1):
+            t = int(now) - 3600 if recent else base_time + depth + b * 10 + i
+            parent = commit([parent], t, 'branch {} commit {}'.format(b, i))
+        repo.create_reference('refs/remotes/origin/branch-{:05d}'.format(b), parent)
+    repo.create_reference('refs/heads/master', head)
+    return repo
+
+
+def legacy_find_recent_branches(repo, now):
+    # The previous implementation, walking each branch separately.
+    branches = []
+    branch_heads = set()
+    all_branches = repo.listall_branches(pygit2.GIT_BRANCH_LOCAL |
+                                         pygit2.GIT_BRANCH_REMOTE)
+    for branch in all_branches:
+        if branch.endswith('/HEAD'):
+            continue
+        has_recent_commits = False
+        branch_head = repo.revparse_single(branch)
+        for commit in repo.walk(branch_head.id, pygit2.GIT_SORT_TIME):
+            if commit.commit_time < now - 86400:
+                break
+            else:
+                has_recent_commits = True
+        if has_recent_commits and branch_head.id not in branch_heads:
+            branches.append(branch)
+            branch_heads.add(branch_head.id)
+    return branches
+
+
+def measure(func, repeat=5):
+    best = None
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - begin
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--branches', type=int, default=500)
+    parser.add_argument('-d', '--depth', type=int, default=2000)
+    parser.add_argument('-r', '--recent', type=int, default=15)
+    args = parser.parse_args()
+
+    now = time.time()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        repo = make_repo(tmpdir, args.branches, args.depth, args.recent, now)
+        legacy_time, legacy_result = measure(
+            lambda: legacy_find_recent_branches(repo, now))
+        gitcache._recent_heads_cache.clear()
+        cold_time, result = measure(
+            lambda: (gitcache._recent_heads_cache.clear(),
+                     gitcache.find_recent_branches(repo, 86400, now))[1])
+        warm_time, _ = measure(lambda: gitcache.find_recent_branches(repo, 86400, now))
+        assert sorted(result) == sorted(legacy_result), (result, legacy_result)
+        print('branches: {}, depth: {}, recent: {}'
+              .format(args.branches, args.depth, len(result)))
+        print('per-branch walks : {:8.2f} ms'.format(legacy_time * 1000))
+        print('heads + one walk : {:8.2f} ms'.format(cold_time * 1000))
+        print('cached result    : {:8.2f} ms'.format(warm_time * 1000))
@@ -0,0 +1,510 @@
+'''
+Benchmark the webhook and the job pipeline end to end.
+
+It runs the testion app in-process with local stand-ins for GitHub (the API
+for commit statuses and a bare repository to clone), Slack and S3, fires
+bursts of push payloads at /webhook, and reports the webhook latency, the
+queue wait, the durations of each stage and the throughput in jobs/minute.
+The results are written as JSON to compare them between versions.
+
+Usage: python benchmarks/bench_pipeline.py [-b BURSTS] [-n PUSHES] [-i INTERVAL]
+                                           [-B BRANCHES] [-w WORKERS] [-c CONCURRENCY]
+                                           [-t TEST_TIME] [-l LATENCY]
+                                           [--cache-path PATH] [-o OUTPUT]
+                                           [--baseline JSON]
+
+Use --cache-path to keep the virtualenv cache between invocations, as the
+first run has to create a virtualenv with pip (which needs the network).
+'''
+
+import argparse
+import asyncio
+from collections import defaultdict
+import json
+import logging
+import os
+from pathlib import Path
+import sys
+import tempfile
+import threading
+import time
+
+import aiohttp
+from aiohttp import web
+import pygit2
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from testion import metrics  # noqa: E402
+from testion.github import clear_clients  # noqa: E402
+from testion.history import close_history, open_history  # noqa: E402
+from testion.jobqueue import JobQueue  # noqa: E402
+from testion.s3 import close_uploader as close_s3_uploader  # noqa: E402
+from testion.server import github_webhook, job_loop  # noqa: E402
+
+here = Path(__file__).resolve().parent
+
+OWNER = 'bench'
+REPO = 'sample'
+ZERO_SHA = '0' * 40
+S3_BUCKET = 'bench-logs'
+
+TEST_PY = '''\
+import os
+import time
+import unittest
+
+TEST_TIME = float(os.environ.get('BENCH_TEST_TIME', '0'))
+
+
+class BenchTest(unittest.TestCase):
+
+    def test_first(self):
+        time.sleep(TEST_TIME / 2)
+
+    def test_second(self):
+        time.sleep(TEST_TIME / 2)
+'''
+
+
+class SampleRepo:
+    '''
+    A bare repository playing the pushed GitHub repository,
+    where every push creates a new commit with a distinct tree.
+    '''
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.repo = pygit2.init_repository(self.path, bare=True)
+        self.heads = {}
+        self.num_commits = 0
+        self.commit('master', 'Initial commit')
+
+    def commit(self, branch, message):
+        repo = self.repo
+        tree = repo.TreeBuilder()
+        tree.insert('test.py', repo.create_blob(TEST_PY.encode('utf-8')),
+                    pygit2.GIT_FILEMODE_BLOB)
+        tree.insert('bench.txt', repo.create_blob(str(self.num_commits).encode('utf-8')),
+                    pygit2.GIT_FILEMODE_BLOB)
+        parent = self.heads.get(branch) or self.heads.get('master')
+        sig = pygit2.Signature('bench', 'bench@example.com')
+        oid = repo.create_commit('refs/heads/{}'.format(branch), sig, sig, message,
+                                 tree.write(), [parent] if parent else [])
+        self.num_commits += 1
+        before = self.heads.get(branch)
+        self.heads[branch] = oid
+        return str(before) if before else ZERO_SHA, str(oid)
+
+    def push(self, branch):
+        before, after = self.commit(branch, 'Push {}'.format(self.num_commits))
+        return {
+            'ref': 'refs/heads/{}'.format(branch),
+            'before': before,
+            'after': after,
+            'repository': {
+                'full_name': '{}/{}'.format(OWNER, REPO),
+                'name': REPO,
+                'owner': {'name': OWNER},
+                'clone_url': self.path,
+                'default_branch': 'master',
+            },
+        }
+
+
+class StandIns:
+    '''
+    Minimal local servers for the GitHub API, the Slack webhook and S3,
+    answering after the given latency (in seconds).
+    '''
+
+    def __init__(self, clone_url, latency=0):
+        self.clone_url = clone_url
+        self.latency = latency
+        self.loop = None
+        self.base_url = None
+        self.counts = defaultdict(int)
+
+    def _user(self, login):
+        url = '{}/api/v3/users/{}'.format(self.base_url, login)
+        user = dict.fromkeys(['avatar_url', 'events_url', 'followers_url',
+                              'following_url', 'gists_url', 'html_url',
+                              'organizations_url', 'received_events_url', 'repos_url',
+                              'starred_url', 'subscriptions_url'], url)
+        user.update(login=login, id=1, url=url, gravatar_id='', type='User',
+                    site_admin=False)
+        return user
+
+    def _repository(self, owner, name):
+        url = '{}/api/v3/repos/{}/{}'.format(self.base_url, owner, name)
+        repo = dict.fromkeys([
+            'archive_url', 'assignees_url', 'blobs_url', 'branches_url',
+            'collaborators_url', 'comments_url', 'commits_url', 'compare_url',
+            'contents_url', 'contributors_url', 'deployments_url', 'downloads_url',
+            'events_url', 'forks_url', 'git_commits_url', 'git_refs_url',
+            'git_tags_url', 'hooks_url', 'html_url', 'issue_comment_url',
+            'issue_events_url', 'issues_url', 'keys_url', 'labels_url',
+            'languages_url', 'merges_url', 'milestones_url', 'notifications_url',
+            'pulls_url', 'releases_url', 'stargazers_url', 'statuses_url',
+            'subscribers_url', 'subscription_url', 'svn_url', 'tags_url',
+            'teams_url', 'trees_url'], url)
+        repo.update({
+            'id': 1, 'name': name, 'full_name': '{}/{}'.format(owner, name),
+            'owner': self._user(owner), 'url': url, 'private': False, 'fork': False,
+            'archived': False, 'description': '', 'homepage': None, 'language': 'Python',
+            'clone_url': self.clone_url, 'git_url': self.clone_url,
+            'ssh_url': self.clone_url, 'mirror_url': None, 'default_branch': 'master',
+            'has_downloads': False, 'has_issues': False, 'has_pages': False,
+            'has_projects': False, 'has_wiki': False, 'size': 0,
+            'forks_count': 0, 'network_count': 0, 'open_issues_count': 0,
+            'stargazers_count': 0, 'subscribers_count': 0, 'watchers_count': 0,
+            'created_at': '2017-01-01T00:00:00Z', 'updated_at': '2017-01-01T00:00:00Z',
+            'pushed_at': '2017-01-01T00:00:00Z',
+        })
+        return repo
+
+    async def _respond(self, kind):
+        self.counts[kind] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency, loop=self.loop)
+
+    async def get_repository(self, request):
+        await self._respond('github_repository')
+        return web.json_response(self._repository(request.match_info['owner'],
+                                                  request.match_info['name']))
+
+    async def create_status(self, request):
+        await self._respond('github_status')
+        body = await request.json()
+        url = '{}/api/v3/repos/{}/{}/statuses/{}'.format(
+            self.base_url, request.match_info['owner'], request.match_info['name'],
+            request.match_info['sha'])
+        status = dict(body, id=self.counts['github_status'], url=url,
+                      creator=self._user(OWNER),
+                      created_at='2017-01-01T00:00:00Z', updated_at='2017-01-01T00:00:00Z')
+        status.setdefault('description', None)
+        status.setdefault('target_url', None)
+        return web.json_response(status, status=201)
+
+    async def slack_hook(self, request):
+        await request.read()
+        await self._respond('slack_message')
+        return web.Response(text='ok')
+
+    async def s3_put(self, request):
+        # Accepts both single uploads and the parts of multipart uploads.
+        await request.read()
+        await self._respond('s3_request')
+        if request.method == 'POST' and 'uploads' in request.GET:
+            return web.Response(text='<InitiateMultipartUploadResult><UploadId>bench'
+                                     '</UploadId></InitiateMultipartUploadResult>')
+        if request.method == 'POST':
+            return web.Response(text='<CompleteMultipartUploadResult/>')
+        return web.Response(headers={'ETag': '"bench"'})
+
+    def create_app(self, loop):
+        app = web.Application(loop=loop)
+        repo_path = '/api/v3/repos/{owner}/{name}'
+        app.router.add_get(repo_path, self.get_repository)
+        app.router.add_post(repo_path + '/statuses/{sha}', self.create_status)
+        app.router.add_post('/slack', self.slack_hook)
+        app.router.add_route('*', '/' + S3_BUCKET + '/{key:.+}', self.s3_put)
+        return app
+
+
+def start_stand_ins(stand_ins):
+    '''
+    Run the stand-ins in a separate thread with its own event loop,
+    so that their response delays are not affected by the load of testion.
+    Returns the base URL and a function to stop them.
+    '''
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    stand_ins.loop = loop
+
+    def run():
+        asyncio.set_event_loop(loop)
+        stand_ins.base_url, stop_server = loop.run_until_complete(
+            start_server(loop, stand_ins.create_app(loop)))
+        started.set()
+        loop.run_forever()
+        loop.run_until_complete(stop_server())
+        loop.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    started.wait()
+
+    def stop():
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+    return stand_ins.base_url, stop
+
+
+def record_observations(histogram):
+    '''
+    Keep the raw values observed by the histogram (by their labels)
+    to compute exact percentiles.
+    '''
+    samples = defaultdict(list)
+    observe = histogram.observe
+
+    def recording_observe(value, **labels):
+        samples[tuple(sorted(labels.values()))].append(value)
+        observe(value, **labels)
+
+    histogram.observe = recording_observe
+    return samples
+
+
+def summarize(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def percentile(p):
+        # the nearest-rank method
+        return values[max(int(round(p / 100 * len(values) + 0.5)) - 1, 0)]
+
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values),
+        'p50': percentile(50),
+        'p90': percentile(90),
+        'p99': percentile(99),
+        'max': values[-1],
+    }
+
+
+async def start_server(loop, app, port=0):
+    handler = app.make_handler(keep_alive_on=False)
+    server = await loop.create_server(handler, '127.0.0.1', port)
+    port = server.sockets[0].getsockname()[1]
+
+    async def stop():
+        server.close()
+        await server.wait_closed()
+        await app.shutdown()
+        # (Clients such as github3 may keep idle connections open.)
+        await handler.finish_connections(1.0)
+        await app.cleanup()
+
+    return 'http://127.0.0.1:{}'.format(port), stop
+
+
+async def fire_bursts(loop, url, sample_repo, args):
+    '''
+    Post the pushes in bursts and return the latencies of the webhook requests.
+    '''
+    latencies = []
+    num_branches = args.branches or args.bursts * args.pushes
+    headers = {'X-GitHub-Event': 'push', 'Content-Type': 'application/json'}
+
+    async def post(session, payload):
+        begin = time.perf_counter()
+        async with session.post(url, data=json.dumps(payload), headers=headers) as resp:
+            await resp.read()
+            if resp.status != 204:
+                raise RuntimeError('The webhook failed: {} {}'
+                                   .format(resp.status, await resp.text()))
+        latencies.append(time.perf_counter() - begin)
+
+    async with aiohttp.ClientSession(loop=loop) as session:
+        push_idx = 0
+        for burst in range(args.bursts):
+            if burst > 0:
+                await asyncio.sleep(args.interval, loop=loop)
+            payloads = []
+            for _ in range(args.pushes):
+                payloads.append(sample_repo.push('bench-{}'.format(push_idx % num_branches)))
+                push_idx += 1
+            await asyncio.gather(*(post(session, p) for p in payloads), loop=loop)
+    return latencies
+
+
+def create_config(args, workdir):
+    report = {
+        'name': 'Benchmark',
+        'cls': 'unit',
+        'envs': ['BENCH_TEST_TIME={}'.format(args.test_time)],
+        'branches': '!HEAD',
+        'test_cmd': 'python -m unittest test.py',
+        'parser': 'unittest',
+        # Run the tests even for the trees tested in previous benchmarks.
+        'result_cache': False,
+    }
+    return {
+        '{}/{}'.format(OWNER, REPO): {
+            'concurrency': args.concurrency,
+            'log': {'local_path': str(workdir / 'logs'), 's3_bucket': S3_BUCKET},
+            'reports': {'bench': report},
+        },
+    }
+
+
+async def run_benchmark(loop, args, workdir):
+    sample_repo = SampleRepo(workdir / 'sample.git')
+    stand_ins = StandIns(sample_repo.path, latency=args.latency / 1000)
+    stand_ins_url, stop_stand_ins = start_stand_ins(stand_ins)
+
+    os.environ.update({
+        'GH_USERNAME': 'bench',
+        'GH_TOKEN': 'bench-token',
+        'TESTION_GITHUB_URL': stand_ins_url,
+        'TESTION_SLACK_HOOK_URL': stand_ins_url + '/slack',
+        'TESTION_S3_ENDPOINT': stand_ins_url,
+        'AWS_ACCESS_KEY_ID': 'bench',
+        'AWS_SECRET_ACCESS_KEY': 'bench-secret',
+        'TESTION_CACHE_PATH': str(args.cache_path or workdir / 'cache'),
+    })
+    os.environ.pop('TESTION_PUBLIC_URL', None)
+
+    app = web.Application(loop=loop)
+    app.config = create_config(args, workdir)
+    app.router.add_post('/webhook', github_webhook)
+    app._job_queue = JobQueue(loop=loop)
+    open_history(workdir / 'history.sqlite3')
+    job_task = asyncio.ensure_future(job_loop(loop, app._job_queue, app.config,
+                                              args.workers))
+    base_url, stop_app = await start_server(loop, app)
+    webhook_url = base_url + '/webhook?report=bench'
+
+    try:
+        if args.warm_up:
+            # Fill the mirror and virtualenv caches outside the measurement.
+            warm_up = argparse.Namespace(**dict(vars(args), bursts=1, pushes=1, branches=1))
+            await fire_bursts(loop, webhook_url, sample_repo, warm_up)
+            await app._job_queue.join()
+
+        queue_waits = record_observations(metrics.queue_wait)
+        stage_durations = record_observations(metrics.stage_duration)
+        call_durations = record_observations(metrics.external_call_duration)
+        outcomes_before = dict(metrics.jobs_total._values)
+        calls_before = dict(stand_ins.counts)
+
+        begin = time.perf_counter()
+        latencies = await fire_bursts(loop, webhook_url, sample_repo, args)
+        await app._job_queue.join()
+        elapsed = time.perf_counter() - begin
+        # Let the log uploads finish as well.
+        await close_s3_uploader()
+    finally:
+        job_task.cancel()
+        await job_task
+        await stop_app()
+        app._job_queue.close()
+        close_history()
+        clear_clients()
+        stop_stand_ins()
+
+    outcomes = {key[0]: value - outcomes_before.get(key, 0)
+                for key, value in metrics.jobs_total._values.items()}
+    num_jobs = sum(count for outcome, count in outcomes.items() if outcome != 'superseded')
+    # Pending jobs replaced by newer pushes to the same branch never run.
+    outcomes['replaced_in_queue'] = len(latencies) - sum(outcomes.values())
+    return {
+        'version': get_version(),
+        'params': {k: v for k, v in vars(args).items()
+                   if k not in ('output', 'baseline', 'cache_path', 'verbose')},
+        'pushes': len(latencies),
+        'jobs': outcomes,
+        'elapsed': elapsed,
+        'jobs_per_minute': num_jobs / elapsed * 60 if elapsed else None,
+        'webhook_latency': summarize(latencies),
+        'queue_wait': summarize(queue_waits[()]),
+        'stages': {key[0]: summarize(values)
+                   for key, values in sorted(stage_durations.items())},
+        'external_calls': {key[0]: summarize(values)
+                           for key, values in sorted(call_durations.items())},
+        'stand_in_requests': {kind: count - calls_before.get(kind, 0)
+                              for kind, count in sorted(stand_ins.counts.items())},
+    }
+
+
+def get_version():
+    try:
+        repo = pygit2.Repository(str(here.parent))
+        return str(repo.head.target)
+    except (KeyError, pygit2.GitError):
+        return None
+
+
+def print_results(results, baseline=None):
+
+    def line(name, stats, base_stats=None):
+        if stats is None:
+            return
+        text = '{:<22} p50 {:9.2f} ms  p90 {:9.2f} ms  p99 {:9.2f} ms  (n={})'.format(
+            name, stats['p50'] * 1000, stats['p90'] * 1000, stats['p99'] * 1000,
+            stats['count'])
+        if base_stats:
+            text += '  p50 x{:.2f}'.format(stats['p50'] / base_stats['p50']
+                                           if base_stats['p50'] else float('inf'))
+        print(text)
+
+    baseline = baseline or {}
+    print('pushes: {}, jobs: {}, elapsed: {:.2f} s'.format(
+          results['pushes'],
+          ', '.join('{} {}'.format(n, outcome) for outcome, n in sorted(results['jobs'].items())),
+          results['elapsed']))
+    throughput = '{:.1f} jobs/minute'.format(results['jobs_per_minute'])
+    if baseline.get('jobs_per_minute'):
+        throughput += ' (x{:.2f})'.format(results['jobs_per_minute'] /
+                                          baseline['jobs_per_minute'])
+    print(throughput)
+    line('webhook latency', results['webhook_latency'], baseline.get('webhook_latency'))
+    line('queue wait', results['queue_wait'], baseline.get('queue_wait'))
+    for stage, stats in results['stages'].items():
+        line('stage: ' + stage, stats, baseline.get('stages', {}).get(stage))
+    for service, stats in results['external_calls'].items():
+        line('call: ' + service, stats, baseline.get('external_calls', {}).get(service))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--bursts', type=int, default=5,
+                        help='The number of bursts of pushes.')
+    parser.add_argument('-n', '--pushes', type=int, default=20,
+                        help='The number of pushes in each burst.')
+    parser.add_argument('-i', '--interval', type=float, default=1.0,
+                        help='The interval between bursts in seconds.')
+    parser.add_argument('-B', '--branches', type=int, default=0,
+                        help='The number of branches to push to (default: one per push); '
+                             'fewer branches make newer pushes supersede queued jobs.')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1,
+                        help='The maximum number of jobs running at the same time.')
+    parser.add_argument('-c', '--concurrency', type=int, default=os.cpu_count() or 1,
+                        help='The "concurrency" of the benchmark repository.')
+    parser.add_argument('-t', '--test-time', type=float, default=0.0,
+                        help='The seconds spent by the test suite of each job.')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help='The latency of the stand-in services in milliseconds.')
+    parser.add_argument('--no-warm-up', dest='warm_up', action='store_false',
+                        help='Do not run a job to fill the caches before measuring.')
+    parser.add_argument('--cache-path', type=Path,
+                        help='The cache directory to reuse (default: a temporary one).')
+    parser.add_argument('-o', '--output', type=Path, default=Path('bench_pipeline.json'),
+                        help='The path to write the results as JSON.')
+    parser.add_argument('--baseline', type=Path,
+                        help='The results of a previous run to compare with.')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s %(levelname)s %(name)s %(message)s')
+    if not args.verbose:
+        # Still write the logs of test runs (uploaded to the S3 stand-in).
+        run_logger = logging.getLogger('testion.TestRun')
+        run_logger.setLevel(logging.INFO)
+        run_logger.propagate = False
+    baseline = json.loads(args.baseline.read_text()) if args.baseline else None
+
+    loop = asyncio.get_event_loop()
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            results = loop.run_until_complete(run_benchmark(loop, args, Path(tmpdir)))
+    finally:
+        loop.close()
+    args.output.write_text(json.dumps(results, indent=2, sort_keys=True) + '\n')
+    print_results(results, baseline)
+    print('Results are written to {}'.format(args.output))
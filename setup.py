@@ -46,7 +46,7 @@ setup(
         'Topic :: Software Development :: Testing',
     ],
 
-    packages=['testion'],
+    packages=find_packages(exclude=['tests']),
 
     install_requires=['uvloop', 'aiohttp', 'requests',
                       'pygit2', 'github3.py', 'pyyaml',
@@ -0,0 +1,164 @@
+'''
+Persistent caches shared by test runs of the same server process
+(and other processes using the same cache directory).
+
+Each cache keeps its entries under a separate subdirectory of the cache root,
+which can be configured using the ``TESTION_CACHE_PATH`` environment variable
+(default: ``$XDG_CACHE_HOME/testion``, i.e., ``~/.cache/testion``).
+'''
+
+import asyncio
+import fcntl
+import logging
+import os
+from pathlib import Path
+import re
+import shutil
+
+_size_units = {
+    '': 1,
+    'K': 1024,
+    'M': 1024 ** 2,
+    'G': 1024 ** 3,
+    'T': 1024 ** 4,
+}
+
+
+def get_cache_path():
+    if 'TESTION_CACHE_PATH' in os.environ:
+        path = Path(os.environ['TESTION_CACHE_PATH'])
+    else:
+        cache_home = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+        path = Path(cache_home) / 'testion'
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def parse_size(value):
+    '''
+    Convert a human-readable size such as "512M" or "20G" into bytes.
+    Zero or None means "unlimited".
+    '''
+    if value is None:
+        return 0
+    if isinstance(value, int):
+        return value
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', str(value), re.I)
+    if not m:
+        raise ValueError('Invalid size value: {!r}'.format(value))
+    return int(float(m.group(1)) * _size_units[m.group(2).upper()])
+
+
+def dir_size(path):
+    '''
+    Calculate the disk usage of the given directory tree.
+    Hard-linked files are counted only once.
+    '''
+    total = 0
+    seen_inodes = set()
+    for dirpath, dirnames, filenames in os.walk(str(path)):
+        for name in filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, name))
+            except FileNotFoundError:
+                continue
+            if st.st_nlink > 1:
+                if st.st_ino in seen_inodes:
+                    continue
+                seen_inodes.add(st.st_ino)
+            total += st.st_size
+    return total
+
+
+class FileLock:
+    '''
+    An advisory file lock based on flock(2), which works across processes
+    as well as across threads of the same process as long as each user
+    opens its own FileLock instance.
+    '''
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._fd = None
+
+    @property
+    def locked(self):
+        return self._fd is not None
+
+    def acquire(self, shared=False, blocking=True):
+        if self._fd is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._fd = os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o644)
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self._fd, flags)
+        except BlockingIOError:
+            self.release()
+            return False
+        return True
+
+    async def acquire_async(self, loop, shared=False):
+        '''
+        Acquire the lock in an executor thread.  If cancelled while waiting,
+        the lock is released as soon as the thread gets it, as the blocking
+        call itself cannot be interrupted.
+        '''
+        future = loop.run_in_executor(None, self.acquire, shared)
+        try:
+            await asyncio.shield(future, loop=loop)
+        except asyncio.CancelledError:
+            future.add_done_callback(lambda f: self.release())
+            raise
+
+    def touch(self):
+        '''Mark the lock file as recently used (for LRU eviction).'''
+        os.utime(str(self.path))
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def evict_lru(entries, max_size, log=None):
+    '''
+    Remove the least recently used cache entries until the total size
+    becomes below max_size.
+
+    entries is a list of (entry_path, lock_path) pairs.  The modification
+    time of each lock file is used as the last-used time of its entry,
+    and entries whose locks are currently held by someone are skipped.
+    '''
+    if not max_size:
+        return
+    log = log or logging.getLogger('testion.cache')
+    sized_entries = []
+    for entry_path, lock_path in entries:
+        try:
+            last_used = lock_path.stat().st_mtime
+        except FileNotFoundError:
+            last_used = 0
+        sized_entries.append((last_used, entry_path, lock_path, dir_size(entry_path)))
+    total = sum(item[3] for item in sized_entries)
+    for last_used, entry_path, lock_path, size in sorted(sized_entries, key=lambda item: item[0]):
+        if total <= max_size:
+            break
+        lock = FileLock(lock_path)
+        if not lock.acquire(blocking=False):
+            continue
+        try:
+            log.info('Evicting {} ({:,} bytes)'.format(entry_path, size))
+            shutil.rmtree(str(entry_path), ignore_errors=True)
+            total -= size
+        finally:
+            lock.release()
@@ -0,0 +1,62 @@
+'''
+Recorded per-file test durations used to balance test shards.
+'''
+
+import sqlite3
+import time
+
+from . import get_cache_path
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS durations (
+    repo_name TEXT NOT NULL,
+    report_key TEXT NOT NULL,
+    path TEXT NOT NULL,
+    duration REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (repo_name, report_key, path)
+);
+'''
+
+
+class DurationStore:
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(str(path), isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(_schema)
+
+    def get(self, repo_name, report_key):
+        rows = self._db.execute('SELECT path, duration FROM durations '
+                                'WHERE repo_name = ? AND report_key = ?',
+                                (repo_name, report_key))
+        return dict(rows)
+
+    def update(self, repo_name, report_key, test_cases):
+        '''
+        Record the total duration of each test file from the test case results.
+        Files without timings (e.g., parsed from the console output) are skipped.
+        '''
+        totals = {}
+        for case in test_cases:
+            if case.file:
+                totals[case.file] = totals.get(case.file, 0.0) + case.duration
+        totals = {path: duration for path, duration in totals.items() if duration > 0}
+        now = time.time()
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO durations '
+                                 '(repo_name, report_key, path, duration, updated_at) '
+                                 'VALUES (?, ?, ?, ?, ?)',
+                                 [(repo_name, report_key, path, duration, now)
+                                  for path, duration in totals.items()])
+
+
+_duration_store = None
+
+
+def get_duration_store():
+    global _duration_store
+    if _duration_store is None:
+        _duration_store = DurationStore(get_cache_path() / 'durations.sqlite3')
+    return _duration_store
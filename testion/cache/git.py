@@ -0,0 +1,277 @@
+'''
+A cache of bare mirror repositories, one per GitHub repository.
+
+Each test run leases a mirror, which is incrementally fetched from the remote,
+and then creates its own working copy that borrows the mirror's objects via
+git alternates, instead of cloning the whole repository over the network.
+'''
+
+import asyncio
+from collections import OrderedDict
+import heapq
+import logging
+import os
+from pathlib import Path
+import shutil
+import time
+
+import pygit2
+
+from . import FileLock, evict_lru, get_cache_path, parse_size
+
+MIRROR_REFSPECS = [
+    '+refs/heads/*:refs/heads/*',
+    '+refs/tags/*:refs/tags/*',
+]
+
+log = logging.getLogger('testion.cache.git')
+
+
+class MirrorLease:
+    '''
+    An async context manager that keeps a mirror from being evicted
+    while working copies borrowing its objects are in use.
+    '''
+
+    def __init__(self, cache, full_name, url, callbacks=None, loop=None):
+        self.cache = cache
+        self.full_name = full_name
+        self.url = url
+        self.callbacks = callbacks
+        self.loop = loop
+        self.path = cache.root / (full_name + '.git')
+        self.lock = FileLock(cache.root / (full_name + '.lock'))
+        self.fetch_lock = FileLock(cache.root / (full_name + '.fetch.lock'))
+        self.repo = None
+
+    async def __aenter__(self):
+        # The shared lock keeps the mirror from being evicted while in use.
+        # Fetching only adds objects and moves refs, so it does not wait for
+        # other runs using the mirror, but only for other fetches.
+        await self.lock.acquire_async(self.loop, shared=True)
+        try:
+            self.lock.touch()
+            # Serialize the fetches of this process with an asyncio lock first,
+            # not to occupy executor threads while waiting for the file lock.
+            async with self.cache.get_fetch_lock(self.full_name, self.loop):
+                await self.fetch_lock.acquire_async(self.loop)
+                try:
+                    await self.loop.run_in_executor(None, self._update)
+                finally:
+                    self.fetch_lock.release()
+        except BaseException:
+            self.lock.release()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.repo = None
+        self.lock.release()
+        await self.loop.run_in_executor(None, self.cache.evict)
+
+    def _update(self):
+        if (self.path / 'HEAD').exists():
+            repo = pygit2.Repository(str(self.path))
+            repo.remotes.set_url('origin', self.url)
+            log.info('Fetching updates for the mirror of {}'.format(self.full_name))
+        else:
+            if self.path.exists():
+                # Remove leftovers of an interrupted mirror creation.
+                shutil.rmtree(str(self.path))
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            repo = pygit2.init_repository(str(self.path), bare=True)
+            repo.remotes.create('origin', self.url, MIRROR_REFSPECS[0])
+            for refspec in MIRROR_REFSPECS[1:]:
+                repo.remotes.add_fetch('origin', refspec)
+            log.info('Creating a new mirror of {}'.format(self.full_name))
+        repo.remotes['origin'].fetch(callbacks=self.callbacks,
+                                     prune=pygit2.GIT_FETCH_PRUNE)
+        self.repo = repo
+
+    def create_worktree(self, wcdir, default_branch=None, ref=None):
+        '''
+        Create a new working copy at wcdir which looks like a fresh clone
+        of the remote, with the default branch checked out.
+        If ref is given, it is checked out (detached) instead.
+        '''
+        assert self.repo is not None
+        repo = pygit2.init_repository(str(wcdir))
+        alternates = Path(repo.path) / 'objects' / 'info' / 'alternates'
+        alternates.write_text(str(self.path / 'objects') + '\n')
+        # Reopen the repository so that its object database reads alternates.
+        repo = pygit2.Repository(str(wcdir))
+        repo.remotes.create('origin', self.url)
+        for refname in self.repo.listall_references():
+            target = self.repo.lookup_reference(refname).target
+            if refname.startswith('refs/heads/'):
+                branch = refname[len('refs/heads/'):]
+                repo.create_reference('refs/remotes/origin/' + branch, target)
+            elif refname.startswith('refs/tags/'):
+                repo.create_reference(refname, target)
+        if default_branch is None or \
+                'refs/heads/' + default_branch not in self.repo.listall_references():
+            default_branch = 'master'
+        remote_branch = 'refs/remotes/origin/' + default_branch
+        if remote_branch in repo.listall_references():
+            commit = repo[repo.lookup_reference(remote_branch).target]
+            branch = repo.create_branch(default_branch, commit)
+            branch.upstream = repo.lookup_branch('origin/' + default_branch,
+                                                 pygit2.GIT_BRANCH_REMOTE)
+            if ref is None:
+                repo.checkout(branch.name, strategy=pygit2.GIT_CHECKOUT_FORCE)
+        if ref is not None:
+            commit = repo.revparse_single(ref).peel(pygit2.Commit)
+            repo.checkout_tree(commit.tree, strategy=pygit2.GIT_CHECKOUT_FORCE)
+            repo.set_head(commit.id)
+        return repo
+
+
+# (branch heads, max_age) -> (computed at, valid until, recent head commit ids)
+_recent_heads_cache = OrderedDict()
+RECENT_HEADS_CACHE_SIZE = 64
+BRANCH_WALK_SLOP = 5
+
+
+def _list_branch_heads(repo):
+    '''
+    Returns a list of (branch name, head commit id) of all local and
+    remote-tracking branches, in the order of their reference names.
+    '''
+    heads = []
+    for refname in repo.listall_references():
+        if refname.startswith('refs/heads/'):
+            name = refname[len('refs/heads/'):]
+        elif refname.startswith('refs/remotes/'):
+            name = refname[len('refs/remotes/'):]
+            if name.endswith('/HEAD'):
+                continue
+        else:
+            continue
+        target = repo.lookup_reference(refname).resolve().target
+        heads.append((name, target))
+    return heads
+
+
+def _find_recent_commit_time(repo, oids, cutoff, slop=BRANCH_WALK_SLOP):
+    '''
+    Walk the history from all the given commits at once, newest first,
+    and return the commit time of the first commit newer than cutoff,
+    or None if there is none.  Like git's "--since" option, it stops after
+    seeing a few ("slop") older commits in a row instead of walking the
+    whole history.  (libgit2's time-sorted revwalk would walk the whole
+    history before yielding the first commit.)
+    '''
+    queue = []
+    seen = set()
+    for oid in oids:
+        if oid not in seen:
+            seen.add(oid)
+            commit = repo[oid].peel(pygit2.Commit)
+            heapq.heappush(queue, (-commit.commit_time, str(oid), commit))
+    num_old = 0
+    while queue and num_old < slop:
+        _, _, commit = heapq.heappop(queue)
+        if commit.commit_time >= cutoff:
+            return commit.commit_time
+        num_old += 1
+        for parent in commit.parents:
+            if parent.id not in seen:
+                seen.add(parent.id)
+                heapq.heappush(queue, (-parent.commit_time, str(parent.id), parent))
+    return None
+
+
+def _find_recent_heads(repo, oids, cutoff):
+    '''
+    Returns a dict mapping the given head commits having commits newer than
+    cutoff to the time of such a commit.
+
+    Usually a branch has recent commits if and only if its head commit is
+    recent, so we first look at the head commits only, and then check the
+    other heads with a single walk over all of them together.
+    Only if it finds a recent commit (e.g., due to skewed commit dates),
+    we walk each of those heads separately.
+    '''
+    recent = {}
+    other_heads = []
+    for oid in oids:
+        commit_time = repo[oid].peel(pygit2.Commit).commit_time
+        if commit_time >= cutoff:
+            recent[oid] = commit_time
+        else:
+            other_heads.append(oid)
+    if other_heads and _find_recent_commit_time(repo, other_heads, cutoff) is not None:
+        for oid in other_heads:
+            commit_time = _find_recent_commit_time(repo, [oid], cutoff)
+            if commit_time is not None:
+                recent[oid] = commit_time
+    return recent
+
+
+def find_recent_branches(repo, max_age=86400, now=None):
+    '''
+    Find the branches having commits newer than max_age seconds,
+    skipping branches whose heads are identical to earlier ones.
+
+    The result is cached per the set of branch heads, which changes only
+    when the mirror is fetched with updates, until the recent commits found
+    become older than max_age.  (Older branches never become recent again
+    as time passes.)
+    '''
+    now = time.time() if now is None else now
+    heads = _list_branch_heads(repo)
+    # Commit IDs are content hashes, so the cache can be shared by all repositories.
+    cache_key = (frozenset(heads), max_age)
+    cached = _recent_heads_cache.get(cache_key)
+    if cached is not None and cached[0] <= now <= cached[1]:
+        recent_heads = cached[2]
+        _recent_heads_cache.move_to_end(cache_key)
+    else:
+        unique_heads = list(OrderedDict.fromkeys(oid for _, oid in heads))
+        recent = _find_recent_heads(repo, unique_heads, now - max_age)
+        valid_until = min(recent.values()) + max_age if recent else float('inf')
+        recent_heads = frozenset(recent)
+        _recent_heads_cache[cache_key] = (now, valid_until, recent_heads)
+        if len(_recent_heads_cache) > RECENT_HEADS_CACHE_SIZE:
+            _recent_heads_cache.popitem(last=False)
+
+    branches = []
+    seen_heads = set()
+    for name, oid in heads:
+        if oid in recent_heads and oid not in seen_heads:
+            branches.append(name)
+            seen_heads.add(oid)
+    return branches
+
+
+class GitMirrorCache:
+
+    def __init__(self, root, max_size=0):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self._fetch_locks = {}
+
+    def get_fetch_lock(self, full_name, loop=None):
+        if full_name not in self._fetch_locks:
+            self._fetch_locks[full_name] = asyncio.Lock(loop=loop)
+        return self._fetch_locks[full_name]
+
+    def lease(self, full_name, url, callbacks=None, loop=None):
+        return MirrorLease(self, full_name, url, callbacks, loop)
+
+    def evict(self):
+        entries = [(path, path.with_suffix('.lock'))
+                   for path in self.root.glob('*/*.git')]
+        evict_lru(entries, self.max_size, log)
+
+
+_mirror_cache = None
+
+
+def get_mirror_cache():
+    global _mirror_cache
+    if _mirror_cache is None:
+        max_size = parse_size(os.environ.get('TESTION_MIRROR_CACHE_SIZE', '20G'))
+        _mirror_cache = GitMirrorCache(get_cache_path() / 'mirrors', max_size)
+    return _mirror_cache
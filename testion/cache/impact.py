@@ -0,0 +1,84 @@
+'''
+The maps from source files to the test files exercising them, recorded
+from the coverage of full test runs and used to select the tests affected
+by the changes of a push.
+'''
+
+import sqlite3
+import time
+
+from . import get_cache_path
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS impact_map (
+    repo_name TEXT NOT NULL,
+    report_key TEXT NOT NULL,
+    source TEXT NOT NULL,
+    test_file TEXT NOT NULL,
+    PRIMARY KEY (repo_name, report_key, source, test_file)
+);
+CREATE TABLE IF NOT EXISTS full_runs (
+    repo_name TEXT NOT NULL,
+    report_key TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (repo_name, report_key)
+);
+'''
+
+
+class ImpactStore:
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(str(path), isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(_schema)
+
+    def get_map(self, repo_name, report_key):
+        '''
+        Returns a dict mapping the source files to the sets of test files.
+        '''
+        impact_map = {}
+        rows = self._db.execute('SELECT source, test_file FROM impact_map '
+                                'WHERE repo_name = ? AND report_key = ?',
+                                (repo_name, report_key))
+        for source, test_file in rows:
+            impact_map.setdefault(source, set()).add(test_file)
+        return impact_map
+
+    def get_last_full_run(self, repo_name, report_key):
+        '''
+        Returns the timestamp of the last full run recording the map, or None.
+        '''
+        row = self._db.execute('SELECT updated_at FROM full_runs '
+                               'WHERE repo_name = ? AND report_key = ?',
+                               (repo_name, report_key)).fetchone()
+        return row[0] if row is not None else None
+
+    def update(self, repo_name, report_key, impact_map):
+        '''
+        Replace the map with the one recorded from a new full run.
+        '''
+        with self._db:
+            self._db.execute('DELETE FROM impact_map '
+                             'WHERE repo_name = ? AND report_key = ?',
+                             (repo_name, report_key))
+            self._db.executemany('INSERT OR IGNORE INTO impact_map '
+                                 '(repo_name, report_key, source, test_file) '
+                                 'VALUES (?, ?, ?, ?)',
+                                 [(repo_name, report_key, source, test_file)
+                                  for source, test_files in impact_map.items()
+                                  for test_file in test_files])
+            self._db.execute('INSERT OR REPLACE INTO full_runs '
+                             '(repo_name, report_key, updated_at) VALUES (?, ?, ?)',
+                             (repo_name, report_key, time.time()))
+
+
+_impact_store = None
+
+
+def get_impact_store():
+    global _impact_store
+    if _impact_store is None:
+        _impact_store = ImpactStore(get_cache_path() / 'impact.sqlite3')
+    return _impact_store
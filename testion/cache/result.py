@@ -0,0 +1,92 @@
+'''
+A cache of test results keyed by the tested tree and the test configuration.
+
+Commits with identical trees (e.g., merge commits or rebased branches)
+produce identical results under the same configuration, so their tests
+do not have to be run again.
+'''
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from . import get_cache_path
+from ..reporter.parser import TestResult
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    tree_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    num_tests INTEGER NOT NULL,
+    num_passes INTEGER NOT NULL,
+    num_fails INTEGER NOT NULL,
+    log_link TEXT,
+    created_at REAL NOT NULL
+);
+'''
+
+# The report options which affect test results.
+RESULT_KEY_OPTIONS = ('cls', 'envs', 'install_cmd', 'test_cmd', 'parser', 'retry_failed')
+
+
+def compute_result_key(tree_id, report, python_version):
+    options = [report.get(name) for name in RESULT_KEY_OPTIONS]
+    h = hashlib.sha256()
+    h.update(json.dumps([str(tree_id), options, python_version]).encode())
+    return h.hexdigest()
+
+
+class ResultCache:
+
+    def __init__(self, path, max_age=0):
+        self._db = sqlite3.connect(str(path), isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(_schema)
+        self.max_age = max_age
+
+    def get(self, key):
+        '''
+        Return (test_result, log_link) for the key, or None if not cached
+        or expired.
+        '''
+        cutoff = time.time() - self.max_age if self.max_age else 0
+        row = self._db.execute('SELECT state, num_tests, num_passes, num_fails, log_link '
+                               'FROM results WHERE key = ? AND created_at >= ?',
+                               (key, cutoff)).fetchone()
+        if row is None:
+            return None
+        return TestResult(*row[:4]), row[4]
+
+    def put(self, key, tree_id, test_result, log_link):
+        '''
+        Store the test result for the key.  Only successful results are
+        stored so that failures (which may be flaky or caused by the
+        environment) are always tested again.
+        '''
+        if test_result.state != 'success':
+            return
+        with self._db:
+            self._db.execute('INSERT OR REPLACE INTO results '
+                             '(key, tree_id, state, num_tests, num_passes, num_fails, '
+                             ' log_link, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (key, str(tree_id), test_result.state,
+                              test_result.num_tests, test_result.num_passes,
+                              test_result.num_fails, log_link, time.time()))
+            if self.max_age:
+                self._db.execute('DELETE FROM results WHERE created_at < ?',
+                                 (time.time() - self.max_age,))
+
+
+_result_cache = None
+
+
+def get_result_cache():
+    global _result_cache
+    if _result_cache is None:
+        max_age = int(os.environ.get('TESTION_RESULT_CACHE_DAYS', '30')) * 86400
+        _result_cache = ResultCache(get_cache_path() / 'results.sqlite3', max_age)
+    return _result_cache
@@ -0,0 +1,161 @@
+'''
+A cache of prepared virtualenvs keyed by the inputs of their installation.
+
+Cached virtualenvs are never used in place; each test run gets its own
+snapshot (a reflink or hard-link copy) relocated to its own path.
+'''
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import uuid
+
+from . import FileLock, evict_lru, get_cache_path, parse_size
+
+# Files in the checkout which affect what gets installed into the virtualenv.
+DEPENDENCY_FILE_PATTERNS = [
+    'requirements*.txt',
+    'requirements/*.txt',
+    'setup.py',
+    'setup.cfg',
+    'pyproject.toml',
+    'Pipfile.lock',
+    'poetry.lock',
+]
+
+# Bump this when the bootstrapping commands in TestReporterBase.run() change.
+BOOTSTRAP_VERSION = 1
+
+log = logging.getLogger('testion.cache.venv')
+
+
+def compute_venv_key(python_version, envs, install_cmd, wcdir):
+    h = hashlib.sha256()
+    h.update(json.dumps([BOOTSTRAP_VERSION, python_version,
+                         envs, install_cmd]).encode())
+    wcdir = Path(wcdir)
+    for pattern in DEPENDENCY_FILE_PATTERNS:
+        for path in sorted(wcdir.glob(pattern)):
+            if not path.is_file():
+                continue
+            h.update(str(path.relative_to(wcdir)).encode() + b'\0')
+            h.update(path.read_bytes())
+            h.update(b'\0')
+    return h.hexdigest()
+
+
+def _is_mutable(relpath):
+    # Files that tools may rewrite in place must not be shared via hard links.
+    return (relpath.parts[0] == 'bin'
+            or relpath.suffix == '.pth'
+            or relpath.name == 'pyvenv.cfg')
+
+
+def snapshot_tree(src, dst):
+    '''
+    Copy a directory tree cheaply, using copy-on-write reflinks if the
+    filesystem supports them, or hard links for immutable files otherwise.
+    '''
+    src, dst = Path(src), Path(dst)
+    try:
+        subprocess.run(['cp', '-a', '--reflink=always', str(src), str(dst)],
+                       check=True, stderr=subprocess.DEVNULL)
+        return
+    except (OSError, subprocess.CalledProcessError):
+        shutil.rmtree(str(dst), ignore_errors=True)
+
+    def link_or_copy(s, d):
+        if not _is_mutable(Path(s).relative_to(str(src))):
+            try:
+                os.link(s, d)
+                return d
+            except OSError:
+                pass
+        return shutil.copy2(s, d)
+
+    shutil.copytree(str(src), str(dst), symlinks=True, copy_function=link_or_copy)
+
+
+def relocate_venv(venvdir, old_prefix):
+    '''
+    Rewrite the absolute paths embedded in the scripts of a copied virtualenv.
+    '''
+    old = str(old_prefix).encode()
+    new = str(venvdir).encode()
+    for path in (Path(venvdir) / 'bin').iterdir():
+        if path.is_symlink() or not path.is_file():
+            continue
+        content = path.read_bytes()
+        if old not in content:
+            continue
+        tmp_path = path.with_name('.{}.tmp'.format(path.name))
+        tmp_path.write_bytes(content.replace(old, new))
+        shutil.copymode(str(path), str(tmp_path))
+        os.replace(str(tmp_path), str(path))
+
+
+class VenvCache:
+
+    def __init__(self, root, max_size=0):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+
+    def _lock(self, key):
+        return FileLock(self.root / (key + '.lock'))
+
+    def restore(self, key, venvdir):
+        '''
+        Populate venvdir (which must be empty or non-existent) with a snapshot
+        of the cached virtualenv.  Returns False if there is no cached one.
+        '''
+        entry = self.root / key
+        with self._lock(key) as lock:
+            if not (entry / 'prefix').exists():
+                return False
+            lock.touch()
+            venvdir = Path(venvdir)
+            if venvdir.exists():
+                venvdir.rmdir()
+            snapshot_tree(entry / 'venv', venvdir)
+            relocate_venv(venvdir, (entry / 'prefix').read_text())
+        return True
+
+    def store(self, key, venvdir):
+        '''
+        Save a full copy of venvdir as the cached virtualenv for key.
+        '''
+        entry = self.root / key
+        tmp_entry = self.root / '.{}.{}.tmp'.format(key, uuid.uuid4().hex)
+        try:
+            tmp_entry.mkdir()
+            shutil.copytree(str(venvdir), str(tmp_entry / 'venv'), symlinks=True)
+            (tmp_entry / 'prefix').write_text(str(venvdir))
+            with self._lock(key) as lock:
+                if not entry.exists():
+                    os.rename(str(tmp_entry), str(entry))
+                    lock.touch()
+        finally:
+            shutil.rmtree(str(tmp_entry), ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        entries = [(path, path.with_name(path.name + '.lock'))
+                   for path in self.root.iterdir()
+                   if path.is_dir() and not path.name.startswith('.')]
+        evict_lru(entries, self.max_size, log)
+
+
+_venv_cache = None
+
+
+def get_venv_cache():
+    global _venv_cache
+    if _venv_cache is None:
+        max_size = parse_size(os.environ.get('TESTION_VENV_CACHE_SIZE', '10G'))
+        _venv_cache = VenvCache(get_cache_path() / 'venvs', max_size)
+    return _venv_cache
@@ -0,0 +1,110 @@
+'''
+A wheelhouse and a pip cache directory shared by all test runs.
+
+pip invocations inside test virtualenvs are pointed to them via the
+``PIP_FIND_LINKS`` and ``PIP_CACHE_DIR`` environment variables, and the wheels
+built by pip (e.g., from source distributions) are collected into the
+wheelhouse so that later runs can install them without rebuilding.
+'''
+
+import logging
+import os
+from pathlib import Path
+import shutil
+import uuid
+
+from . import FileLock, get_cache_path, parse_size
+
+log = logging.getLogger('testion.cache.wheel')
+
+
+class Wheelhouse:
+
+    def __init__(self, root, max_size=0):
+        self.root = Path(root)
+        self.path = self.root / 'wheels'
+        self.pip_cache_path = self.root / 'cache'
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.pip_cache_path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+
+    def lock(self):
+        '''
+        Returns a lock which installers should hold (shared) while pip may read
+        the wheelhouse, and which eviction takes exclusively.
+        '''
+        return FileLock(self.root / 'wheels.lock')
+
+    def get_env(self):
+        return {
+            'PIP_FIND_LINKS': str(self.path),
+            'PIP_CACHE_DIR': str(self.pip_cache_path),
+        }
+
+    def collect(self):
+        '''
+        Copy the wheels built by pip into the wheelhouse.
+        Each wheel is written to a temporary file first and then renamed,
+        so that concurrent pip runs never see partially written wheels.
+        '''
+        num_collected = 0
+        for wheel in (self.pip_cache_path / 'wheels').glob('**/*.whl'):
+            dest = self.path / wheel.name
+            if dest.exists():
+                os.utime(str(dest))
+                continue
+            tmp_dest = self.path / '.{}.{}.tmp'.format(wheel.name, uuid.uuid4().hex)
+            try:
+                shutil.copyfile(str(wheel), str(tmp_dest))
+                os.replace(str(tmp_dest), str(dest))
+                num_collected += 1
+            except FileNotFoundError:
+                # The wheel has been removed by another pip process.
+                pass
+            finally:
+                if tmp_dest.exists():
+                    tmp_dest.unlink()
+        if num_collected:
+            log.info('Collected {} new wheel(s) into the wheelhouse'.format(num_collected))
+        self.evict()
+
+    def evict(self):
+        if not self.max_size:
+            return
+        lock = self.lock()
+        if not lock.acquire(blocking=False):
+            # Someone is installing packages now; try again next time.
+            return
+        try:
+            files = []
+            for base in (self.path, self.pip_cache_path):
+                for dirpath, dirnames, filenames in os.walk(str(base)):
+                    for name in filenames:
+                        path = os.path.join(dirpath, name)
+                        try:
+                            st = os.stat(path)
+                        except FileNotFoundError:
+                            continue
+                        files.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+            total = sum(item[1] for item in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_size:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        finally:
+            lock.release()
+
+
+_wheelhouse = None
+
+
+def get_wheelhouse():
+    global _wheelhouse
+    if _wheelhouse is None:
+        max_size = parse_size(os.environ.get('TESTION_WHEEL_CACHE_SIZE', '5G'))
+        _wheelhouse = Wheelhouse(get_cache_path() / 'pip', max_size)
+    return _wheelhouse
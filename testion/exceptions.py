@@ -1,2 +1,10 @@
 class UnsupportedEventError(RuntimeError):
     pass
+
+
+class CommandError(RuntimeError):
+
+    def __init__(self, cmd, returncode):
+        super().__init__('Command {!r} exited with status {}'.format(cmd, returncode))
+        self.cmd = cmd
+        self.returncode = returncode
@@ -0,0 +1,193 @@
+'''
+A non-blocking wrapper of github3 clients.
+
+Blocking github3 calls are executed in a dedicated thread pool, and the
+clients (with their pooled HTTP sessions) and repository objects are shared
+by all reporters using the same credentials.
+'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import logging
+import os
+import time
+
+import github3
+
+from . import metrics
+
+# The number of API requests kept in reserve when the rate limit is low.
+RATE_LIMIT_RESERVE = 10
+MAX_API_THREADS = 8
+
+STATUS_MAX_RETRIES = 5
+STATUS_RETRY_DELAY = 1.0  # doubled on every retry
+
+log = logging.getLogger('testion.github')
+
+_executor = None
+_clients = {}
+
+
+class RequestBudget:
+    '''
+    Tracks the API rate limit from the response headers and makes callers
+    wait for the next reset when the remaining budget is about to run out.
+    '''
+
+    def __init__(self, reserve=RATE_LIMIT_RESERVE):
+        self.reserve = reserve
+        self.remaining = None
+        self.reset_at = None
+
+    def update(self, response, *args, **kwargs):
+        # Used as a requests response hook, which runs in the API threads.
+        headers = response.headers
+        try:
+            self.remaining = int(headers['X-RateLimit-Remaining'])
+            self.reset_at = int(headers['X-RateLimit-Reset'])
+        except (KeyError, ValueError):
+            pass
+        return response
+
+    async def acquire(self, loop=None):
+        if self.remaining is not None and self.remaining <= self.reserve:
+            delay = self.reset_at - time.time()
+            if delay > 0:
+                log.warning('GitHub API rate limit is almost exhausted; '
+                            'waiting {:.0f} seconds until reset'.format(delay))
+                await asyncio.sleep(delay, loop=loop)
+            self.remaining = None
+        elif self.remaining is not None:
+            self.remaining -= 1
+
+
+class StatusDispatcher:
+    '''
+    Sends commit statuses in the background, one sender per (repository, sha,
+    context).  If new states are posted while a previous one is being sent,
+    only the latest one is sent afterwards and the intermediate ones are
+    dropped.  Failed requests are retried with exponential backoff.
+    '''
+
+    def __init__(self, client):
+        self.client = client
+        self._latest = {}   # key -> (status kwargs, logger, waiters)
+        self._senders = {}  # key -> sender task
+
+    def post(self, remote_repo, sha, context, state, description, target_url,
+             logger=None):
+        '''
+        Schedule a status update without waiting for it.  The returned future
+        is resolved when this or a newer status of the same commit and context
+        is delivered (or finally failed).
+        '''
+        loop = asyncio.get_event_loop()
+        key = (remote_repo, sha, context)
+        waiter = loop.create_future()
+        waiters = [waiter]
+        if key in self._latest:
+            # Supersede the state which has not been sent yet.
+            waiters.extend(self._latest[key][2])
+        self._latest[key] = (dict(sha=sha, state=state, description=description,
+                                  context=context, target_url=target_url),
+                             logger or log, waiters)
+        if key not in self._senders:
+            self._senders[key] = loop.create_task(self._send_loop(key))
+        return waiter
+
+    async def _send_loop(self, key):
+        remote_repo = key[0]
+        try:
+            while key in self._latest:
+                status, logger, waiters = self._latest.pop(key)
+                short_sha = status['sha'][:7]
+                delay = STATUS_RETRY_DELAY
+                for retry in range(STATUS_MAX_RETRIES + 1):
+                    try:
+                        result = await self.client.call(remote_repo.create_status, **status)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception:
+                        logger.exception('Error on creating status for commit {}'
+                                         .format(short_sha))
+                        result = None
+                    if result:
+                        logger.info("Marked '{0}' status for commit {1}"
+                                    .format(status['state'], short_sha))
+                        break
+                    if retry == STATUS_MAX_RETRIES:
+                        logger.error('Error on creating status for commit {}'
+                                     .format(short_sha))
+                        break
+                    await asyncio.sleep(delay)
+                    delay *= 2
+                    if key in self._latest:
+                        # Retry with the newer state posted in the meantime,
+                        # not to overwrite it with the outdated one.
+                        status, logger, newer_waiters = self._latest.pop(key)
+                        waiters.extend(newer_waiters)
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(bool(result))
+        finally:
+            del self._senders[key]
+
+
+class GitHubClient:
+
+    def __init__(self, user, token):
+        url = os.environ.get('TESTION_GITHUB_URL')
+        if url:
+            # GitHub Enterprise or a compatible server (e.g., for benchmarks)
+            self.gh = github3.enterprise_login(user, token, url=url)
+        else:
+            self.gh = github3.login(user, token)
+        self.budget = RequestBudget()
+        self.gh.session.hooks['response'].append(self.budget.update)
+        self.statuses = StatusDispatcher(self)
+        self._repos = {}
+
+    async def call(self, func, *args, **kwargs):
+        '''
+        Call a (blocking) github3 method in the API thread pool.
+        '''
+        loop = asyncio.get_event_loop()
+        await self.budget.acquire(loop=loop)
+        with metrics.external_call_duration.time(service='github'):
+            return await loop.run_in_executor(_get_executor(),
+                                              functools.partial(func, *args, **kwargs))
+
+    async def repository(self, owner, name):
+        key = (owner, name)
+        if key not in self._repos:
+            # Share the pending lookup with concurrent callers.
+            self._repos[key] = asyncio.ensure_future(
+                self.call(self.gh.repository, owner, name))
+        try:
+            repo = await asyncio.shield(self._repos[key])
+        except Exception:
+            repo = None
+        if not repo:
+            # Do not cache failed lookups.
+            self._repos.pop(key, None)
+        return repo
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=MAX_API_THREADS)
+    return _executor
+
+
+def get_client(user, token):
+    key = (user, token)
+    if key not in _clients:
+        _clients[key] = GitHubClient(user, token)
+    return _clients[key]
+
+
+def clear_clients():
+    _clients.clear()
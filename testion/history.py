@@ -0,0 +1,178 @@
+'''
+The history of test runs and per-test results, kept in SQLite for
+trend queries and for the features using the outcomes of past runs.
+'''
+
+import json
+import sqlite3
+import time
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    repo_name TEXT NOT NULL,
+    report_key TEXT NOT NULL,
+    branch TEXT,
+    sha TEXT NOT NULL,
+    state TEXT NOT NULL,
+    num_tests INTEGER,
+    num_passes INTEGER,
+    num_fails INTEGER,
+    started_at REAL NOT NULL,
+    duration REAL NOT NULL,
+    stages TEXT NOT NULL,
+    log_link TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_by_report
+    ON runs (repo_name, report_key, started_at);
+CREATE TABLE IF NOT EXISTS test_results (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    repo_name TEXT NOT NULL,
+    report_key TEXT NOT NULL,
+    test_id TEXT NOT NULL,
+    file TEXT,
+    outcome TEXT NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS test_results_by_test
+    ON test_results (repo_name, report_key, test_id, run_id);
+CREATE INDEX IF NOT EXISTS test_results_by_run
+    ON test_results (run_id);
+'''
+
+_run_columns = ('id', 'repo_name', 'report_key', 'branch', 'sha', 'state',
+                'num_tests', 'num_passes', 'num_fails', 'started_at', 'duration',
+                'stages', 'log_link')
+
+
+class HistoryStore:
+    '''
+    Records each tested ref as a run with its stage timings,
+    and the outcome and duration of each test of the run.
+    If path is None, the history is kept only in memory.
+    '''
+
+    def __init__(self, path=None):
+        self._db = sqlite3.connect(str(path) if path else ':memory:',
+                                   isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('PRAGMA foreign_keys=ON')
+        self._db.executescript(_schema)
+
+    def add_run(self, repo_name, report_key, branch, sha, test_result,
+                started_at, stages, log_link, test_cases=()):
+        '''
+        Record a run and its test cases, and return the ID of the run.
+        '''
+        if test_result is not None:
+            state, num_tests, num_passes, num_fails = test_result
+        else:
+            state, num_tests, num_passes, num_fails = 'error', None, None, None
+        with self._db:
+            cur = self._db.execute(
+                'INSERT INTO runs (repo_name, report_key, branch, sha, state, '
+                'num_tests, num_passes, num_fails, started_at, duration, stages, log_link) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (repo_name, report_key, branch, sha, state,
+                 num_tests, num_passes, num_fails, started_at,
+                 time.time() - started_at, json.dumps(stages), log_link))
+            run_id = cur.lastrowid
+            self._db.executemany(
+                'INSERT INTO test_results '
+                '(run_id, repo_name, report_key, test_id, file, outcome, duration) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(run_id, repo_name, report_key, case.test_id, case.file,
+                  case.outcome, case.duration) for case in test_cases])
+        return run_id
+
+    def get_runs(self, repo_name=None, report_key=None, branch=None, limit=50):
+        '''
+        Returns the latest runs as dicts, newest first.
+        '''
+        conds, params = self._filter(repo_name=repo_name, report_key=report_key,
+                                     branch=branch)
+        rows = self._db.execute('SELECT {} FROM runs {} ORDER BY started_at DESC LIMIT ?'
+                                .format(', '.join(_run_columns), conds),
+                                params + [limit])
+        runs = []
+        for row in rows:
+            run = dict(zip(_run_columns, row))
+            run['stages'] = json.loads(run['stages'])
+            runs.append(run)
+        return runs
+
+    def get_test_results(self, repo_name, report_key, test_id, limit=50):
+        '''
+        Returns the latest results of a test with the runs they belong to,
+        newest first.
+        '''
+        rows = self._db.execute(
+            'SELECT r.id, r.branch, r.sha, r.started_at, t.outcome, t.duration '
+            'FROM test_results t JOIN runs r ON r.id = t.run_id '
+            'WHERE t.repo_name = ? AND t.report_key = ? AND t.test_id = ? '
+            'ORDER BY t.run_id DESC LIMIT ?',
+            (repo_name, report_key, test_id, limit))
+        return [dict(zip(('run_id', 'branch', 'sha', 'started_at', 'outcome', 'duration'),
+                         row))
+                for row in rows]
+
+    def get_failed_first_order(self, repo_name, report_key, num_runs=20):
+        '''
+        Returns the IDs of the tests failed (including flaky ones) in the last
+        num_runs runs of the report: the ones failed in the latest run first,
+        then the others in the descending order of their failure rates.
+        '''
+        run_ids = [row[0] for row in self._db.execute(
+            'SELECT id FROM runs WHERE repo_name = ? AND report_key = ? '
+            'AND num_tests > 0 ORDER BY id DESC LIMIT ?',
+            (repo_name, report_key, num_runs))]
+        if not run_ids:
+            return []
+        rows = self._db.execute(
+            "SELECT test_id, MAX(CASE WHEN outcome IN ('failed', 'error', 'flaky') "
+            "                         THEN run_id END) AS last_failed, "
+            "       AVG(CASE WHEN outcome IN ('failed', 'error', 'flaky') "
+            "                THEN 1.0 ELSE 0.0 END) AS failure_rate "
+            'FROM test_results '
+            'WHERE repo_name = ? AND report_key = ? AND run_id >= ? '
+            'GROUP BY test_id HAVING last_failed IS NOT NULL',
+            (repo_name, report_key, run_ids[-1]))
+        latest = run_ids[0]
+        stats = sorted(rows, key=lambda row: (row[1] != latest, -row[2], -row[1]))
+        return [test_id for test_id, _, _ in stats]
+
+    def _filter(self, **kwargs):
+        conds = []
+        params = []
+        for column, value in kwargs.items():
+            if value is not None:
+                conds.append('{} = ?'.format(column))
+                params.append(value)
+        return ('WHERE ' + ' AND '.join(conds)) if conds else '', params
+
+    def close(self):
+        self._db.close()
+
+
+_history = None
+
+
+def open_history(path=None):
+    global _history
+    _history = HistoryStore(path)
+    return _history
+
+
+def get_history():
+    '''
+    Returns the history store opened by the server, or None if not opened.
+    '''
+    return _history
+
+
+def close_history():
+    global _history
+    if _history is not None:
+        _history.close()
+        _history = None
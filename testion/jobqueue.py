@@ -0,0 +1,183 @@
+'''
+A durable job queue backed by SQLite.
+
+Each job is stored as a descriptor (repository, report key, ref, push payload)
+so that it can be re-created after a server restart.  Jobs are "leased" while
+running, and unfinished leases are put back into the queue on startup.
+'''
+
+import asyncio
+from collections import deque
+import json
+import sqlite3
+import time
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    repo_name TEXT NOT NULL,
+    report_key TEXT NOT NULL,
+    ref TEXT,
+    payload TEXT NOT NULL,
+    enqueued_at REAL NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    leased_at REAL
+);
+'''
+
+
+class Job:
+
+    def __init__(self, repo_name, report_key, ref, data, reporter=None,
+                 id=None, enqueued_at=None):
+        self.id = id
+        self.repo_name = repo_name
+        self.report_key = report_key
+        self.ref = ref
+        self.data = data
+        self.enqueued_at = enqueued_at or time.time()
+        # The reporter is created lazily for jobs recovered from the database.
+        self.reporter = reporter
+        self.superseded_by = None
+
+    @property
+    def key(self):
+        return (self.repo_name, self.report_key, self.ref)
+
+
+class JobQueue:
+    '''
+    A FIFO queue of jobs which keeps at most one pending job per
+    (repository, report key, ref).  Putting a job with the same key replaces
+    the pending one at its original position, so that only the latest push
+    of a branch gets tested.
+
+    It also keeps track of running jobs so that they can be cancelled
+    when superseded.  If path is None, jobs are kept only in memory.
+    '''
+
+    def __init__(self, path=None, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self._db = sqlite3.connect(str(path) if path else ':memory:',
+                                   isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(_schema)
+        self._pending = deque()
+        self._index = {}
+        self._running = {}
+        self._unfinished = 0
+        # Set whenever a job is added or released, to re-check waiting get() calls.
+        self._changed = asyncio.Event(loop=self._loop)
+        self._finished = asyncio.Event(loop=self._loop)
+        self._finished.set()
+        self._recover()
+
+    def _recover(self):
+        with self._db:
+            self._db.execute("UPDATE jobs SET state = 'queued', leased_at = NULL "
+                             "WHERE state = 'leased'")
+        rows = self._db.execute('SELECT id, repo_name, report_key, ref, payload, enqueued_at '
+                                "FROM jobs WHERE state = 'queued' ORDER BY id")
+        for id, repo_name, report_key, ref, payload, enqueued_at in rows.fetchall():
+            job = Job(repo_name, report_key, ref, json.loads(payload),
+                      id=id, enqueued_at=enqueued_at)
+            old_job = self._index.get(job.key)
+            if old_job is not None:
+                # A job interrupted while running and a newer push for the same
+                # branch: keep only the newer one at the position of the older.
+                with self._db:
+                    self._db.execute('DELETE FROM jobs WHERE id = ?', (old_job.id,))
+                self._index[job.key] = job
+                self._pending[self._pending.index(old_job)] = job
+            else:
+                self._append(job)
+
+    def _append(self, job):
+        self._pending.append(job)
+        self._index[job.key] = job
+        self._unfinished += 1
+        self._finished.clear()
+        self._changed.set()
+
+    def qsize(self):
+        return len(self._pending)
+
+    async def put(self, job):
+        '''
+        Enqueue the job and return the pending job it has superseded, if any.
+        '''
+        old_job = self._index.get(job.key)
+        payload = json.dumps(job.data)
+        if old_job is not None:
+            job.id = old_job.id
+            with self._db:
+                self._db.execute('UPDATE jobs SET payload = ?, enqueued_at = ? WHERE id = ?',
+                                 (payload, job.enqueued_at, job.id))
+            old_job.superseded_by = job
+            self._index[job.key] = job
+            self._pending[self._pending.index(old_job)] = job
+        else:
+            with self._db:
+                cur = self._db.execute(
+                    'INSERT INTO jobs (repo_name, report_key, ref, payload, enqueued_at) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (job.repo_name, job.report_key, job.ref, payload, job.enqueued_at))
+            job.id = cur.lastrowid
+            self._append(job)
+        return old_job
+
+    async def get(self, ready=None):
+        '''
+        Lease the next job.  If ready is given, it leases the first job for
+        which ready(job) returns true, waiting until there is such a job.
+        '''
+        while True:
+            job = next((job for job in self._pending
+                        if ready is None or ready(job)), None)
+            if job is not None:
+                break
+            self._changed.clear()
+            await self._changed.wait()
+        self._pending.remove(job)
+        if self._index.get(job.key) is job:
+            del self._index[job.key]
+        with self._db:
+            self._db.execute("UPDATE jobs SET state = 'leased', leased_at = ? WHERE id = ?",
+                             (time.time(), job.id))
+        return job
+
+    def task_done(self, job):
+        '''
+        Mark the leased job as finished and remove it from the database.
+        '''
+        with self._db:
+            self._db.execute('DELETE FROM jobs WHERE id = ?', (job.id,))
+        self._release(job)
+
+    def abandon(self, job):
+        '''
+        Give up the leased job without finishing it (e.g., on shutdown),
+        so that it is recovered on the next startup.
+        '''
+        self._release(job)
+
+    def _release(self, job):
+        if self._running.get(job.key, (None, None))[0] is job:
+            del self._running[job.key]
+        self._unfinished -= 1
+        if self._unfinished == 0:
+            self._finished.set()
+        self._changed.set()
+
+    async def join(self):
+        await self._finished.wait()
+
+    def get_running(self, key):
+        return self._running.get(key, (None, None))
+
+    def set_running(self, job, task):
+        self._running[job.key] = (job, task)
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,57 @@
+'''
+A registry of the log files of running (and recently finished) jobs,
+served by the /jobs/{id}/log route while the jobs are still running.
+'''
+
+from collections import OrderedDict
+import os
+
+# The number of finished jobs whose logs are still served.
+MAX_FINISHED_LOGS = 1000
+
+
+class LiveLog:
+
+    def __init__(self, job_id, path):
+        self.job_id = job_id
+        self.path = path
+        self.finished = False
+
+
+_live_logs = OrderedDict()
+
+
+def get_live_log_url(job_id):
+    '''
+    Returns the public URL of the live log, or None if the public URL of
+    the server is not configured with TESTION_PUBLIC_URL.
+    '''
+    public_url = os.environ.get('TESTION_PUBLIC_URL')
+    if not public_url:
+        return None
+    return '{}/jobs/{}/log'.format(public_url.rstrip('/'), job_id)
+
+
+def register(job_id, path):
+    _live_logs[job_id] = LiveLog(job_id, path)
+    return _live_logs[job_id]
+
+
+def finish(job_id):
+    live_log = _live_logs.get(job_id)
+    if live_log is None:
+        return
+    live_log.finished = True
+    # Forget the oldest finished jobs.
+    _live_logs.move_to_end(job_id)
+    num_finished = sum(1 for entry in _live_logs.values() if entry.finished)
+    for old_id in list(_live_logs):
+        if num_finished <= MAX_FINISHED_LOGS:
+            break
+        if _live_logs[old_id].finished:
+            del _live_logs[old_id]
+            num_finished -= 1
+
+
+def get(job_id):
+    return _live_logs.get(job_id)
@@ -0,0 +1,155 @@
+'''
+In-process metrics exposed in the Prometheus text format on /metrics.
+
+Updating a metric costs only a dict lookup and a few additions,
+so that instrumenting the job pipeline has negligible overhead.
+'''
+
+import bisect
+import contextlib
+import time
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60,
+                   120, 300, 600, 1200, 1800, 3600, float('inf'))
+
+_registry = []
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                                                       .replace('"', '\\"')
+                                                       .replace('\n', '\\n'))
+                          for k, v in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+
+    type = None
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self):
+        '''
+        Yields (name, labels, value) tuples of the current values.
+        '''
+        for key, value in sorted(self._values.items()):
+            yield self.name, tuple(zip(self.labelnames, key)), value
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.doc),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        for name, labels, value in self.samples():
+            lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def __init__(self, name, doc, labelnames=()):
+        super().__init__(name, doc, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        '''
+        Read the (unlabeled) value by calling the function when exposed.
+        '''
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            yield self.name, (), self._function()
+        else:
+            yield from super().samples()
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, doc, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # [count per bucket..., sum]
+            state = self._values[key] = [0] * len(self.buckets) + [0.0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        begin = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - begin, **labels)
+
+    def samples(self):
+        for key, state in sorted(self._values.items()):
+            labels = tuple(zip(self.labelnames, key))
+            count = 0
+            for bound, n in zip(self.buckets, state):
+                count += n
+                yield self.name + '_bucket', labels + (('le', _format_value(bound)),), count
+            yield self.name + '_sum', labels, state[-1]
+            yield self.name + '_count', labels, count
+
+
+def generate_latest():
+    '''
+    Returns all metrics in the Prometheus text exposition format.
+    '''
+    return '\n'.join(metric.expose() for metric in _registry) + '\n'
+
+
+stage_duration = Histogram('testion_stage_duration_seconds',
+                           'Time spent in each stage of test runs.', ['stage'])
+command_duration = Histogram('testion_command_duration_seconds',
+                             'Time spent running shell commands.')
+external_call_duration = Histogram('testion_external_call_duration_seconds',
+                                   'Time spent calling external services.', ['service'])
+queue_wait = Histogram('testion_queue_wait_seconds',
+                       'Time jobs waited in the queue until they started.')
+jobs_total = Counter('testion_jobs_total', 'Number of finished jobs.', ['outcome'])
+queue_depth = Gauge('testion_queue_depth', 'Number of pending jobs in the queue.')
+active_workers = Gauge('testion_active_workers', 'Number of running jobs.')
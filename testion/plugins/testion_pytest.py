@@ -0,0 +1,96 @@
+'''
+A pytest plugin loaded into test commands by testion (``-p testion_pytest``
+in ``PYTEST_ADDOPTS``).
+
+It is imported from the tested project's virtualenv, so it must not depend
+on testion itself or anything other than pytest.
+
+Environment variables:
+
+ * ``TESTION_SELECT_FILE``: the path of a file listing test files, directories
+   or node IDs (one per line) to run; the other collected tests are deselected.
+ * ``TESTION_ORDER_FILE``: the path of a file listing node IDs (one per line)
+   to run first in the listed order, such as the recently failed tests.
+ * ``TESTION_IMPACT_MAP``: the path of a JSON file to write the map from the
+   source files to the test files executing them, measured with coverage.py
+   (if installed) while running the tests.
+'''
+
+import json
+import os
+
+import pytest
+
+
+def _read_lines(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def _matches(nodeid, selectors):
+    if nodeid in selectors:
+        return True
+    # Match the containing file or any parent node (class, parametrized base).
+    parts = nodeid.split('::')
+    for idx in range(1, len(parts)):
+        if '::'.join(parts[:idx]) in selectors:
+            return True
+    if nodeid.split('[')[0] in selectors:
+        return True
+    path = parts[0]
+    return any(path.startswith(selector.rstrip('/') + '/') for selector in selectors)
+
+
+class ImpactRecorder:
+
+    def __init__(self, coverage, path, rootdir):
+        self.path = path
+        self.rootdir = rootdir
+        self.cov = coverage.Coverage(data_file=None, include=[os.path.join(rootdir, '*')])
+        self.cov.start()
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_runtest_setup(self, item):
+        self.cov.switch_context(item.location[0])
+
+    def pytest_sessionfinish(self, session):
+        self.cov.stop()
+        data = self.cov.get_data()
+        impact_map = {}
+        for filename in data.measured_files():
+            test_files = set()
+            for contexts in data.contexts_by_lineno(filename).values():
+                test_files.update(context for context in contexts if context)
+            if test_files:
+                source = os.path.relpath(filename, self.rootdir).replace(os.sep, '/')
+                impact_map[source] = sorted(test_files)
+        with open(self.path, 'w') as f:
+            json.dump(impact_map, f)
+
+
+def pytest_configure(config):
+    impact_map_path = os.environ.get('TESTION_IMPACT_MAP')
+    if impact_map_path:
+        try:
+            import coverage
+        except ImportError:
+            return
+        recorder = ImpactRecorder(coverage, impact_map_path, str(config.rootdir))
+        config.pluginmanager.register(recorder, 'testion_impact')
+
+
+def pytest_collection_modifyitems(session, config, items):
+    select_file = os.environ.get('TESTION_SELECT_FILE')
+    if select_file:
+        selectors = set(_read_lines(select_file))
+        selected = []
+        deselected = []
+        for item in items:
+            (selected if _matches(item.nodeid, selectors) else deselected).append(item)
+        if deselected:
+            config.hook.pytest_deselected(items=deselected)
+        items[:] = selected
+    order_file = os.environ.get('TESTION_ORDER_FILE')
+    if order_file:
+        priority = {nodeid: idx for idx, nodeid in enumerate(_read_lines(order_file))}
+        items.sort(key=lambda item: priority.get(item.nodeid, len(priority)))
@@ -1,57 +1,63 @@
 import asyncio
 import subprocess
-from collections import namedtuple, OrderedDict as odict
+from collections import deque, namedtuple, OrderedDict as odict
+import codecs
 import contextlib
 from datetime import datetime
+import json
 import logging
 import os
 from pathlib import Path
 import re
+import signal
 import sys
 import tempfile
+import time
 import uuid
 
-import github3
 import pygit2
 
-TestResult = namedtuple('TestResult', 'state num_tests num_passes num_fails')
+from .. import metrics
+from ..cache.durations import get_duration_store
+from ..cache.git import find_recent_branches, get_mirror_cache
+from ..cache.impact import get_impact_store
+from ..cache.result import compute_result_key, get_result_cache
+from ..cache.venv import compute_venv_key, get_venv_cache
+from ..cache.wheel import get_wheelhouse
+from ..exceptions import CommandError
+from ..github import get_client as get_github_client
+from ..history import get_history
+from .impact import get_changed_files, select_tests
+from .parser import TestResult, create_parser, merge_test_results
+from .sharding import parse_collected_files, split_into_shards
+
+# The size of the output tail returned by run_command() for result parsing.
+# It caps the memory used per job regardless of how verbose the tests are.
+OUTPUT_TAIL_SIZE = 256 * 1024
+OUTPUT_CHUNK_SIZE = 64 * 1024
+
+# The interval (in seconds) to report the live counts of test results.
+PROGRESS_INTERVAL = 30
+
+# The interval (in seconds) to check new failures in the fast-fail mode.
+FAST_FAIL_CHECK_INTERVAL = 1
+
+# The maximum size of the test collection output used for sharding.
+COLLECT_OUTPUT_SIZE = 16 * 1024 * 1024
+
+plugins_path = Path(__file__).resolve().parent.parent / 'plugins'
+
+# Install commands linking the virtualenv to the working copy they run in.
+rx_editable_install = re.compile(r'(?:^|\s)(?:-e|--editable)|\bsetup\.py\s+develop\b')
 
 
 def parse_test_result(output, parser='unittest'):
     if output is None:
         return None
-    if parser == 'unittest':
-        m = re.search(r'Ran (\d+) test', output)
-        if not m:
-            return None
-        num_tests = int(m.group(1))
-        m = re.search(r'FAILED \(([^\)]*)\)', output)
-        num_fails = 0
-        if m:
-            fail_msg = m.group(1)
-            # There are two kinds of error: failures and errors.
-            m = re.search(r'failures?=(\d+)', fail_msg)
-            num_fails += int(m.group(1)) if m else 0
-            m = re.search(r'errors?=(\d+)', fail_msg)
-            num_fails += int(m.group(1)) if m else 0
-        num_passes = num_tests - num_fails
-        state = 'success' if num_fails == 0 else 'failure'
-        return TestResult(state, num_tests, num_passes, num_fails)
-    elif parser == 'pytest':
-        m = re.search(r'==== (' +
-                      r'((?P<fails>\d+) failed)?' +
-                      r'(, )?' +
-                      r'((?P<passes>\d+) passed)?' +
-                      r') in ([\d.])+ seconds? ====', output)
-        if not m:
-            return None
-        num_fails = int(m.group('fails')) if m.group('fails') else 0
-        num_passes = int(m.group('passes')) if m.group('passes') else 0
-        num_tests = num_fails + num_passes
-        state = 'success' if num_fails == 0 else 'failure'
-        return TestResult(state, num_tests, num_passes, num_fails)
-    else:
-        raise ValueError('Invalid test result parser type.')
+    result_parser = create_parser(parser)
+    result_parser.feed(output)
+    result_parser.close()
+    return result_parser.get_result()
 
 def summarize_result(test_result) -> (str, str):
     '''
@@ -60,15 +66,45 @@ def summarize_result(test_result) -> (str, str):
     '''
     if test_result is None:
         return 'Ough!', 'No test results.'
-    success_ratio = test_result.num_passes / test_result.num_tests
     if test_result.num_fails == 0:
         return 'Success!', 'All {} tests OK.'.format(test_result.num_tests)
+    success_ratio = test_result.num_passes / test_result.num_tests
     return 'Failed!', '{0:.1f}% ({1.num_passes} / {1.num_tests}) passed' \
            .format(success_ratio * 100, test_result)
 
-@contextlib.contextmanager
-def noop_context():
-    yield
+class TailBuffer:
+    '''
+    Keeps only the last max_size characters of the appended text.
+    '''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._chunks = deque()
+        self._size = 0
+
+    def append(self, text):
+        if not text:
+            return
+        self._chunks.append(text)
+        self._size += len(text)
+        while self._size - len(self._chunks[0]) >= self.max_size:
+            self._size -= len(self._chunks.popleft())
+
+    def getvalue(self):
+        return ''.join(self._chunks)[-self.max_size:]
+
+class noop_context:
+    '''
+    The default runner context, which provides no extra environment variables.
+    Runner contexts are async context managers returning a dict of environment
+    variables for the test commands (e.g., connection info of test servers).
+    '''
+
+    async def __aenter__(self):
+        return {}
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        pass
 
 
 class TestReporterBase:
@@ -76,13 +112,17 @@ class TestReporterBase:
     context = 'ci/testion/test'
     test_type = 'test'
     runner_ctxmgr = noop_context
+    # Whether multiple refs may be tested at the same time ("parallel" option).
+    parallel_safe = True
 
-    def __init__(self, config, report, data):
+    def __init__(self, config, report, data, report_key=None):
 
         self.loop = asyncio.get_event_loop()
 
         self.config = config
         self.report = report
+        self.report_key = report_key
+        self.repo_name = data['repository']['full_name']
 
         self.gh_user = os.environ['GH_USERNAME']
         self.gh_token = os.environ['GH_TOKEN']
@@ -99,71 +139,207 @@ class TestReporterBase:
         log_fname = "{}-{}-{}.txt".format(self.test_type, test_time, test_id)
 
         # Set paths to store logs
-        if 'log_path' in config:
+        if config['log'].get('local_path'):
             log_path = Path(config['log']['local_path']) / test_date
         else:
             log_path = here.parent.parent / 'logs' / test_date
         log_path.mkdir(parents=True, exist_ok=True)
         self.log_file = str(log_path / log_fname)
         if config['log']['s3_bucket']:
-            self.s3_dest  = 's3://{}/{}/{}/{}/{}' \
-                            .format(config['log']['s3_bucket'], test_date,
-                                    self.target_user, self.target_repo, log_fname)
-            self.log_link = 'https://{}.s3.amazonaws.com/{}/{}/{}/{}' \
-                            .format(config['log']['s3_bucket'], test_date,
-                                    self.target_user, self.target_repo, log_fname)
+            self.s3_bucket = config['log']['s3_bucket']
+            self.s3_key = '{}/{}/{}/{}'.format(test_date, self.target_user,
+                                               self.target_repo, log_fname)
+            self.s3_dest = 's3://{}/{}'.format(self.s3_bucket, self.s3_key)
+            if os.environ.get('TESTION_S3_ENDPOINT'):
+                self.log_link = '{}/{}/{}'.format(
+                    os.environ['TESTION_S3_ENDPOINT'].rstrip('/'), self.s3_bucket, self.s3_key)
+            else:
+                self.log_link = 'https://{}.s3.amazonaws.com/{}' \
+                                .format(self.s3_bucket, self.s3_key)
         else:
-            self.s3_dest = None
+            self.s3_bucket = self.s3_key = self.s3_dest = None
             self.log_link = '#'
 
         # Set up the file logger only used for this test run.
         # (Its output will be propagated to the root logger as well, though.)
-        self.logger = logging.getLogger('testion.TestRun.{}'.format(test_id))
-        self.logfile_handler = logging.FileHandler(self.log_file)
+        # It is not registered to the logging manager, which would keep it
+        # forever, and the log file is opened only when written.
+        self.logger = logging.Logger('testion.TestRun.{}'.format(test_id))
+        self.logger.parent = logging.getLogger('testion.TestRun')
+        self.logfile_handler = logging.FileHandler(self.log_file, delay=True)
         self.logfile_handler.setLevel(logging.DEBUG)
         self.logger.addHandler(self.logfile_handler)
 
         # Github & repo objects
-        self.remote_gh   = github3.login(self.gh_user, self.gh_token)
-        self.remote_repo = self.remote_gh.repository(self.target_user, self.target_repo)
-
-    async def run_command(self, cmd, cwd=None, venv=None, env=None, verbose=False):
+        # (The repository object is fetched lazily to avoid blocking.)
+        self.github = get_github_client(self.gh_user, self.gh_token)
+        self.remote_gh = self.github.gh
+        self.remote_repo = None
+
+        # The URL to stream the log while running, set when the job starts.
+        self.live_log_url = None
+
+        # The wall-clock seconds spent in each stage of the run.
+        self.stage_timings = odict()
+        # The IDs of the tests passed on retry, by the tested refs.
+        self.flaky_tests = {}
+
+    async def get_remote_repo(self):
+        if self.remote_repo is None:
+            self.remote_repo = await self.github.repository(self.target_user,
+                                                            self.target_repo)
+        return self.remote_repo
+
+    @contextlib.contextmanager
+    def timed_stage(self, name, timings=None):
+        '''
+        Measure the time spent in the block as the given stage.
+        '''
+        timings = self.stage_timings if timings is None else timings
+        begin = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - begin
+            timings[name] = timings.get(name, 0.0) + elapsed
+            metrics.stage_duration.observe(elapsed, stage=name)
+
+    async def run_command(self, cmd, cwd=None, venv=None, env=None, verbose=False,
+                          tail_size=OUTPUT_TAIL_SIZE, parser=None, check=False):
+        '''
+        Run the given shell command and return the last tail_size characters
+        of its output.  If verbose is set, the whole output is streamed into
+        the log as it is produced, without being kept in memory.
+        If parser is given, the output is fed to it as it is produced, too.
+        If check is set, CommandError is raised when the command fails.
+        '''
         composed_env = {k: v for k, v in os.environ.items() if k != 'PYTHONHOME'}
         if env:
             composed_env.update(env)
         if venv:
+            # Let pip reuse the wheels and downloads of other test runs.
+            for k, v in get_wheelhouse().get_env().items():
+                composed_env.setdefault(k, v)
             composed_env['VIRTUAL_ENV'] = venv
             composed_env['PATH'] = '{}:{}'.format(Path(venv) / 'bin', composed_env['PATH'])
+        begin = time.monotonic()
         p = await asyncio.create_subprocess_shell(
             cmd,
             env=composed_env,
             cwd=cwd,
             stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT  # stderr is merged with stdout
+            stderr=asyncio.subprocess.STDOUT,  # stderr is merged with stdout
+            start_new_session=True,
         )
-        stdout, _ = await p.communicate()
-        if stdout is not None:
-            stdout = stdout.decode().strip()
         if verbose:
             self.logger.info('>>> {}'.format(cmd))
-            printed_stdout = stdout + ('' if stdout is not None and stdout.endswith('\n') else '\n')
-            self.logger.info('---\n{}---'.format(printed_stdout))
-        return stdout
-
-    async def _mark_status(self, state, test_result=None, msg=''):
-        target_url = None
+            self.logger.info('---')
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        tail = TailBuffer(tail_size)
+        partial_line = ''
+        try:
+            while True:
+                chunk = await p.stdout.read(OUTPUT_CHUNK_SIZE)
+                text = decoder.decode(chunk, final=not chunk)
+                tail.append(text)
+                if parser is not None:
+                    parser.feed(text)
+                if verbose:
+                    # Log only complete lines to keep the log file readable.
+                    lines, sep, partial_line = (partial_line + text).rpartition('\n')
+                    if sep:
+                        self.logger.info(lines)
+                    # Flush overlong lines (e.g., progress bars redrawn
+                    # with '\r') instead of buffering them indefinitely.
+                    if len(partial_line) >= OUTPUT_CHUNK_SIZE:
+                        self.logger.info(partial_line)
+                        partial_line = ''
+                if not chunk:
+                    break
+            await p.wait()
+        except asyncio.CancelledError:
+            # Do not leave the process running when the job is cancelled.
+            if p.returncode is None:
+                with contextlib.suppress(ProcessLookupError):
+                    os.killpg(p.pid, signal.SIGKILL)
+                await p.wait()
+            raise
+        finally:
+            metrics.command_duration.observe(time.monotonic() - begin)
+        if parser is not None:
+            parser.close()
+        if verbose:
+            if partial_line:
+                self.logger.info(partial_line)
+            self.logger.info('---')
+        if check and p.returncode != 0:
+            raise CommandError(cmd, p.returncode)
+        return tail.getvalue().strip()
+
+    async def _mark_status(self, state, test_result=None, msg='', target_url=None):
         if state == 'pending':
             desc = msg
+            target_url = target_url or self.live_log_url
         elif state in ('error', 'success', 'failure'):
-            target_url = self.log_link
+            if target_url in (None, '#'):
+                # Without S3, keep linking the log served by the server.
+                target_url = self.log_link if self.log_link != '#' \
+                             else (self.live_log_url or self.log_link)
             if test_result is not None:
                 assert test_result.state == state
-            _, desc = summarize_result(test_result)
+            if msg:
+                desc = msg
+            else:
+                _, desc = summarize_result(test_result)
         else:
             self.logger.error("Invalid status state: {}".format(state))
             return
         await self.mark_status(state, desc, target_url)
 
+    def close(self):
+        '''
+        Release the resources of this reporter, such as the log file.
+        It is safe to call this multiple times.
+        '''
+        self.logger.removeHandler(self.logfile_handler)
+        self.logfile_handler.close()
+
+    async def report_progress(self, parsers, fast_fail=False):
+        '''
+        Periodically report the live counts of the test results
+        while the test command(s) are running.
+        In the fast-fail mode, the failure status is reported as soon as
+        the first failure is parsed, and no further progress is reported.
+        '''
+        last_counts = (0, 0)
+        last_reported = self.loop.time()
+        while True:
+            await asyncio.sleep(FAST_FAIL_CHECK_INTERVAL if fast_fail else PROGRESS_INTERVAL)
+            counts = (sum(parser.num_passes for parser in parsers),
+                      sum(parser.num_fails for parser in parsers))
+            if fast_fail and counts[1] > 0:
+                self.logger.info('Reporting the failure early; the tests are still running.')
+                await self._mark_status('failure', msg='{1} failed, {0} passed so far; '
+                                        'still running the other tests...'.format(*counts),
+                                        target_url=self.live_log_url)
+                return
+            if counts == last_counts or \
+                    self.loop.time() - last_reported < PROGRESS_INTERVAL:
+                continue
+            last_counts = counts
+            last_reported = self.loop.time()
+            await self._mark_status('pending', msg='Running tests... '
+                                    '({} passed, {} failed so far)'.format(*counts))
+
+    def log_slowest_tests(self, test_cases, limit=10):
+        if not any(case.duration > 0 for case in test_cases):
+            return
+        slowest = sorted(test_cases, key=lambda case: case.duration, reverse=True)[:limit]
+        self.logger.info('Slowest {} tests:\n'.format(len(slowest)) +
+                         '\n'.join(' - {:.3f}s {} ({})'.format(case.duration, case.test_id,
+                                                              case.outcome)
+                                    for case in slowest))
+
     async def mark_status(self, state, desc, target_url):
         '''
         Report the progress of the currently running test suite.
@@ -174,6 +350,13 @@ class TestReporterBase:
         '''
         pass
 
+    async def flush_status(self):
+        '''
+        Wait until the last reported status is delivered,
+        if your reporter sends status updates in the background.
+        '''
+        pass
+
     def add_result(self, case_name, ref, test_result):
         '''
         Store the given test result (may be None) in the format(s) you want.
@@ -187,78 +370,454 @@ class TestReporterBase:
         '''
         pass
 
+    async def prepare_venv(self, wcdir, venvdir, env, python_version):
+        '''
+        Create a virtualenv for the tests, reusing a cached one if possible.
+        '''
+        venv_key = None
+        venv_cached = False
+        if self.report.get('venv_cache', True):
+            venv_key = compute_venv_key(python_version,
+                                        self.report.get('envs'),
+                                        self.report.get('install_cmd'),
+                                        wcdir)
+            venv_cached = await self.loop.run_in_executor(
+                None, get_venv_cache().restore, venv_key, venvdir)
+            self.logger.info('Virtualenv cache {}: {}'.format(
+                             'hit' if venv_cached else 'miss', venv_key[:12]))
+        wheelhouse_lock = get_wheelhouse().lock()
+        await wheelhouse_lock.acquire_async(self.loop, shared=True)
+        try:
+            if not venv_cached:
+                with self.timed_stage('venv_create'):
+                    await self.run_command('python -m venv {}'.format(venvdir),
+                                           env=env, check=True)
+                    await self.run_command('pip install -U pip wheel setuptools',
+                                           venv=venvdir, env=env, check=True)
+                    await self.run_command('pip install pytest nose',
+                                           venv=venvdir, env=env, check=True)
+
+            # Run install_cmd if set.
+            # (We run it even for cached virtualenvs because it may install
+            # the checked-out project itself, while the dependencies are
+            # already satisfied.)
+            if 'install_cmd' in self.report:
+                with self.timed_stage('install'):
+                    await self.run_command(self.report['install_cmd'],
+                                           venv=venvdir, env=env, cwd=wcdir,
+                                           verbose=True, check=True)
+        except CommandError as e:
+            # Let the tests run and report the failure, but never cache
+            # a virtualenv that may be broken (e.g., by a network error).
+            self.logger.error('Cannot prepare the virtualenv: {}'.format(e))
+            venv_key = None
+        finally:
+            wheelhouse_lock.release()
+        await self.loop.run_in_executor(None, get_wheelhouse().collect)
+
+        if venv_key is not None and not venv_cached:
+            await self.loop.run_in_executor(
+                None, get_venv_cache().store, venv_key, venvdir)
+
+    def pytest_plugin_env(self, env=None):
+        '''
+        Returns the environment variables to load testion's pytest plugin
+        in the test virtualenv.  The plugin is enabled with PYTEST_ADDOPTS
+        instead of the command line, which may be a compound shell command
+        (e.g., "cd tests && pytest").
+        '''
+        composed_env = odict(env or {})
+        python_path = composed_env.get('PYTHONPATH', os.environ.get('PYTHONPATH'))
+        composed_env['PYTHONPATH'] = str(plugins_path) if not python_path \
+                                     else '{}:{}'.format(plugins_path, python_path)
+        addopts = composed_env.get('PYTEST_ADDOPTS', os.environ.get('PYTEST_ADDOPTS'))
+        composed_env['PYTEST_ADDOPTS'] = '-p testion_pytest' if not addopts \
+                                         else '-p testion_pytest {}'.format(addopts)
+        return composed_env
+
+    async def run_tests(self, case_idx, wcdir, venvdir, env, selected=None):
+        '''
+        Run test_cmd, split into the shards if the "shards" option is set,
+        and return the (merged) test result and per-test results.
+        If selected is given, only the listed test files are run.
+        '''
+        artifact_prefix = '{}-{}'.format(self.log_file[:-4], case_idx)
+        is_pytest = self.report['parser'] in ('pytest', 'junit')
+        record_impact = is_pytest and 'impact' in self.report and selected is None
+        num_shards = self.report.get('shards', 1)
+        groups = [selected]
+        if num_shards > 1:
+            if is_pytest:
+                groups = await self.split_tests(num_shards, wcdir, venvdir, env,
+                                                files=selected) or groups
+            else:
+                self.logger.warning('Sharding is supported only for pytest; '
+                                    'running the whole suite at once.')
+        order = self.get_failed_first_order() if is_pytest else []
+        use_plugin = record_impact or bool(order) or groups != [None]
+        if order:
+            order_file = artifact_prefix + '.order.txt'
+            with open(order_file, 'w') as f:
+                f.write('\n'.join(order) + '\n')
+
+        parsers = []
+        commands = []
+        for group_idx, files in enumerate(groups):
+            prefix = artifact_prefix if len(groups) == 1 \
+                     else '{}-s{}'.format(artifact_prefix, group_idx)
+            parser = create_parser(self.report['parser'], prefix)
+            test_cmd = self.report['test_cmd']
+            cmd_env = env
+            if use_plugin:
+                cmd_env = self.pytest_plugin_env(env)
+            if files is not None:
+                select_file = prefix + '.select.txt'
+                with open(select_file, 'w') as f:
+                    f.write('\n'.join(files) + '\n')
+                cmd_env['TESTION_SELECT_FILE'] = select_file
+            if order:
+                cmd_env['TESTION_ORDER_FILE'] = order_file
+            if record_impact:
+                cmd_env['TESTION_IMPACT_MAP'] = prefix + '.impact.json'
+            parsers.append(parser)
+            commands.append((parser.prepare_command(test_cmd), cmd_env))
+        if len(groups) > 1:
+            self.logger.info('Running tests in {} shards'.format(len(groups)))
+
+        progress_task = self.loop.create_task(
+            self.report_progress(parsers, self.report.get('fast_fail', False)))
+        try:
+            await asyncio.gather(*(self.run_command(cmd, venv=venvdir, env=cmd_env,
+                                                    cwd=wcdir, verbose=True,
+                                                    parser=parser)
+                                   for (cmd, cmd_env), parser in zip(commands, parsers)),
+                                 loop=self.loop)
+        finally:
+            progress_task.cancel()
+        if record_impact:
+            self.record_impact_map([cmd_env['TESTION_IMPACT_MAP'] for _, cmd_env in commands])
+        test_result = merge_test_results([parser.get_result() for parser in parsers])
+        test_cases = [case for parser in parsers for case in parser.test_cases]
+        return test_result, test_cases
+
+    async def retry_failed_tests(self, case_idx, wcdir, venvdir, env, test_result, test_cases):
+        '''
+        Rerun only the failed tests up to "retry_failed" times, and mark the
+        ones passing on a retry as flaky.  Returns the updated test result and
+        test cases with the list of the flaky test IDs.
+        '''
+        if self.report['parser'] not in ('pytest', 'junit'):
+            self.logger.warning('Retrying failed tests is supported only for pytest.')
+            return test_result, test_cases, []
+        failed = [case.test_id for case in test_cases if case.outcome in ('failed', 'error')]
+        if not failed:
+            self.logger.warning('Cannot retry failed tests without their node IDs.')
+            return test_result, test_cases, []
+        flaky = []
+        for attempt in range(self.report['retry_failed']):
+            self.logger.info('Retrying {} failed tests (attempt {})...'
+                             .format(len(failed), attempt + 1))
+            prefix = '{}-{}-r{}'.format(self.log_file[:-4], case_idx, attempt)
+            select_file = prefix + '.select.txt'
+            with open(select_file, 'w') as f:
+                f.write('\n'.join(failed) + '\n')
+            retry_env = self.pytest_plugin_env(env)
+            retry_env['TESTION_SELECT_FILE'] = select_file
+            # List the failures in the short test summary even without "-v",
+            # as the passed tests are not listed then.
+            retry_env['PYTEST_ADDOPTS'] += ' -rfE'
+            parser = create_parser(self.report['parser'], prefix)
+            test_cmd = parser.prepare_command(self.report['test_cmd'])
+            await self.run_command(test_cmd, venv=venvdir, env=retry_env, cwd=wcdir,
+                                   verbose=True, parser=parser)
+            result = parser.get_result()
+            failed_again = {case.test_id for case in parser.test_cases
+                            if case.outcome in ('failed', 'error')}
+            if result is None or len(failed_again.intersection(failed)) < result.num_fails:
+                self.logger.warning('Cannot tell which tests failed again in the retry.')
+                continue
+            flaky.extend(test_id for test_id in failed if test_id not in failed_again)
+            failed = [test_id for test_id in failed if test_id in failed_again]
+            if not failed:
+                break
+        if not flaky:
+            return test_result, test_cases, []
+        self.logger.warning('Flaky tests (passed on retry):\n' +
+                            '\n'.join(' - {}'.format(test_id) for test_id in flaky))
+        flaky_ids = set(flaky)
+        test_cases = [case._replace(outcome='flaky') if case.test_id in flaky_ids else case
+                      for case in test_cases]
+        num_fails = max(test_result.num_fails - len(flaky), 0)
+        test_result = TestResult('success' if num_fails == 0 else 'failure',
+                                 test_result.num_tests,
+                                 test_result.num_tests - num_fails, num_fails)
+        return test_result, test_cases, flaky
+
+    def get_failed_first_order(self):
+        '''
+        Returns the IDs of the recently failed tests to run first
+        if the "failed_first" option is set.
+        '''
+        history = get_history()
+        if not self.report.get('failed_first', False) or history is None:
+            return []
+        order = history.get_failed_first_order(self.repo_name, self.report_key)
+        if order:
+            self.logger.info('Running {} recently failed tests first.'.format(len(order)))
+        return order
+
+    async def split_tests(self, num_shards, wcdir, venvdir, env, files=None):
+        '''
+        Collect the test files (unless given) and split them into shards
+        balanced by their recorded durations.
+        '''
+        if files is None:
+            output = await self.run_command(self.report['test_cmd'] + ' --collect-only -q',
+                                            venv=venvdir, env=env, cwd=wcdir,
+                                            tail_size=COLLECT_OUTPUT_SIZE)
+            files = parse_collected_files(output)
+        if len(files) < 2:
+            return None
+        durations = get_duration_store().get(self.repo_name, self.report_key)
+        return split_into_shards(files, durations, num_shards)
+
+    def select_impacted_tests(self, repo, commit):
+        '''
+        Returns the list of the test files affected by the pushed changes
+        if the "impact" option is set, or None to run the full test suite.
+        '''
+        impact = self.report.get('impact')
+        if not impact or self.report['branches'] != '!HEAD' \
+                or str(commit.id) != self.data.get('after'):
+            return None
+        if self.report['parser'] not in ('pytest', 'junit'):
+            self.logger.warning('Impact-based test selection is supported only for pytest.')
+            return None
+        if self.data.get('ref') == 'refs/heads/{}'.format(
+                self.data['repository'].get('default_branch')):
+            self.logger.info('Running the full test suite on the default branch.')
+            return None
+        store = get_impact_store()
+        last_full_run = store.get_last_full_run(self.repo_name, self.report_key)
+        if last_full_run is None or \
+                time.time() - last_full_run > impact.get('full_run_interval', 86400):
+            self.logger.info('Running the full test suite to refresh the impact map.')
+            return None
+        changed_files = get_changed_files(repo, self.data.get('before'), str(commit.id))
+        if changed_files is None:
+            self.logger.info('Running the full test suite as the base commit is unknown.')
+            return None
+        selected = select_tests(changed_files, store.get_map(self.repo_name, self.report_key),
+                                impact.get('rules'), impact.get('ignore', ()))
+        if selected is None:
+            self.logger.info('Running the full test suite as some changed files '
+                             'are not in the impact map.')
+            return None
+        self.logger.info('Selected tests affected by {} changed files:\n'
+                         .format(len(changed_files)) +
+                         '\n'.join(' - {}'.format(path) for path in selected))
+        return selected
+
+    def record_impact_map(self, paths):
+        impact_map = {}
+        for path in paths:
+            try:
+                with open(path) as f:
+                    for source, test_files in json.load(f).items():
+                        impact_map.setdefault(source, set()).update(test_files)
+            except (OSError, ValueError):
+                self.logger.warning('Could not read the impact map from {} '
+                                    '(is coverage installed?)'.format(path))
+                return
+        get_impact_store().update(self.repo_name, self.report_key, impact_map)
+
+    async def run_case(self, case_idx, ref, repo, wcdir, venvdir, env,
+                       result_key, cached_result=None):
+        '''
+        Check out the ref in the given working copy and run the tests there.
+        Returns a tuple of the case name, the test result (may be None),
+        and the link to the log containing the result.
+        '''
+        co_strategy = pygit2.GIT_CHECKOUT_FORCE \
+                      | pygit2.GIT_CHECKOUT_REMOVE_UNTRACKED
+        commit = repo.revparse_single(ref).peel(pygit2.Commit)
+        repo.checkout_tree(commit.tree, strategy=co_strategy)
+        repo.set_head(commit.id)
+        msg = 'Checked out to {}'.format(str(commit.id)[:7])
+        if repo.lookup_branch(ref) is not None or \
+                repo.lookup_branch(ref, pygit2.GIT_BRANCH_REMOTE) is not None:
+            case_name = "branch '{}' ({})".format(ref, str(commit.id)[:7])
+            msg += " (branch '{}')".format(ref)
+        else:
+            case_name = "commit {}".format(str(commit.id)[:7])
+            msg += " (detached)"
+        self.logger.info(msg)
+
+        if cached_result is not None:
+            test_result, log_link = cached_result
+            self.logger.info('Reusing the result of the identical tree {} '
+                             'tested before: {}'
+                             .format(commit.tree.id, log_link))
+            return case_name, test_result, log_link
+
+        selected = self.select_impacted_tests(repo, commit)
+        if selected == []:
+            self.logger.info('No tests are affected by the changes.')
+            return case_name, TestResult('success', 0, 0, 0), self.log_link
+
+        started_at = time.time()
+        stages = odict(self.stage_timings)
+        async with type(self).runner_ctxmgr() as runner_env:
+            if runner_env:
+                env = odict(env or {})
+                env.update(runner_env)
+            self.logger.info('=== Test[{}] started at {} ===' \
+                             .format(case_idx, datetime.now()))
+            with self.timed_stage('tests', stages):
+                test_result, test_cases = await self.run_tests(case_idx, wcdir, venvdir,
+                                                               env, selected)
+            if self.report.get('retry_failed', 0) > 0 and test_result is not None \
+                    and test_result.num_fails > 0:
+                with self.timed_stage('retry', stages):
+                    test_result, test_cases, flaky = await self.retry_failed_tests(
+                        case_idx, wcdir, venvdir, env, test_result, test_cases)
+                if flaky:
+                    self.flaky_tests[ref] = flaky
+            self.logger.info('=== Test[{}] finished at {} ===' \
+                             .format(case_idx, datetime.now()))
+
+        self.log_slowest_tests(test_cases)
+        if test_cases:
+            get_duration_store().update(self.repo_name, self.report_key, test_cases)
+        history = get_history()
+        if history is not None:
+            history.add_run(self.repo_name, self.report_key, self.get_branch_name(repo, ref),
+                            str(commit.id), test_result, started_at, stages,
+                            self.log_link, test_cases)
+        # The results of partial runs and failures are not reused for
+        # identical trees.
+        if test_result is not None and test_result.state == 'success' \
+                and selected is None \
+                and self.report.get('result_cache', True):
+            get_result_cache().put(result_key, commit.tree.id,
+                                   test_result, self.log_link)
+        return case_name, test_result, self.log_link
+
+    def get_branch_name(self, repo, ref):
+        '''
+        Returns the name of the branch tested as the ref, or None for commits.
+        '''
+        if repo.lookup_branch(ref) is not None or \
+                repo.lookup_branch(ref, pygit2.GIT_BRANCH_REMOTE) is not None:
+            return ref
+        pushed_ref = self.data.get('ref') or ''
+        if ref == self.data.get('after') and pushed_ref.startswith('refs/heads/'):
+            return pushed_ref[len('refs/heads/'):]
+        return None
+
     async def run(self):
         await self._mark_status('pending', msg='Preparing tests...')
         self.logger.info("Start testing procedure at {} ...".format(datetime.now()))
 
-        with tempfile.TemporaryDirectory() as wcdir, tempfile.TemporaryDirectory() as venvdir:
-            await self._mark_status('pending', msg='Running tests...')
-
-            # Clone the repository.
-            creds = pygit2.UserPass(self.gh_user, self.gh_token)
-            callbacks = pygit2.RemoteCallbacks(credentials=creds)
-            repo_url = self.data['repository']['clone_url']
-            self.local_repo = pygit2.clone_repository(repo_url, wcdir,
-                                                      callbacks=callbacks)
-
-            # Create a virtualenv.
-            if 'envs' in self.report:
-                env = odict(e.split('=', 1) for e in self.report['envs'])
-            else:
-                env = None
-            await self.run_command('python -m venv {}'.format(venvdir), env=env)
-            await self.run_command('pip install -U pip wheel setuptools', venv=venvdir, env=env)
-            await self.run_command('pip install pytest nose', venv=venvdir, env=env)
+        # Clone the repository from the local mirror, which is fetched
+        # incrementally from the remote.
+        creds = pygit2.UserPass(self.gh_user, self.gh_token)
+        callbacks = pygit2.RemoteCallbacks(credentials=creds)
+        repo_url = self.data['repository']['clone_url']
+        mirror_lease = get_mirror_cache().lease(self.repo_name,
+                                                repo_url, callbacks, loop=self.loop)
 
-            # Run install_cmd if set.
-            if 'install_cmd' in self.report:
-                output = await self.run_command(self.report['install_cmd'],
-                                       venv=venvdir, env=env, cwd=wcdir,
-                                       verbose=True)
-
-            case_idx = -1
-            for case_idx, ref in enumerate(self.generate_target_refs()):
-
-                co_strategy = pygit2.GIT_CHECKOUT_FORCE \
-                              | pygit2.GIT_CHECKOUT_REMOVE_UNTRACKED
-                commit = self.local_repo.revparse_single(ref)
-                self.local_repo.checkout_tree(commit.tree, strategy=co_strategy)
-                msg = 'Checked out to {}'.format(self.local_repo.head.target.hex[:7])
-                if not self.local_repo.head_is_detached:
-                    self.branch = self.local_repo.head.shorthand
-                    case_name = "branch '{}' ({})".format(self.branch, commit.hex[:7])
-                    msg += " (branch '{}')".format(self.branch)
-                else:
-                    self.branch = None
-                    case_name = "commit {}".format(commit.hex[:7])
-                    msg += " (detached)"
-                self.logger.info(msg)
-
-                with type(self).runner_ctxmgr():
-                    self.logger.info('=== Test[{}] started at {} ===' \
-                                     .format(case_idx, datetime.now()))
-                    output = await self.run_command(self.report['test_cmd'],
-                                                    venv=venvdir, env=env,
-                                                    cwd=wcdir,
-                                                    verbose=True)
-                    self.logger.info('=== Test[{}] finished at {} ===' \
-                                     .format(case_idx, datetime.now()))
-
-                test_result = parse_test_result(output, self.report['parser'])
-                if test_result is not None:
-                    await self._mark_status(test_result.state, test_result)
+        fetch_begin = time.monotonic()
+        with tempfile.TemporaryDirectory() as wcdir, tempfile.TemporaryDirectory() as venvdir:
+            async with mirror_lease as mirror:
+                self.stage_timings['fetch'] = time.monotonic() - fetch_begin
+                metrics.stage_duration.observe(self.stage_timings['fetch'], stage='fetch')
+                await self._mark_status('pending', msg='Running tests...')
+
+                default_branch = self.data['repository'].get('default_branch')
+                with self.timed_stage('checkout'):
+                    self.local_repo = await self.loop.run_in_executor(
+                        None, mirror.create_worktree, wcdir, default_branch)
+
+                if 'envs' in self.report:
+                    env = odict(e.split('=', 1) for e in self.report['envs'])
                 else:
-                    await self._mark_status('error', None)
-                self.add_result(case_name, ref, test_result)
-
-            if case_idx == -1:
-                self.logger.info('No test commands executed.')
-                await self._mark_status('success', None)
-
-            self.local_repo = None
-            self.logger.info("Finished at {}\n".format(datetime.now()))
-            self.logger.removeHandler(self.logfile_handler)
-            await self.flush_results()
+                    env = None
+                python_version = await self.run_command(
+                    'python -c "import sys; print(sys.version)"', env=env)
+
+                # Skip the trees already tested with the same configuration.
+                target_refs = list(self.generate_target_refs())
+                result_keys = {}
+                cached_results = {}
+                for ref in target_refs:
+                    tree_id = self.local_repo.revparse_single(ref).peel(pygit2.Tree).id
+                    result_keys[ref] = compute_result_key(tree_id, self.report, python_version)
+                    if self.report.get('result_cache', True):
+                        cached = get_result_cache().get(result_keys[ref])
+                        if cached is not None:
+                            cached_results[ref] = cached
+
+                if len(cached_results) < len(target_refs):
+                    with self.timed_stage('venv'):
+                        await self.prepare_venv(wcdir, venvdir, env, python_version)
+
+                # Test the refs in separate worktrees concurrently if requested.
+                parallelism = self.report.get('parallel', 1) if self.parallel_safe else 1
+                if parallelism > 1 and \
+                        rx_editable_install.search(self.report.get('install_cmd', '')):
+                    # The shared virtualenv would import the code of the main
+                    # working copy instead of each worktree.
+                    self.logger.warning('Testing refs one by one as "install_cmd" '
+                                        'is an editable install.')
+                    parallelism = 1
+                case_sema = asyncio.Semaphore(max(parallelism, 1), loop=self.loop)
+
+                async def run_case_task(case_idx, ref):
+                    async with case_sema:
+                        if parallelism <= 1:
+                            return await self.run_case(case_idx, ref, self.local_repo,
+                                                       wcdir, venvdir, env,
+                                                       result_keys[ref],
+                                                       cached_results.get(ref))
+                        with tempfile.TemporaryDirectory() as case_wcdir:
+                            case_repo = await self.loop.run_in_executor(
+                                None, mirror.create_worktree, case_wcdir,
+                                default_branch, ref)
+                            return await self.run_case(case_idx, ref, case_repo,
+                                                       case_wcdir, venvdir, env,
+                                                       result_keys[ref],
+                                                       cached_results.get(ref))
+
+                case_idx = -1
+                case_tasks = [self.loop.create_task(run_case_task(case_idx, ref))
+                              for case_idx, ref in enumerate(target_refs)]
+                try:
+                    # Report the results in the order of refs.
+                    for case_idx, (ref, task) in enumerate(zip(target_refs, case_tasks)):
+                        case_name, test_result, log_link = await task
+                        if test_result is not None:
+                            _, desc = summarize_result(test_result)
+                            if ref in self.flaky_tests:
+                                desc += ' ({} flaky)'.format(len(self.flaky_tests[ref]))
+                            await self._mark_status(test_result.state, test_result,
+                                                    msg=desc, target_url=log_link)
+                        else:
+                            await self._mark_status('error', None)
+                        self.add_result(case_name, ref, test_result)
+                finally:
+                    for task in case_tasks:
+                        task.cancel()
+
+                if case_idx == -1:
+                    self.logger.info('No test commands executed.')
+                    await self._mark_status('success', None)
+
+                self.local_repo = None
+                self.logger.info("Finished at {}\n".format(datetime.now()))
+                self.logger.removeHandler(self.logfile_handler)
+                await self.flush_results()
+                await self.flush_status()
 
     def get_recently_updated_branches(self):
         """
@@ -267,24 +826,7 @@ class TestReporterBase:
         assert self.local_repo is not None
         # Since we have just cloned the repo recently (at the beginning of test),
         # we don't have to fetch again here.
-        branches = []
-        branch_heads = set()  # to skip identical (merged or local==remote) branches
-        all_branches = self.local_repo.listall_branches(pygit2.GIT_BRANCH_LOCAL |
-                                                        pygit2.GIT_BRANCH_REMOTE)
-        now = time.time()  # in UTC
-        for branch in all_branches:
-            if branch.endswith('/HEAD'):
-                continue
-            has_recent_commits = False
-            branch_head = self.local_repo.revparse_single(branch)
-            for commit in self.local_repo.walk(branch_head.hex, pygit2.GIT_SORT_TIME):
-                if commit.commit_time < now - 86400:
-                    break
-                else:
-                    has_recent_commits = True
-            if has_recent_commits and branch_head.hex not in branch_heads:
-                branches.append(branch)
-                branch_heads.add(branch_head.hex)
+        branches = find_recent_branches(self.local_repo, 86400)
         self.logger.info('Non-identical branches with new commits within last 24 hours:\n' +
                          '\n'.join(' - {}'.format(name) for name in branches))
         return branches
@@ -0,0 +1,62 @@
+'''
+Selection of the tests affected by the files changed in a push.
+'''
+
+from fnmatch import fnmatch
+import posixpath
+
+import pygit2
+
+TEST_FILE_PATTERNS = ('test_*.py', '*_test.py')
+
+ZERO_SHA = '0' * 40
+
+
+def get_changed_files(repo, before, after):
+    '''
+    Returns the set of paths changed between the two commits,
+    or None if the base commit is not available (e.g., a new branch).
+    '''
+    if not before or before == ZERO_SHA:
+        return None
+    try:
+        old_tree = repo.revparse_single(before).peel(pygit2.Tree)
+    except KeyError:
+        return None
+    new_tree = repo.revparse_single(after).peel(pygit2.Tree)
+    paths = set()
+    for delta in repo.diff(old_tree, new_tree).deltas:
+        paths.add(delta.old_file.path)
+        paths.add(delta.new_file.path)
+    return paths
+
+
+def select_tests(changed_files, impact_map, rules=None, ignore=()):
+    '''
+    Map the changed files to the test files (or directories) to run using
+    the path rules ({glob pattern: test path(s)}) and the recorded impact map.
+    Changed test files select themselves, and the files matching the ignore
+    patterns select nothing.
+
+    Returns the sorted list of the test paths, or None if any changed file
+    cannot be mapped so that the full test suite must be run.
+    '''
+    selected = set()
+    for path in changed_files:
+        if any(fnmatch(path, pattern) for pattern in ignore):
+            continue
+        matched = False
+        for pattern, tests in (rules or {}).items():
+            if fnmatch(path, pattern):
+                selected.update([tests] if isinstance(tests, str) else tests)
+                matched = True
+        if any(fnmatch(posixpath.basename(path), pattern)
+               for pattern in TEST_FILE_PATTERNS):
+            selected.add(path)
+            matched = True
+        if path in impact_map:
+            selected.update(impact_map[path])
+            matched = True
+        if not matched:
+            return None
+    return sorted(selected)
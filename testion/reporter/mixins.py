@@ -1,11 +1,16 @@
+import functools
 import json
 import os
 
-import github3
 import requests
 
+from .. import metrics
+from ..s3 import get_uploader as get_s3_uploader
 from .base import summarize_result
 
+# The timeout (in seconds) of posting the results to Slack.
+SLACK_TIMEOUT = 10
+
 
 class SlackReportMixin:
 
@@ -25,9 +30,17 @@ class SlackReportMixin:
                      .format(self.target_user, self.target_repo, ref)
         title, summary = summarize_result(test_result)
         desc = '`<{}|{}>`: {}'.format(gh_url, case_name.capitalize(), summary)
+        flaky = self.flaky_tests.get(ref)
+        if flaky:
+            desc += '\nFlaky (passed on retry): {}'.format(
+                ', '.join('`{}`'.format(test_id) for test_id in flaky[:10]))
+            if len(flaky) > 10:
+                desc += ' and {} more'.format(len(flaky) - 10)
 
         if test_result is None:
             color = 'danger'
+        elif test_result.num_tests == 0:
+            color = 'good'
         else:
             success_ratio = test_result.num_passes / test_result.num_tests
             if success_ratio > 0.999:
@@ -58,10 +71,16 @@ class SlackReportMixin:
                     'title': 'Empty result.',
                     'text': 'No tests have been executed.',
                 })
-            r = requests.post(self.slack_hook_url, data=json.dumps({
+            post = functools.partial(requests.post, self.slack_hook_url, data=json.dumps({
                 'text': text,
                 'attachments': self.slack_items,
-            }))
+            }), timeout=SLACK_TIMEOUT)
+            try:
+                # Do not block other jobs while waiting for Slack.
+                with metrics.external_call_duration.time(service='slack'):
+                    await self.loop.run_in_executor(None, post)
+            except requests.RequestException as e:
+                self.logger.warning('Cannot post the results to Slack: {!r}'.format(e))
             # ignore the request result
 
         self.slack_items.clear()
@@ -75,10 +94,6 @@ class GHIssueCommentMixin:
         super().__init__(*args, **kwargs)
         self.comment_items = []
         assert self.gh_issue_num is not None
-        if not hasattr(self, 'remote_gh') or self.remote_gh is None:
-            self.remote_gh = github3.login(user, token)
-            self.remote_repo = self.remote_gh.repository(self.target_user,
-                                                         self.target_repo)
 
     def add_result(self, case_name, ref, test_result):
         super().add_result(case_name, ref, test_result)
@@ -89,13 +104,14 @@ class GHIssueCommentMixin:
     async def flush_results(self):
         await super().flush_results()
 
-        if self.remote_repo:
+        remote_repo = await self.get_remote_repo()
+        if remote_repo:
             desc = self.test_type.upper() + ':\n' + '\n'.join(self.comment_items)
-            issue = self.remote_repo.issue(issue_num)
+            issue = await self.github.call(remote_repo.issue, self.gh_issue_num)
             if issue:  # When there is a corresponding issue
-                cmt = issue.create_comment(desc)
+                cmt = await self.github.call(issue.create_comment, desc)
                 if cmt:
-                    self.logger.info('Error comment posted on issue #{}'.format(issue_num))
+                    self.logger.info('Error comment posted on issue #{}'.format(self.gh_issue_num))
                 else:
                     self.logger.error('Error on posting comment')
 
@@ -104,13 +120,10 @@ class GHIssueCommentMixin:
 
 class S3LogUploadMixin:
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.aws_available = 'AWS_ACCESS_KEY_ID' in os.environ
-
     async def flush_results(self):
         await super().flush_results()
 
-        if self.aws_available and self.s3_dest:
-            cmd = "aws s3 cp {0} {1}".format(self.log_file, self.s3_dest)
-            await self.run_command(cmd, verbose=True)
+        uploader = get_s3_uploader()
+        if uploader is not None and self.s3_dest:
+            # Uploaded in the background; it waits only if the upload queue is full.
+            await uploader.submit(self.log_file, self.s3_bucket, self.s3_key)
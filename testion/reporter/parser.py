@@ -0,0 +1,300 @@
+from collections import namedtuple
+import json
+import re
+from xml.etree import ElementTree
+
+TestResult = namedtuple('TestResult', 'state num_tests num_passes num_fails')
+
+# Longer lines are truncated to their last MAX_LINE_LENGTH characters.
+MAX_LINE_LENGTH = 64 * 1024
+
+
+class TestCaseResult(namedtuple('TestCaseResult', 'classname name file outcome duration')):
+
+    @property
+    def test_id(self):
+        '''
+        The identifier which can be passed to the test runner to select
+        this test case: a pytest node ID if the source file is known,
+        otherwise a dotted unittest name.
+        '''
+        if self.file and self.file.endswith('.py'):
+            module = self.file[:-3].replace('/', '.')
+            parts = [self.file]
+            if self.classname.startswith(module + '.'):
+                parts.extend(self.classname[len(module) + 1:].split('.'))
+            parts.append(self.name)
+            return '::'.join(parts)
+        if self.classname:
+            return '{}.{}'.format(self.classname, self.name)
+        return self.name
+
+
+class TestResultParser:
+    '''
+    The base class of incremental test result parsers.
+
+    Parsers are fed with chunks of the test command output as they arrive
+    and process them line by line, so that the whole output is never kept
+    in memory.  num_passes and num_fails hold the running counts of tests
+    observed so far (if the test runner prints per-test progress), and
+    get_result() returns the final TestResult after close().
+
+    Parsers may store extra result files whose paths start with
+    artifact_prefix, and may provide per-test results as test_cases.
+    '''
+
+    def __init__(self, artifact_prefix=None):
+        self.artifact_prefix = artifact_prefix
+        self.test_cases = []
+        self.num_passes = 0
+        self.num_fails = 0
+        self._partial_line = ''
+
+    def prepare_command(self, cmd):
+        '''
+        Adjust the test command so that it produces what this parser needs.
+        '''
+        return cmd
+
+    def feed(self, text):
+        lines = (self._partial_line + text).split('\n')
+        # Do not buffer the output without newlines (e.g., progress bars
+        # redrawn with '\r') indefinitely.
+        self._partial_line = lines.pop()[-MAX_LINE_LENGTH:]
+        for line in lines:
+            self.feed_line(line.rstrip('\r'))
+
+    def close(self):
+        if self._partial_line:
+            self.feed_line(self._partial_line.rstrip('\r'))
+            self._partial_line = ''
+
+    def feed_line(self, line):
+        raise NotImplementedError
+
+    def get_result(self):
+        raise NotImplementedError
+
+
+class UnittestResultParser(TestResultParser):
+
+    rx_progress = re.compile(r' \.\.\. (?P<outcome>ok|FAIL|ERROR|skipped|expected failure|'
+                             r'unexpected success)')
+    rx_ran = re.compile(r'^Ran (\d+) tests? in ')
+    rx_failed = re.compile(r'^FAILED \(([^\)]*)\)')
+    rx_fail_count = re.compile(r'(?:failures|errors)=(\d+)')
+
+    def __init__(self, artifact_prefix=None):
+        super().__init__(artifact_prefix)
+        self._num_tests = None
+        self._num_final_fails = 0
+
+    def feed_line(self, line):
+        m = self.rx_progress.search(line)
+        if m:
+            if m.group('outcome') in ('FAIL', 'ERROR'):
+                self.num_fails += 1
+            else:
+                self.num_passes += 1
+            return
+        m = self.rx_ran.match(line)
+        if m:
+            self._num_tests = int(m.group(1))
+            self._num_final_fails = 0
+            return
+        m = self.rx_failed.match(line)
+        if m:
+            # There are two kinds of error: failures and errors.
+            self._num_final_fails = sum(int(n) for n in self.rx_fail_count.findall(m.group(1)))
+
+    def get_result(self):
+        if self._num_tests is None:
+            return None
+        num_fails = self._num_final_fails
+        num_passes = self._num_tests - num_fails
+        state = 'success' if num_fails == 0 else 'failure'
+        return TestResult(state, self._num_tests, num_passes, num_fails)
+
+
+class PytestResultParser(TestResultParser):
+
+    rx_progress = re.compile(r'^\S+\.py ([.FEsxX]+)\s*(?:\[\s*\d+%\])?$')
+    rx_verbose = re.compile(r'^(?P<nodeid>\S+::\S.*?) '
+                            r'(?P<outcome>PASSED|FAILED|ERROR|SKIPPED|XFAIL|XPASS)\b')
+    rx_short_summary = re.compile(r'^(?P<outcome>FAILED|ERROR) (?P<nodeid>\S+::\S+)')
+    rx_summary = re.compile(r'^=+ (?P<counts>.+) in [\d.]+ ?s(?:econds?)?(?: \([^)]*\))? =+$')
+    rx_count = re.compile(r'(\d+) (\w+)')
+
+    fail_outcomes = frozenset(['F', 'E', 'FAILED', 'ERROR',
+                               'failed', 'error', 'errors'])
+    pass_outcomes = frozenset(['.', 's', 'x', 'X', 'PASSED', 'SKIPPED', 'XFAIL', 'XPASS',
+                               'passed', 'skipped', 'xfailed', 'xpassed'])
+
+    verbose_outcomes = {'PASSED': 'passed', 'FAILED': 'failed', 'ERROR': 'error',
+                        'SKIPPED': 'skipped', 'XFAIL': 'xfailed', 'XPASS': 'xpassed'}
+
+    def __init__(self, artifact_prefix=None):
+        super().__init__(artifact_prefix)
+        self._final_counts = None
+        self._failed_ids = set()
+
+    def _add_test_case(self, nodeid, outcome):
+        '''
+        Record a test case from the verbose output or the short test summary.
+        Durations are not available from the console output.
+        '''
+        outcome = self.verbose_outcomes[outcome]
+        if outcome in self.fail_outcomes:
+            if nodeid in self._failed_ids:
+                return
+            self._failed_ids.add(nodeid)
+        path, *parts = nodeid.split('::')
+        classname = '.'.join([path[:-3].replace('/', '.')] + parts[:-1])
+        self.test_cases.append(TestCaseResult(classname, parts[-1], path, outcome, 0.0))
+
+    def _count(self, outcome, n=1):
+        if outcome in self.fail_outcomes:
+            self.num_fails += n
+        elif outcome in self.pass_outcomes:
+            self.num_passes += n
+
+    def feed_line(self, line):
+        m = self.rx_progress.match(line)
+        if m:
+            for outcome in m.group(1):
+                self._count(outcome)
+            return
+        m = self.rx_verbose.match(line)
+        if m:
+            self._count(m.group('outcome'))
+            self._add_test_case(m.group('nodeid'), m.group('outcome'))
+            return
+        m = self.rx_short_summary.match(line)
+        if m:
+            self._add_test_case(m.group('nodeid'), m.group('outcome'))
+            return
+        m = self.rx_summary.match(line)
+        if m:
+            counts = {}
+            for n, outcome in self.rx_count.findall(m.group('counts')):
+                counts[outcome] = counts.get(outcome, 0) + int(n)
+            self._final_counts = counts
+
+    def get_result(self):
+        if self._final_counts is None:
+            return None
+        num_fails = sum(n for outcome, n in self._final_counts.items()
+                        if outcome in self.fail_outcomes)
+        # Like unittest, we count skipped and expected failures as passes.
+        num_passes = sum(n for outcome, n in self._final_counts.items()
+                         if outcome in self.pass_outcomes)
+        num_tests = num_fails + num_passes
+        if num_tests == 0:
+            # e.g., "no tests ran" due to a wrong path or a collection problem
+            return None
+        state = 'success' if num_fails == 0 else 'failure'
+        return TestResult(state, num_tests, num_passes, num_fails)
+
+
+class JUnitResultParser(TestResultParser):
+    '''
+    Reads the results from the JUnit XML report written by the test command.
+    If the test command does not have the "{junit_xml}" placeholder for the
+    report path, pytest's --junitxml option is appended.
+
+    The console output is only used for live progress counts (assuming pytest),
+    and per-test results are saved as JSON lines next to the report.
+    '''
+
+    def __init__(self, artifact_prefix):
+        super().__init__(artifact_prefix)
+        self.xml_path = '{}.junit.xml'.format(artifact_prefix)
+        self.cases_path = '{}.tests.jsonl'.format(artifact_prefix)
+        self._progress = PytestResultParser()
+        self._result = None
+
+    def prepare_command(self, cmd):
+        if '{junit_xml}' in cmd:
+            return cmd.replace('{junit_xml}', self.xml_path)
+        # xunit1 includes the source file paths required to build test IDs.
+        return '{} --junitxml={} -o junit_family=xunit1'.format(cmd, self.xml_path)
+
+    def feed_line(self, line):
+        self._progress.feed_line(line)
+        self.num_passes = self._progress.num_passes
+        self.num_fails = self._progress.num_fails
+
+    def close(self):
+        super().close()
+        self._progress.close()
+        try:
+            self._parse()
+        except (OSError, ElementTree.ParseError):
+            self._result = None
+
+    def _parse(self):
+        num_passes = 0
+        num_fails = 0
+        test_cases = []
+        context = ElementTree.iterparse(self.xml_path, events=('end',))
+        for _, elem in context:
+            if elem.tag != 'testcase':
+                continue
+            outcome = 'passed'
+            for child in elem:
+                if child.tag in ('failure', 'error', 'skipped'):
+                    outcome = {'failure': 'failed'}.get(child.tag, child.tag)
+                    break
+            if outcome in ('failed', 'error'):
+                num_fails += 1
+            else:
+                num_passes += 1
+            test_cases.append(TestCaseResult(
+                elem.get('classname', ''), elem.get('name', ''), elem.get('file'),
+                outcome, float(elem.get('time') or 0)))
+            # Release the parsed subtree as we go.
+            elem.clear()
+        self.test_cases = test_cases
+        with open(self.cases_path, 'w') as f:
+            for case in test_cases:
+                f.write(json.dumps({
+                    'name': case.test_id,
+                    'outcome': case.outcome,
+                    'duration': case.duration,
+                }) + '\n')
+        num_tests = num_passes + num_fails
+        state = 'success' if num_fails == 0 else 'failure'
+        self._result = TestResult(state, num_tests, num_passes, num_fails)
+
+    def get_result(self):
+        return self._result
+
+
+def merge_test_results(results):
+    '''
+    Merge the results of test shards into one.
+    If any shard has no result, the merged result is None as well.
+    '''
+    if not results or any(result is None for result in results):
+        return None
+    num_tests = sum(result.num_tests for result in results)
+    num_passes = sum(result.num_passes for result in results)
+    num_fails = sum(result.num_fails for result in results)
+    state = 'success' if num_fails == 0 else 'failure'
+    return TestResult(state, num_tests, num_passes, num_fails)
+
+
+parser_map = {
+    'unittest': UnittestResultParser,
+    'pytest': PytestResultParser,
+    'junit': JUnitResultParser,
+}
+
+
+def create_parser(parser_type, artifact_prefix=None):
+    try:
+        parser_cls = parser_map[parser_type]
+    except KeyError:
+        raise ValueError('Invalid test result parser type.')
+    return parser_cls(artifact_prefix)
@@ -0,0 +1,46 @@
+import heapq
+
+
+def parse_collected_files(output):
+    '''
+    Extract the test files from the output of "pytest --collect-only -q",
+    keeping the collection order.
+    '''
+    files = []
+    seen = set()
+    for line in output.splitlines():
+        line = line.strip()
+        if '::' not in line:
+            continue
+        # Parametrized test IDs may contain spaces, but not the paths.
+        path = line.split('::', 1)[0]
+        if not path or ' ' in path:
+            continue
+        if path not in seen:
+            seen.add(path)
+            files.append(path)
+    return files
+
+
+def split_into_shards(files, durations, num_shards):
+    '''
+    Split the test files into num_shards groups with similar total durations,
+    assigning the longest files first to the least loaded group.
+    If there are no recorded durations, files are assigned round-robin.
+    '''
+    num_shards = max(1, min(num_shards, len(files)))
+    shards = [[] for _ in range(num_shards)]
+    known = [durations[f] for f in files if f in durations]
+    if not known:
+        for idx, path in enumerate(files):
+            shards[idx % num_shards].append(path)
+        return shards
+    # Assume the average duration for new test files.
+    default = sum(known) / len(known)
+    by_duration = sorted(files, key=lambda f: durations.get(f, default), reverse=True)
+    loads = [(0.0, idx) for idx in range(num_shards)]
+    for path in by_duration:
+        load, idx = heapq.heappop(loads)
+        shards[idx].append(path)
+        heapq.heappush(loads, (load + durations.get(path, default), idx))
+    return [shard for shard in shards if shard]
@@ -11,20 +11,16 @@ class UnitTestReporter(S3LogUploadMixin, SlackReportMixin, TestReporterBase):
         super().__init__(*args, **kwargs)
         self.sha       = self.data['after']
         self.short_sha = self.sha[:7]
+        self._status_waiter = None
 
     async def mark_status(self, state, desc, target_url):
-        if not self.remote_repo:
+        remote_repo = await self.get_remote_repo()
+        if not remote_repo:
             return
-        result = self.remote_repo.create_status(
-            sha=self.sha, state=state,
-            description=desc,
-            context=self.context,
-            target_url=target_url
-        )
-        if result:
-            msg = "Marked '{0}' status for commit {1}".format(state, self.short_sha)
-            self.logger.info(msg)
-        else:
-            msg = "Error on creating status for commit {}".format(self.short_sha)
-            self.logger.error(msg)
+        self._status_waiter = self.github.statuses.post(
+            remote_repo, self.sha, self.context, state, desc, target_url,
+            logger=self.logger)
 
+    async def flush_status(self):
+        if self._status_waiter is not None:
+            await self._status_waiter
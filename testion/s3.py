@@ -0,0 +1,298 @@
+'''
+An in-process uploader of test logs to S3 (or S3-compatible storages).
+
+Logs are gzip-compressed (served with ``Content-Encoding: gzip``) and
+uploaded in the background by a few worker tasks consuming a bounded queue,
+so that finishing a job does not wait for the upload.  Large logs are sent
+with the multipart upload API, and failed requests are retried with backoff.
+
+The following environment variables are used:
+
+ * ``AWS_ACCESS_KEY_ID``, ``AWS_SECRET_ACCESS_KEY`` and optionally
+   ``AWS_SESSION_TOKEN``: the credentials.
+ * ``AWS_DEFAULT_REGION``: the region of the bucket (default: us-east-1).
+ * ``TESTION_S3_ENDPOINT``: the endpoint URL of an S3-compatible storage
+   such as ``http://127.0.0.1:9000``, accessed with path-style URLs.
+'''
+
+import asyncio
+from datetime import datetime
+import hashlib
+import hmac
+import logging
+import os
+import tempfile
+from urllib.parse import quote
+from xml.etree import ElementTree
+import zlib
+
+import aiohttp
+
+from . import metrics
+
+# Logs larger than this (after compression) are uploaded in multiple parts.
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+# S3 requires at least 5 MiB for each part except the last one.
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+COMPRESS_CHUNK_SIZE = 1024 * 1024
+
+MAX_UPLOAD_QUEUE_SIZE = 64
+NUM_UPLOAD_WORKERS = 2
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1
+
+log = logging.getLogger('testion.s3')
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+
+def sign_request(method, host, path, query, headers, payload_hash,
+                 access_key, secret_key, region, now=None):
+    '''
+    Add the AWS Signature Version 4 authorization headers to the request
+    headers (a dict) and return it.  path must be URI-encoded already, and
+    query is a dict of the query parameters.
+    '''
+    now = now or datetime.utcnow()
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    date_stamp = now.strftime('%Y%m%d')
+    headers['Host'] = host
+    headers['x-amz-date'] = amz_date
+    headers['x-amz-content-sha256'] = payload_hash
+
+    canonical_headers = sorted((k.lower(), str(v).strip()) for k, v in headers.items())
+    signed_headers = ';'.join(k for k, _ in canonical_headers)
+    canonical_query = '&'.join('{}={}'.format(quote(k, safe='-_.~'), quote(v, safe='-_.~'))
+                               for k, v in sorted(query.items()))
+    canonical_request = '\n'.join([
+        method, path, canonical_query,
+        ''.join('{}:{}\n'.format(k, v) for k, v in canonical_headers),
+        signed_headers, payload_hash])
+    scope = '{}/{}/s3/aws4_request'.format(date_stamp, region)
+    string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                                _sha256(canonical_request.encode('utf-8'))])
+    key = _hmac(('AWS4' + secret_key).encode('utf-8'), date_stamp)
+    for part in (region, 's3', 'aws4_request'):
+        key = _hmac(key, part)
+    signature = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+    headers['Authorization'] = ('AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, '
+                                'Signature={}'.format(access_key, scope,
+                                                      signed_headers, signature))
+    return headers
+
+
+def compress_file(src_path, dest_file):
+    '''
+    Gzip-compress the file into the given (binary) file object chunk by chunk,
+    and return the compressed size.
+    '''
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    with open(src_path, 'rb') as src:
+        while True:
+            chunk = src.read(COMPRESS_CHUNK_SIZE)
+            if not chunk:
+                break
+            dest_file.write(compressor.compress(chunk))
+    dest_file.write(compressor.flush())
+    dest_file.flush()
+    return dest_file.tell()
+
+
+class S3Error(Exception):
+    pass
+
+
+class S3Uploader:
+
+    def __init__(self, access_key, secret_key, region='us-east-1', endpoint=None,
+                 session_token=None, loop=None):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.session_token = session_token
+        self.region = region
+        self.endpoint = endpoint.rstrip('/') if endpoint else None
+        self._loop = loop or asyncio.get_event_loop()
+        self._session = None
+        self._queue = asyncio.Queue(MAX_UPLOAD_QUEUE_SIZE, loop=self._loop)
+        self._workers = []
+
+    def _get_url(self, bucket, key):
+        '''
+        Returns (scheme, host, encoded path) of the object.
+        '''
+        encoded_key = quote(key, safe='-_.~/')
+        if self.endpoint:
+            scheme, _, host = self.endpoint.partition('://')
+            return scheme, host, '/{}/{}'.format(bucket, encoded_key)
+        return 'https', '{}.s3.amazonaws.com'.format(bucket), '/' + encoded_key
+
+    async def request(self, method, bucket, key, query=None, data=b'', headers=None):
+        '''
+        Send a signed request and return the response headers and body,
+        retrying on connection errors and server errors.
+        '''
+        if self._session is None:
+            self._session = aiohttp.ClientSession(loop=self._loop)
+        query = query or {}
+        scheme, host, path = self._get_url(bucket, key)
+        url = '{}://{}{}'.format(scheme, host, path)
+        if query:
+            url += '?' + '&'.join('{}={}'.format(k, quote(v, safe='-_.~'))
+                                  for k, v in sorted(query.items()))
+        payload_hash = _sha256(data)
+        for attempt in range(MAX_RETRIES):
+            req_headers = dict(headers or {})
+            if self.session_token:
+                req_headers['x-amz-security-token'] = self.session_token
+            sign_request(method, host, path, query, req_headers, payload_hash,
+                         self.access_key, self.secret_key, self.region)
+            try:
+                with metrics.external_call_duration.time(service='s3'):
+                    async with self._session.request(method, url, data=data,
+                                                     headers=req_headers) as resp:
+                        body = await resp.read()
+                        if resp.status < 300:
+                            return resp.headers, body
+                        if resp.status < 500:
+                            raise S3Error('{} {} failed: {} {}'.format(
+                                method, url, resp.status, body[:500]))
+                        error = '{} {}'.format(resp.status, body[:200])
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = repr(e)
+            if attempt + 1 < MAX_RETRIES:
+                delay = RETRY_BASE_DELAY * 2 ** attempt
+                log.warning('{} {} failed ({}); retrying in {} sec.'
+                            .format(method, url, error, delay))
+                await asyncio.sleep(delay, loop=self._loop)
+        raise S3Error('{} {} failed after {} attempts: {}'
+                      .format(method, url, MAX_RETRIES, error))
+
+    async def upload_file(self, path, bucket, key, content_type='text/plain; charset=utf-8'):
+        '''
+        Compress and upload the file, using multipart uploads for large ones.
+        '''
+        headers = {'Content-Type': content_type, 'Content-Encoding': 'gzip'}
+        with tempfile.TemporaryFile() as compressed:
+            size = await self._loop.run_in_executor(None, compress_file, path, compressed)
+            compressed.seek(0)
+            if size <= MULTIPART_THRESHOLD:
+                await self.request('PUT', bucket, key, data=compressed.read(),
+                                   headers=headers)
+            else:
+                await self._upload_multipart(compressed, bucket, key, headers)
+        log.info('Uploaded {} to s3://{}/{} ({} bytes compressed)'
+                 .format(path, bucket, key, size))
+
+    async def _upload_multipart(self, fileobj, bucket, key, headers):
+        _, body = await self.request('POST', bucket, key, query={'uploads': ''},
+                                     headers=headers)
+        upload_id = _find_xml_text(body, 'UploadId')
+        try:
+            etags = []
+            while True:
+                part = fileobj.read(MULTIPART_PART_SIZE)
+                if not part:
+                    break
+                part_number = len(etags) + 1
+                etag = await self._upload_part(bucket, key, upload_id, part_number, part)
+                etags.append(etag)
+            complete = ['<CompleteMultipartUpload>']
+            for part_number, etag in enumerate(etags, 1):
+                complete.append('<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>'
+                                .format(part_number, etag))
+            complete.append('</CompleteMultipartUpload>')
+            _, body = await self.request('POST', bucket, key, query={'uploadId': upload_id},
+                                         data=''.join(complete).encode('utf-8'))
+            # S3 may report errors of the completion with the 200 status.
+            if b'<Error>' in body:
+                raise S3Error('Completing the multipart upload failed: {}'.format(body[:500]))
+        except BaseException:
+            try:
+                await self.request('DELETE', bucket, key, query={'uploadId': upload_id})
+            except S3Error:
+                log.exception('Cannot abort the multipart upload {}'.format(upload_id))
+            raise
+
+    async def _upload_part(self, bucket, key, upload_id, part_number, data):
+        headers, _ = await self.request('PUT', bucket, key,
+                                        query={'partNumber': str(part_number),
+                                               'uploadId': upload_id},
+                                        data=data)
+        return headers['ETag']
+
+    async def submit(self, path, bucket, key):
+        '''
+        Enqueue the file to upload in the background.  It waits only if
+        the queue is full.
+        '''
+        if not self._workers:
+            self._workers = [asyncio.ensure_future(self._worker(), loop=self._loop)
+                             for _ in range(NUM_UPLOAD_WORKERS)]
+        await self._queue.put((path, bucket, key))
+
+    async def _worker(self):
+        while True:
+            path, bucket, key = await self._queue.get()
+            try:
+                await self.upload_file(path, bucket, key)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Cannot upload {} to s3://{}/{}'.format(path, bucket, key))
+            finally:
+                self._queue.task_done()
+
+    async def join(self):
+        '''
+        Wait until all queued uploads are finished.
+        '''
+        await self._queue.join()
+
+    async def close(self):
+        if self._workers:
+            await self.join()
+            for worker in self._workers:
+                worker.cancel()
+            await asyncio.wait(self._workers, loop=self._loop)
+            self._workers = []
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+
+def _find_xml_text(body, tag):
+    root = ElementTree.fromstring(body)
+    for elem in root.iter():
+        if elem.tag == tag or elem.tag.endswith('}' + tag):
+            return elem.text
+    raise S3Error('No {} in the response: {}'.format(tag, body[:500]))
+
+
+_uploader = None
+
+
+def get_uploader():
+    '''
+    Returns the shared uploader, or None if the credentials are not set.
+    '''
+    global _uploader
+    if _uploader is None and 'AWS_ACCESS_KEY_ID' in os.environ:
+        _uploader = S3Uploader(os.environ['AWS_ACCESS_KEY_ID'],
+                               os.environ.get('AWS_SECRET_ACCESS_KEY', ''),
+                               region=os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'),
+                               endpoint=os.environ.get('TESTION_S3_ENDPOINT'),
+                               session_token=os.environ.get('AWS_SESSION_TOKEN'))
+    return _uploader
+
+
+async def close_uploader():
+    global _uploader
+    if _uploader is not None:
+        await _uploader.close()
+        _uploader = None
@@ -0,0 +1,268 @@
+'''
+A pool of pre-warmed Xvfb + Selenium server pairs for functional tests.
+
+Each instance owns a unique X display number and port, and is leased by one
+test run at a time.  Instances are started once and reused across test runs,
+so that the JVM startup is paid only once, and are health-checked before
+every lease.  The connection info is passed to the tests as environment
+variables: ``DISPLAY``, ``TESTION_SELENIUM_PORT`` and ``TESTION_SELENIUM_URL``.
+
+The pool is configured with the following environment variables:
+
+ * ``TESTION_SELENIUM_JAR``: the path of the Selenium standalone server jar.
+ * ``TESTION_SELENIUM_POOL_SIZE``: the number of instances (default: 2).
+ * ``TESTION_SELENIUM_DISPLAY_BASE``: the first X display number to try
+   (default: 90).
+ * ``TESTION_SELENIUM_PORT_BASE``: the first port to try (default: 4444).
+'''
+
+import asyncio
+import contextlib
+import logging
+import os
+from pathlib import Path
+import signal
+import socket
+
+DEFAULT_SELENIUM_JAR = '/home/jpark/selenium-server-standalone-2.53.0.jar'
+
+# The time (in seconds) to wait until a new instance becomes ready.
+STARTUP_TIMEOUT = 60
+HEALTH_CHECK_TIMEOUT = 5
+
+log = logging.getLogger('testion.selenium')
+
+
+def _display_in_use(display):
+    return Path('/tmp/.X{}-lock'.format(display)).exists() or \
+           Path('/tmp/.X11-unix/X{}'.format(display)).exists()
+
+
+def _port_in_use(port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        try:
+            s.bind(('127.0.0.1', port))
+        except OSError:
+            return True
+    return False
+
+
+class SeleniumInstance:
+
+    def __init__(self, display, port, jar_path, loop):
+        self.display = display
+        self.port = port
+        self.jar_path = jar_path
+        self._loop = loop
+        self._xvfb = None
+        self._selenium = None
+
+    @property
+    def env(self):
+        return {
+            'DISPLAY': ':{}'.format(self.display),
+            'TESTION_SELENIUM_PORT': str(self.port),
+            'TESTION_SELENIUM_URL': 'http://127.0.0.1:{}/wd/hub'.format(self.port),
+        }
+
+    async def start(self):
+        '''
+        Start the processes and wait until the server becomes ready.
+        Returns False (with the processes stopped) if it fails.
+        '''
+        log.info('Starting Xvfb on :{} and Selenium server on port {}'
+                 .format(self.display, self.port))
+        try:
+            self._xvfb = await asyncio.create_subprocess_exec(
+                'Xvfb', ':{}'.format(self.display), '-screen', '0', '1440x900x16', '-ac',
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+                start_new_session=True, loop=self._loop)
+            env = dict(os.environ, DISPLAY=':{}'.format(self.display))
+            self._selenium = await asyncio.create_subprocess_exec(
+                'java', '-jar', self.jar_path, '-port', str(self.port), '-maxSession', '1',
+                env=env,
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+                start_new_session=True, loop=self._loop)
+        except OSError as e:
+            # e.g., Xvfb or java is not installed
+            log.error('Cannot start Xvfb and Selenium server on port {}: {!r}'
+                      .format(self.port, e))
+            await self.stop()
+            return False
+        deadline = self._loop.time() + STARTUP_TIMEOUT
+        while self._loop.time() < deadline:
+            if await self.is_healthy():
+                log.info('Selenium server on port {} is ready'.format(self.port))
+                return True
+            if not self._is_running():
+                break
+            await asyncio.sleep(0.5, loop=self._loop)
+        log.error('Selenium server on port {} did not become ready'.format(self.port))
+        await self.stop()
+        return False
+
+    def _is_running(self):
+        return all(p is not None and p.returncode is None
+                   for p in (self._xvfb, self._selenium))
+
+    async def is_healthy(self):
+        '''
+        Check that both processes are alive and the server responds to
+        the status API.
+        '''
+        if not self._is_running():
+            return False
+        if not Path('/tmp/.X11-unix/X{}'.format(self.display)).exists():
+            return False
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection('127.0.0.1', self.port, loop=self._loop),
+                HEALTH_CHECK_TIMEOUT, loop=self._loop)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        try:
+            writer.write('GET /wd/hub/status HTTP/1.0\r\nHost: 127.0.0.1:{}\r\n\r\n'
+                         .format(self.port).encode('ascii'))
+            status_line = await asyncio.wait_for(reader.readline(), HEALTH_CHECK_TIMEOUT,
+                                                 loop=self._loop)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        finally:
+            writer.close()
+        parts = status_line.split()
+        return len(parts) >= 2 and parts[1] == b'200'
+
+    async def stop(self):
+        for p in (self._selenium, self._xvfb):
+            if p is not None and p.returncode is None:
+                with contextlib.suppress(ProcessLookupError):
+                    os.killpg(p.pid, signal.SIGTERM)
+                try:
+                    await asyncio.wait_for(p.wait(), 10, loop=self._loop)
+                except asyncio.TimeoutError:
+                    with contextlib.suppress(ProcessLookupError):
+                        os.killpg(p.pid, signal.SIGKILL)
+                    await p.wait()
+        self._xvfb = self._selenium = None
+
+
+class SeleniumLease:
+    '''
+    An async context manager which leases an instance from the pool
+    and returns its connection info as a dict of environment variables.
+    '''
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._instance = None
+
+    async def __aenter__(self):
+        self._instance = await self._pool.acquire()
+        return self._instance.env
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        self._pool.release(self._instance)
+        self._instance = None
+
+
+class SeleniumPool:
+
+    def __init__(self, size, jar_path, display_base=90, port_base=4444, loop=None):
+        self.size = size
+        self.jar_path = jar_path
+        self.display_base = display_base
+        self.port_base = port_base
+        self._loop = loop or asyncio.get_event_loop()
+        self._instances = []
+        self._idle = asyncio.Queue(loop=self._loop)
+        self._warm_up_task = None
+
+    def _allocate(self):
+        '''
+        Pick the display number and port not used by other instances
+        or other processes on this host.
+        '''
+        displays = {instance.display for instance in self._instances}
+        ports = {instance.port for instance in self._instances}
+        display = self.display_base
+        while display in displays or _display_in_use(display):
+            display += 1
+        port = self.port_base
+        while port in ports or _port_in_use(port):
+            port += 1
+        return display, port
+
+    def warm_up(self):
+        '''
+        Start all instances in the background, only once.
+        '''
+        if self._warm_up_task is None:
+            self._warm_up_task = asyncio.ensure_future(self._warm_up(), loop=self._loop)
+        return self._warm_up_task
+
+    async def _warm_up(self):
+        for _ in range(self.size):
+            display, port = self._allocate()
+            instance = SeleniumInstance(display, port, self.jar_path, self._loop)
+            self._instances.append(instance)
+        results = await asyncio.gather(*(instance.start() for instance in self._instances),
+                                       loop=self._loop, return_exceptions=True)
+        # The ones failed to start are retried when leased.
+        for instance, result in zip(self._instances, results):
+            if isinstance(result, Exception):
+                log.error('Cannot start the Selenium server on port {}: {!r}'
+                          .format(instance.port, result))
+            self._idle.put_nowait(instance)
+
+    async def acquire(self):
+        await self.warm_up()
+        instance = await self._idle.get()
+        try:
+            if not await instance.is_healthy():
+                log.warning('Restarting the unhealthy Selenium server on port {}'
+                            .format(instance.port))
+                await instance.stop()
+                if not await instance.start():
+                    raise RuntimeError('Cannot start the Selenium server on port {}'
+                                       .format(instance.port))
+        except BaseException:
+            self._idle.put_nowait(instance)
+            raise
+        return instance
+
+    def release(self, instance):
+        self._idle.put_nowait(instance)
+
+    def lease(self):
+        return SeleniumLease(self)
+
+    async def close(self):
+        if self._warm_up_task is not None:
+            self._warm_up_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._warm_up_task
+        await asyncio.gather(*(instance.stop() for instance in self._instances),
+                             loop=self._loop)
+        self._instances.clear()
+        self._warm_up_task = None
+
+
+_selenium_pool = None
+
+
+def get_selenium_pool():
+    global _selenium_pool
+    if _selenium_pool is None:
+        _selenium_pool = SeleniumPool(
+            int(os.environ.get('TESTION_SELENIUM_POOL_SIZE', '2')),
+            os.environ.get('TESTION_SELENIUM_JAR', DEFAULT_SELENIUM_JAR),
+            int(os.environ.get('TESTION_SELENIUM_DISPLAY_BASE', '90')),
+            int(os.environ.get('TESTION_SELENIUM_PORT_BASE', '4444')))
+    return _selenium_pool
+
+
+async def close_selenium_pool():
+    global _selenium_pool
+    if _selenium_pool is not None:
+        await _selenium_pool.close()
+        _selenium_pool = None
@@ -1,8 +1,12 @@
 import argparse
 import asyncio
+from collections import defaultdict
+import functools
 import json
 import logging
+import os
 import signal
+import time
 import traceback
 from pathlib import Path
 
@@ -11,9 +15,15 @@ import coloredlogs
 import uvloop
 import yaml
 
+from . import livelog, metrics
+from .cache import get_cache_path
 from .exceptions import UnsupportedEventError
+from .history import close_history, get_history, open_history
+from .jobqueue import Job, JobQueue
 from .reporter.unittest import UnitTestReporter
 from .reporter.functest import SeleniumFunctionalTestReporter
+from .s3 import close_uploader as close_s3_uploader
+from .selenium_pool import close_selenium_pool, get_selenium_pool
 
 
 reporter_map = {
@@ -23,17 +33,112 @@ reporter_map = {
 
 here = Path(__file__).resolve().parent.parent
 
+# The interval (in seconds) to check new lines of the logs being streamed.
+LOG_POLL_INTERVAL = 1
+LOG_CHUNK_SIZE = 64 * 1024
 
-async def job_loop(loop, queue):
+
+async def run_job(job):
     log = logging.getLogger('testion.jobqueue')
+    log.info('Running a job for {}'.format(job.repo_name))
+    metrics.queue_wait.observe(max(time.time() - job.enqueued_at, 0))
+    metrics.active_workers.inc()
+    livelog.register(job.id, job.reporter.log_file)
+    job.reporter.live_log_url = livelog.get_live_log_url(job.id)
+    try:
+        await job.reporter.run()
+        metrics.jobs_total.inc(outcome='finished')
+    except asyncio.CancelledError:
+        if job.superseded_by is not None:
+            log.info('Cancelled a job for {} superseded by a newer push'
+                     .format(job.repo_name))
+            metrics.jobs_total.inc(outcome='superseded')
+            await mark_superseded(job)
+        else:
+            metrics.jobs_total.inc(outcome='cancelled')
+            raise
+    except Exception:
+        metrics.jobs_total.inc(outcome='error')
+        log.exception('Unexpected error while running a job for {}'
+                      .format(job.repo_name))
+    finally:
+        metrics.active_workers.dec()
+        livelog.finish(job.id)
+        job.reporter.close()
+
+
+def create_reporter(config, job):
+    repo_config = config[job.repo_name]
+    report = repo_config['reports'][job.report_key]
+    return reporter_map[report['cls']](repo_config, report, job.data,
+                                       report_key=job.report_key)
+
+
+async def mark_superseded(job):
+    new_sha = job.superseded_by.reporter.data['after']
+    await job.reporter._mark_status(
+        'error', msg='Superseded by a newer push ({}).'.format(new_sha[:7]))
+    await job.reporter.flush_status()
+    job.reporter.close()
+
+
+async def job_loop(loop, queue, config, max_workers=1):
+    '''
+    Fetch jobs from the queue and run them concurrently,
+    up to max_workers jobs in total and up to the "concurrency" value
+    of each repository config per repository.
+    '''
+    log = logging.getLogger('testion.jobqueue')
+    global_sema = asyncio.Semaphore(max_workers, loop=loop)
+    num_running = defaultdict(int)  # by repository
+    running = set()
+    metrics.queue_depth.set_function(queue.qsize)
+
+    def has_free_slot(job):
+        concurrency = config.get(job.repo_name, {}).get('concurrency', 1)
+        return num_running[job.repo_name] < concurrency
+
+    def job_done(job, task):
+        running.discard(task)
+        num_running[job.repo_name] -= 1
+        global_sema.release()
+        if task.cancelled():
+            # Interrupted by shutdown; keep it for the next startup.
+            queue.abandon(job)
+        else:
+            queue.task_done(job)
+
     while True:
         try:
-            job = await queue.get()
-            log.info('Fetched a new job and executing it. (current qsize: {})'
+            # Lease jobs only when they can start right away, so that
+            # the waiting ones stay in the queue to be superseded.
+            await global_sema.acquire()
+            try:
+                job = await queue.get(has_free_slot)
+            except asyncio.CancelledError:
+                global_sema.release()
+                raise
+            log.info('Fetched a new job and scheduling it. (current qsize: {})'
                      .format(queue.qsize()))
-            await job
-            queue.task_done()
+            if job.reporter is None:
+                try:
+                    job.reporter = create_reporter(config, job)
+                except Exception:
+                    log.exception('Cannot create the reporter of a recovered job for {}'
+                                  .format(job.repo_name))
+                    global_sema.release()
+                    queue.task_done(job)
+                    continue
+            num_running[job.repo_name] += 1
+            task = loop.create_task(run_job(job))
+            task.add_done_callback(functools.partial(job_done, job))
+            queue.set_running(job, task)
+            running.add(task)
         except asyncio.CancelledError:
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.wait(running, loop=loop)
             break
 
 async def github_webhook(request):
@@ -66,11 +171,23 @@ async def github_webhook(request):
         return web.Response(status=400, text='Invalid reporter class.')
 
     try:
-        reporter = reporter_cls(config, report, data)
-        app._last_reporter = reporter  # for tests
-        if app._job_queue.qsize() > 0:
-            reporter._mark_status('pending', msg='Waiting for other tests to finish...')
-        await app._job_queue.put(reporter.run())
+        reporter = reporter_cls(config, report, data, report_key=report_key)
+        # Send the status in the background to respond quickly.
+        asyncio.ensure_future(
+            reporter._mark_status('pending', msg='Waiting for other tests to finish...'))
+        # Only the latest push of each branch matters for per-commit reports.
+        ref = data.get('ref') if report['branches'] == '!HEAD' else None
+        job = Job(repo_name, report_key, ref, data, reporter)
+        old_job = await app._job_queue.put(job)
+        if old_job is not None:
+            if old_job.reporter is None:
+                old_job.reporter = create_reporter(app.config, old_job)
+            asyncio.ensure_future(mark_superseded(old_job))
+        elif report.get('cancel_superseded', False):
+            running_job, task = app._job_queue.get_running(job.key)
+            if running_job is not None:
+                running_job.superseded_by = job
+                task.cancel()
     except UnsupportedEventError:
         return web.Response(status=400, text='Unsupported GitHub event type.')
     except Exception as e:
@@ -78,6 +195,103 @@ async def github_webhook(request):
         return web.Response(status=500, text=traceback.format_exc())
     return web.Response(status=204)
 
+async def api_history(request):
+    '''
+    Query the history of test runs.  Without the "test" parameter, it returns
+    the latest runs filtered by "repo", "report" and "branch"; with it, it
+    returns the latest results of the test in the given repo and report.
+    '''
+    history = get_history()
+    if history is None:
+        return web.Response(status=404, text='The history is not recorded.')
+    query = request.GET
+    try:
+        limit = min(int(query.get('limit', 50)), 1000)
+    except ValueError:
+        return web.Response(status=400, text='Invalid limit.')
+    if 'test' in query:
+        if 'repo' not in query or 'report' not in query:
+            return web.Response(status=400,
+                                text='"repo" and "report" are required to query a test.')
+        results = history.get_test_results(query['repo'], query['report'],
+                                           query['test'], limit)
+    else:
+        results = history.get_runs(query.get('repo'), query.get('report'),
+                                   query.get('branch'), limit)
+    return web.json_response(results)
+
+def read_log_chunk(path, offset):
+    '''
+    Read up to LOG_CHUNK_SIZE bytes of the log file from offset.
+    The log file does not exist until the first line is written.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(LOG_CHUNK_SIZE)
+    except FileNotFoundError:
+        return b''
+
+async def job_log(request):
+    '''
+    Stream the log of a running job, following it until the job finishes.
+    It uses Server-Sent Events (one event per chunk of lines, with the byte
+    offset as the event ID to resume from) if the client accepts them,
+    and a plain chunked text response otherwise.
+    '''
+    try:
+        live_log = livelog.get(int(request.match_info['id']))
+    except ValueError:
+        live_log = None
+    if live_log is None:
+        return web.Response(status=404, text='No such job.')
+    use_sse = 'text/event-stream' in request.headers.get('Accept', '')
+    try:
+        offset = int(request.headers.get('Last-Event-ID', 0)) if use_sse else 0
+    except ValueError:
+        offset = 0
+
+    resp = web.StreamResponse()
+    resp.content_type = 'text/event-stream' if use_sse else 'text/plain'
+    resp.charset = 'utf-8'
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.enable_chunked_encoding()
+    await resp.prepare(request)
+    loop = asyncio.get_event_loop()
+    while True:
+        # Check it before reading so that the last lines are not missed.
+        finished = live_log.finished
+        chunk = await loop.run_in_executor(None, read_log_chunk, live_log.path, offset)
+        if chunk and use_sse:
+            # Send only complete lines, unless a line is too long.
+            end = chunk.rfind(b'\n') + 1
+            if end > 0:
+                chunk = chunk[:end]
+            elif len(chunk) < LOG_CHUNK_SIZE and not finished:
+                chunk = b''
+        if chunk:
+            offset += len(chunk)
+            if use_sse:
+                lines = chunk.decode('utf-8', 'replace').rstrip('\n').split('\n')
+                resp.write('id: {}\n{}\n'.format(
+                    offset, ''.join('data: {}\n'.format(line) for line in lines))
+                    .encode('utf-8'))
+            else:
+                resp.write(chunk)
+            await resp.drain()
+            continue
+        if finished:
+            break
+        await asyncio.sleep(LOG_POLL_INTERVAL)
+    if use_sse:
+        resp.write(b'event: end\ndata: \n\n')
+    await resp.write_eof()
+    return resp
+
+
+async def prometheus_metrics(request):
+    return web.Response(text=metrics.generate_latest(), content_type='text/plain')
+
 def handle_signal(loop, term_ev):
     if not term_ev.is_set():
         loop.stop()
@@ -87,9 +301,22 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--port', type=int, default=9092)
     parser.add_argument('-f', '--config', type=Path, default=here / 'config.yml')
+    parser.add_argument('-q', '--queue-db', type=Path, default=None,
+                        help='The path of the database to keep pending jobs across restarts '
+                             '(default: jobs.sqlite3 in the cache directory).')
+    parser.add_argument('-H', '--history-db', type=Path, default=None,
+                        help='The path of the database to record the history of test runs '
+                             '(default: history.sqlite3 in the cache directory).')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1,
+                        help='The maximum number of jobs running at the same time.')
     args = parser.parse_args()
     config = yaml.load(args.config.read_text())
     config['service_port'] = args.port
+    config['max_workers'] = args.workers
+    if args.queue_db is None:
+        args.queue_db = get_cache_path() / 'jobs.sqlite3'
+    if args.history_db is None:
+        args.history_db = get_cache_path() / 'history.sqlite3'
 
     # Set up the root logger that prints all test runs.
     coloredlogs.install(
@@ -112,13 +339,24 @@ if __name__ == '__main__':
     app.config = config
     app.sslctx = None
     app.router.add_post('/webhook', github_webhook)
-    app._job_queue = asyncio.Queue(loop=loop)
+    app.router.add_get('/api/history', api_history)
+    app.router.add_get('/metrics', prometheus_metrics)
+    app.router.add_get('/jobs/{id}/log', job_log)
+    app._job_queue = JobQueue(args.queue_db, loop=loop)
+    open_history(args.history_db)
     term_ev = asyncio.Event(loop=loop)
     loop.add_signal_handler(signal.SIGINT, handle_signal, loop, term_ev)
     loop.add_signal_handler(signal.SIGTERM, handle_signal, loop, term_ev)
     try:
         web_handler = app.make_handler(keep_alive_on=False)
-        job_task = asyncio.ensure_future(job_loop(loop, app._job_queue))
+        # Start the Selenium servers early if any functional tests are configured.
+        if any(isinstance(repo_config, dict) and
+               any(report.get('cls') == 'slfunc'
+                   for report in repo_config.get('reports', {}).values())
+               for repo_config in config.values()):
+            get_selenium_pool().warm_up()
+        job_task = asyncio.ensure_future(job_loop(loop, app._job_queue, app.config,
+                                                  config['max_workers']))
         server = loop.run_until_complete(
             loop.create_server(web_handler, '0.0.0.0',
                                app.config['service_port']))
@@ -131,10 +369,16 @@ if __name__ == '__main__':
             server.close()
             job_task.cancel()
             await server.wait_closed()
+            await job_task
             await app.shutdown()
             await web_handler.finish_connections()
             await app.cleanup()
+            await close_selenium_pool()
+            # Finish the pending log uploads.
+            await close_s3_uploader()
         loop.run_until_complete(finish_web())
+        app._job_queue.close()
+        close_history()
     finally:
         loop.close()
         logger.info('terminated.')
@@ -4,6 +4,7 @@ import gc
 from pathlib import Path
 import socket
 import ssl
+from unittest import mock
 
 import aiohttp
 from aiohttp import web
@@ -11,7 +12,12 @@ import pytest
 import uvloop
 import yaml
 
-from testion.server import github_webhook, job_loop
+from testion.github import clear_clients
+from testion.history import close_history, open_history
+from testion.jobqueue import JobQueue
+from testion.reporter.base import TestReporterBase
+from testion.server import (api_history, github_webhook, job_log, job_loop,
+                            prometheus_metrics)
 
 
 @contextlib.contextmanager
@@ -75,9 +81,13 @@ def create_server(loop, unused_port, root):
         app.config['service_port'] = unused_port
         app.sslctx = None
         app.router.add_post('/webhook', github_webhook)
-        app._job_queue = asyncio.Queue(loop=loop)
+        app.router.add_get('/api/history', api_history)
+        app.router.add_get('/metrics', prometheus_metrics)
+        app.router.add_get('/jobs/{id}/log', job_log)
+        app._job_queue = JobQueue(loop=loop)
+        open_history()
         handler = app.make_handler(debug=debug, keep_alive_on=False)
-        job_task = asyncio.ensure_future(job_loop(loop, app._job_queue))
+        job_task = asyncio.ensure_future(job_loop(loop, app._job_queue, app.config))
         server = await loop.create_server(handler,
                                           '127.0.0.1',
                                           app.config['service_port'])
@@ -89,10 +99,15 @@ def create_server(loop, unused_port, root):
         server.close()
         job_task.cancel()
         await server.wait_closed()
+        await job_task
         await app.shutdown()
         await handler.finish_connections()
         await app.cleanup()
+        app._job_queue.close()
+        close_history()
     loop.run_until_complete(finish())
+    # Drop GitHub clients bound to the mocked github3 of this test.
+    clear_clients()
 
 
 class Client:
@@ -115,6 +130,11 @@ class Client:
         params['blocking'] = '1'
         return self._session.post(url, params=params, **kwargs)
 
+    def get(self, path, **kwargs):
+        while path.startswith('/'):
+            path = path[1:]
+        return self._session.get(self._url + path, **kwargs)
+
 
 @pytest.yield_fixture
 def create_app_and_client(capsys, loop, create_server):
@@ -137,3 +157,31 @@ def create_app_and_client(capsys, loop, create_server):
 
     if client:
         client.close()
+
+
+@pytest.yield_fixture
+def make_reporter(monkeypatch, tmpdir):
+    '''
+    Returns a function creating a reporter for the given report config,
+    which writes its log under tmpdir and uses a mocked GitHub client.
+    '''
+    monkeypatch.setenv('GH_USERNAME', 'testion')
+    monkeypatch.setenv('GH_TOKEN', 'dummy-token')
+    reporters = []
+
+    def make(report, cls=TestReporterBase):
+        config = {'log': {'local_path': str(tmpdir.join('logs')), 's3_bucket': None}}
+        data = {
+            'ref': 'refs/heads/master',
+            'after': '0' * 40,
+            'repository': {'full_name': 'lablup/testion', 'name': 'testion',
+                           'owner': {'name': 'lablup'}},
+        }
+        reporters.append(cls(config, report, data))
+        return reporters[-1]
+
+    with mock.patch('github3.login'):
+        yield make
+    for reporter in reporters:
+        reporter.close()
+    clear_clients()
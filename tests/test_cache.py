@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+from testion.cache import FileLock, get_cache_path
+
+
+async def test_cancel_acquire_async(loop, tmpdir):
+    path = tmpdir.join('test.lock')
+    holder = FileLock(path)
+    holder.acquire()
+    waiter = FileLock(path)
+    task = loop.create_task(waiter.acquire_async(loop, shared=True))
+    await asyncio.sleep(0.1, loop=loop)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    holder.release()
+    # The cancelled waiter releases the lock once it gets it.
+    for _ in range(100):
+        if not waiter.locked:
+            break
+        await asyncio.sleep(0.01, loop=loop)
+    assert not waiter.locked
+    assert holder.acquire(blocking=False)
+    holder.release()
+
+
+def test_default_cache_path(tmpdir, monkeypatch):
+    monkeypatch.delenv('TESTION_CACHE_PATH', raising=False)
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    assert str(get_cache_path()) == str(tmpdir.join('testion'))
+    assert tmpdir.join('testion').check(dir=1)
+    monkeypatch.setenv('TESTION_CACHE_PATH', str(tmpdir.join('custom')))
+    assert str(get_cache_path()) == str(tmpdir.join('custom'))
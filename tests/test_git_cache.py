@@ -0,0 +1,128 @@
+import asyncio
+import time
+
+import pygit2
+
+from testion.cache import git
+from testion.cache.git import GitMirrorCache, find_recent_branches
+
+
+def make_remote(path):
+    repo = pygit2.init_repository(str(path), bare=True)
+    sig = pygit2.Signature('test', 'test@example.com')
+    tree = repo.TreeBuilder()
+    tree.insert('README', repo.create_blob(b'hello\n'), pygit2.GIT_FILEMODE_BLOB)
+    master = repo.create_commit('refs/heads/master', sig, sig, 'Initial commit',
+                                tree.write(), [])
+    repo.create_reference('refs/tags/v1.0', master)
+    tree.insert('README', repo.create_blob(b'feature\n'), pygit2.GIT_FILEMODE_BLOB)
+    repo.create_commit('refs/heads/feature', sig, sig, 'Add a feature',
+                       tree.write(), [master])
+    return repo
+
+
+async def test_create_worktree(loop, tmpdir):
+    remote = make_remote(tmpdir.join('remote.git'))
+    cache = GitMirrorCache(str(tmpdir.join('mirrors')))
+    async with cache.lease('o/r', str(tmpdir.join('remote.git')), loop=loop) as mirror:
+        repo = mirror.create_worktree(str(tmpdir.join('wc')), 'master')
+        assert repo.head.shorthand == 'master'
+        assert tmpdir.join('wc', 'README').read() == 'hello\n'
+        assert repo.revparse_single('origin/feature').id == \
+            remote.lookup_reference('refs/heads/feature').target
+        assert repo.revparse_single('v1.0').id == \
+            remote.lookup_reference('refs/tags/v1.0').target
+
+
+async def test_create_worktree_at_ref(loop, tmpdir):
+    remote = make_remote(tmpdir.join('remote.git'))
+    cache = GitMirrorCache(str(tmpdir.join('mirrors')))
+    async with cache.lease('o/r', str(tmpdir.join('remote.git')), loop=loop) as mirror:
+        repo = mirror.create_worktree(str(tmpdir.join('wc')), 'master', 'origin/feature')
+        assert repo.head_is_detached
+        assert repo.head.target == remote.lookup_reference('refs/heads/feature').target
+        assert tmpdir.join('wc', 'README').read() == 'feature\n'
+        assert repo.lookup_branch('master') is not None
+
+
+async def test_leases_do_not_wait_for_each_other(loop, tmpdir):
+    make_remote(tmpdir.join('remote.git'))
+    cache = GitMirrorCache(str(tmpdir.join('mirrors')))
+    url = str(tmpdir.join('remote.git'))
+    async with cache.lease('o/r', url, loop=loop):
+        # Another run fetches the mirror while it is used by the first one.
+        entered = asyncio.Event(loop=loop)
+
+        async def second_run():
+            async with cache.lease('o/r', url, loop=loop):
+                entered.set()
+
+        task = loop.create_task(second_run())
+        for _ in range(100):
+            if entered.is_set():
+                break
+            await asyncio.sleep(0.05, loop=loop)
+        assert entered.is_set()
+        await task
+
+
+async def test_evict_unused_mirrors_only(loop, tmpdir):
+    make_remote(tmpdir.join('remote.git'))
+    cache = GitMirrorCache(str(tmpdir.join('mirrors')), max_size=1)
+    mirror_path = tmpdir.join('mirrors', 'o', 'r.git')
+    async with cache.lease('o/r', str(tmpdir.join('remote.git')), loop=loop):
+        cache.evict()
+        assert mirror_path.join('HEAD').check()
+    # The lease evicts the mirror on exit as it exceeds the size limit.
+    assert not mirror_path.check()
+
+
+def make_branches(path, now):
+    repo = pygit2.init_repository(str(path), bare=True)
+    tree = repo.TreeBuilder().write()
+
+    def commit(parents, age):
+        sig = pygit2.Signature('test', 'test@example.com', int(now - age), 0)
+        return repo.create_commit(None, sig, sig, 'age {}'.format(age), tree, parents)
+
+    old = commit([], 10 * 86400)
+    repo.create_reference('refs/heads/master', old)
+    recent = commit([old], 3600)
+    repo.create_reference('refs/heads/recent', recent)
+    repo.create_reference('refs/remotes/origin/recent', recent)  # identical head
+    repo.create_reference('refs/remotes/origin/older', commit([old], 5 * 86400))
+    # A recent commit under an old one, e.g., due to a skewed clock.
+    repo.create_reference('refs/heads/skewed', commit([commit([old], 7200)], 3 * 86400))
+    return repo
+
+
+def test_find_recent_branches(tmpdir, monkeypatch):
+    monkeypatch.setattr(git, '_recent_heads_cache', git.OrderedDict())
+    now = time.time()
+    repo = make_branches(tmpdir.join('repo.git'), now)
+    assert find_recent_branches(repo, 86400, now) == ['recent', 'skewed']
+    assert find_recent_branches(repo, 86400 * 6, now) == \
+        ['recent', 'skewed', 'origin/older']
+
+    # The result is reused until the recent commits get old.
+    find_recent_heads = git._find_recent_heads
+    num_walks = 0
+
+    def count_walks(*args):
+        nonlocal num_walks
+        num_walks += 1
+        return find_recent_heads(*args)
+
+    monkeypatch.setattr(git, '_find_recent_heads', count_walks)
+    assert find_recent_branches(repo, 86400, now + 3600) == ['recent', 'skewed']
+    assert num_walks == 0
+    assert find_recent_branches(repo, 86400, now + 80000) == ['recent']
+    assert find_recent_branches(repo, 86400, now + 86400) == []
+    assert num_walks == 2
+
+
+async def test_get_recently_updated_branches(loop, tmpdir, make_reporter):
+    repo = make_branches(tmpdir.join('repo.git'), time.time())
+    reporter = make_reporter({'branches': '!OUTSTANDING'})
+    reporter.local_repo = repo
+    assert list(reporter.generate_target_refs()) == ['recent', 'skewed']
@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+import pytest
+
+from testion import github
+from testion.github import RequestBudget, StatusDispatcher
+
+
+class FakeClient:
+
+    def __init__(self, loop):
+        self.gate = asyncio.Event(loop=loop)
+        self.gate.set()
+
+    async def call(self, func, *args, **kwargs):
+        await self.gate.wait()
+        return func(*args, **kwargs)
+
+
+class FakeRepo:
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.states = []
+
+    def create_status(self, sha, state, description, context, target_url):
+        self.states.append(state)
+        if self.failures > 0:
+            self.failures -= 1
+            raise RuntimeError('server error')
+        return True
+
+
+def post(dispatcher, repo, state):
+    return dispatcher.post(repo, 'a' * 40, 'ci/test', state, '', None)
+
+
+@pytest.fixture
+def fast_retry(monkeypatch):
+    monkeypatch.setattr(github, 'STATUS_RETRY_DELAY', 0.01)
+
+
+async def test_coalesce_statuses(loop):
+    client = FakeClient(loop)
+    dispatcher = StatusDispatcher(client)
+    repo = FakeRepo()
+    client.gate.clear()
+    waiters = [post(dispatcher, repo, state) for state in ('pending', 'failure')]
+    await asyncio.sleep(0.01, loop=loop)
+    # The intermediate states posted while sending are dropped.
+    waiters += [post(dispatcher, repo, 'pending'), post(dispatcher, repo, 'success')]
+    client.gate.set()
+    assert await asyncio.gather(*waiters, loop=loop) == [True] * 4
+    assert repo.states == ['failure', 'success']
+    assert not dispatcher._senders
+
+
+async def test_retry_status(loop, fast_retry):
+    dispatcher = StatusDispatcher(FakeClient(loop))
+    repo = FakeRepo(failures=2)
+    assert await post(dispatcher, repo, 'success')
+    assert repo.states == ['success'] * 3
+
+
+async def test_give_up_status(loop, fast_retry):
+    dispatcher = StatusDispatcher(FakeClient(loop))
+    repo = FakeRepo(failures=100)
+    assert not await post(dispatcher, repo, 'success')
+    assert len(repo.states) == github.STATUS_MAX_RETRIES + 1
+
+
+async def test_retry_newer_status(loop, monkeypatch):
+    monkeypatch.setattr(github, 'STATUS_RETRY_DELAY', 0.1)
+    dispatcher = StatusDispatcher(FakeClient(loop))
+    repo = FakeRepo(failures=1)
+    first = post(dispatcher, repo, 'pending')
+    await asyncio.sleep(0.05, loop=loop)
+    # A newer state posted during the backoff is sent instead of the old one.
+    second = post(dispatcher, repo, 'success')
+    assert await asyncio.gather(first, second, loop=loop) == [True, True]
+    assert repo.states == ['pending', 'success']
+
+
+class FakeResponse:
+
+    def __init__(self, headers):
+        self.headers = headers
+
+
+async def test_request_budget(loop):
+    budget = RequestBudget(reserve=2)
+    await budget.acquire(loop=loop)
+    assert budget.remaining is None
+    budget.update(FakeResponse({'X-RateLimit-Remaining': '5',
+                                'X-RateLimit-Reset': str(int(time.time()) + 3600)}))
+    await budget.acquire(loop=loop)
+    assert budget.remaining == 4
+    # Responses without the headers do not change the budget.
+    budget.update(FakeResponse({}))
+    assert budget.remaining == 4
+
+
+async def test_request_budget_waits_for_reset(loop, monkeypatch):
+    budget = RequestBudget(reserve=2)
+    budget.update(FakeResponse({'X-RateLimit-Remaining': '2',
+                                'X-RateLimit-Reset': str(int(time.time()) + 60)}))
+    delays = []
+
+    async def fake_sleep(delay, loop=None):
+        delays.append(delay)
+
+    monkeypatch.setattr(asyncio, 'sleep', fake_sleep)
+    await budget.acquire(loop=loop)
+    assert len(delays) == 1 and 55 < delays[0] <= 60
+    # The budget is unknown until the next response after the reset.
+    assert budget.remaining is None
@@ -0,0 +1,80 @@
+from testion.history import HistoryStore, get_history
+from testion.reporter.parser import TestCaseResult, TestResult
+
+
+def test_history_store():
+    history = HistoryStore()
+    cases = [
+        TestCaseResult('test_a', 'test_one', 'test_a.py', 'passed', 0.5),
+        TestCaseResult('test_a', 'test_two', 'test_a.py', 'failed', 1.5),
+    ]
+    first = history.add_run('lablup/testion', 'unit', 'master', 'a' * 40,
+                            TestResult('failure', 2, 1, 1), 1000.0,
+                            {'venv': 3.0, 'tests': 2.0}, '#', cases)
+    second = history.add_run('lablup/testion', 'unit', 'feature', 'b' * 40,
+                             None, 2000.0, {}, '#')
+    history.add_run('lablup/other', 'unit', 'master', 'c' * 40,
+                    TestResult('success', 0, 0, 0), 3000.0, {}, '#')
+
+    runs = history.get_runs('lablup/testion', 'unit')
+    assert [run['id'] for run in runs] == [second, first]
+    assert runs[0]['state'] == 'error'
+    assert runs[1]['stages'] == {'venv': 3.0, 'tests': 2.0}
+    assert [run['sha'] for run in history.get_runs(branch='master')] == ['c' * 40, 'a' * 40]
+
+    results = history.get_test_results('lablup/testion', 'unit', 'test_a.py::test_two')
+    assert len(results) == 1
+    assert results[0]['run_id'] == first
+    assert results[0]['outcome'] == 'failed'
+    history.close()
+
+
+def test_failed_first_order():
+    history = HistoryStore()
+
+    def add_run(outcomes):
+        cases = [TestCaseResult('test_a', name, 'test_a.py', outcome, 0.1)
+                 for name, outcome in outcomes.items()]
+        num_fails = sum(outcome == 'failed' for outcome in outcomes.values())
+        result = TestResult('failure' if num_fails else 'success', len(cases),
+                            len(cases) - num_fails, num_fails)
+        history.add_run('lablup/testion', 'unit', 'master', 'a' * 40,
+                        result, 1000.0, {}, '#', cases)
+
+    add_run({'test_flaky': 'failed', 'test_broken': 'passed', 'test_ok': 'passed'})
+    add_run({'test_flaky': 'failed', 'test_broken': 'passed', 'test_ok': 'passed'})
+    add_run({'test_flaky': 'passed', 'test_broken': 'failed', 'test_ok': 'passed'})
+    assert history.get_failed_first_order('lablup/testion', 'unit') == \
+           ['test_a.py::test_broken', 'test_a.py::test_flaky']
+    assert history.get_failed_first_order('lablup/testion', 'unit', num_runs=1) == \
+           ['test_a.py::test_broken']
+    assert history.get_failed_first_order('lablup/testion', 'other') == []
+
+
+async def test_api_history(create_app_and_client):
+    app, client = await create_app_and_client()
+    history = get_history()
+    cases = [TestCaseResult('test_a', 'test_one', 'test_a.py', 'failed', 0.5)]
+    run_id = history.add_run('lablup/testion', 'unit', 'master', 'a' * 40,
+                             TestResult('failure', 1, 0, 1), 1000.0, {}, '#', cases)
+    history.add_run('lablup/other', 'unit', 'master', 'b' * 40,
+                    TestResult('success', 0, 0, 0), 2000.0, {}, '#')
+
+    resp = await client.get('/api/history', params={'repo': 'lablup/testion'})
+    assert resp.status == 200
+    runs = await resp.json()
+    assert [run['id'] for run in runs] == [run_id]
+    resp = await client.get('/api/history', params={'limit': '1'})
+    assert [run['sha'] for run in await resp.json()] == ['b' * 40]
+
+    resp = await client.get('/api/history', params={
+        'repo': 'lablup/testion', 'report': 'unit', 'test': 'test_a.py::test_one'})
+    results = await resp.json()
+    assert [(r['run_id'], r['outcome']) for r in results] == [(run_id, 'failed')]
+
+    resp = await client.get('/api/history', params={'test': 'test_a.py::test_one'})
+    assert resp.status == 400
+    resp.close()
+    resp = await client.get('/api/history', params={'limit': 'many'})
+    assert resp.status == 400
+    resp.close()
@@ -0,0 +1,31 @@
+import pygit2
+
+from testion.reporter.impact import get_changed_files, select_tests, ZERO_SHA
+
+
+def _commit(repo, files, parents):
+    builder = repo.TreeBuilder()
+    for name, content in files.items():
+        builder.insert(name, repo.create_blob(content), pygit2.GIT_FILEMODE_BLOB)
+    sig = pygit2.Signature('testion', 'testion@example.com')
+    return repo.create_commit(None, sig, sig, 'commit', builder.write(), parents)
+
+
+def test_get_changed_files(tmpdir):
+    repo = pygit2.init_repository(str(tmpdir), bare=True)
+    before = _commit(repo, {'a.py': b'a', 'b.py': b'b'}, [])
+    after = _commit(repo, {'a.py': b'A', 'c.py': b'c'}, [before])
+    assert get_changed_files(repo, str(before), str(after)) == {'a.py', 'b.py', 'c.py'}
+    assert get_changed_files(repo, ZERO_SHA, str(after)) is None
+
+
+def test_select_tests():
+    impact_map = {'pkg/a.py': {'tests/test_a.py'}}
+    rules = {'pkg/conf/*': ['tests/conf']}
+    assert select_tests({'pkg/a.py', 'tests/test_b.py'}, impact_map) == \
+           ['tests/test_a.py', 'tests/test_b.py']
+    assert select_tests({'pkg/conf/x.yml', 'README.md'}, impact_map, rules,
+                        ignore=['*.md']) == ['tests/conf']
+    assert select_tests({'README.md'}, impact_map, ignore=['*.md']) == []
+    # Unmapped files require the full test suite.
+    assert select_tests({'pkg/a.py', 'pkg/new.py'}, impact_map) is None
@@ -0,0 +1,114 @@
+import asyncio
+
+from testion.jobqueue import Job, JobQueue
+from testion.server import job_loop
+
+
+class FakeReporter:
+
+    def __init__(self, name, started, release):
+        self.name = name
+        self.started = started
+        self.release = release
+        self.log_file = '/dev/null'
+        self.live_log_url = None
+
+    async def run(self):
+        self.started.append(self.name)
+        await self.release.wait()
+
+    def close(self):
+        pass
+
+
+def make_job(repo_name, ref, reporter):
+    return Job(repo_name, 'unit', ref, {'ref': ref}, reporter)
+
+
+async def wait_until(loop, cond):
+    for _ in range(100):
+        if cond():
+            return
+        await asyncio.sleep(0.01, loop=loop)
+    assert cond()
+
+
+async def run_job_loop(loop, queue, config, max_workers, body):
+    job_task = asyncio.ensure_future(job_loop(loop, queue, config, max_workers=max_workers))
+    try:
+        await body()
+    finally:
+        job_task.cancel()
+        await job_task
+        queue.close()
+
+
+async def test_global_limit(loop):
+    queue = JobQueue(loop=loop)
+    config = {'o/r': {'concurrency': 10}}
+    started = []
+    release = asyncio.Event(loop=loop)
+
+    async def body():
+        for ref in 'abcd':
+            await queue.put(make_job('o/r', ref, FakeReporter(ref, started, release)))
+        await wait_until(loop, lambda: len(started) == 2)
+        await asyncio.sleep(0.05, loop=loop)
+        assert started == ['a', 'b']
+        release.set()
+        await queue.join()
+        assert started == ['a', 'b', 'c', 'd']
+
+    await run_job_loop(loop, queue, config, 2, body)
+
+
+async def test_per_repo_limit(loop):
+    queue = JobQueue(loop=loop)
+    # Repositories without the "concurrency" config run one job at a time.
+    config = {'o/r': {'concurrency': 2}, 'o/s': {}}
+    started = []
+    release = asyncio.Event(loop=loop)
+
+    async def body():
+        for ref in 'abc':
+            await queue.put(make_job('o/r', ref, FakeReporter('r' + ref, started, release)))
+            await queue.put(make_job('o/s', ref, FakeReporter('s' + ref, started, release)))
+        await wait_until(loop, lambda: len(started) == 3)
+        await asyncio.sleep(0.05, loop=loop)
+        assert sorted(started) == ['ra', 'rb', 'sa']
+        release.set()
+        await queue.join()
+        assert sorted(started) == ['ra', 'rb', 'rc', 'sa', 'sb', 'sc']
+
+    await run_job_loop(loop, queue, config, 10, body)
+
+
+async def test_job_loop_keeps_waiting_jobs_queued(loop):
+    queue = JobQueue(loop=loop)
+    config = {'o/r': {'concurrency': 1}, 'o/s': {'concurrency': 1}}
+    started = []
+    release = asyncio.Event(loop=loop)
+
+    async def body():
+        await queue.put(make_job('o/r', 'a', FakeReporter('a', started, release)))
+        await wait_until(loop, lambda: started == ['a'])
+
+        # The jobs waiting for a slot of the repository stay in the queue
+        # and are superseded by newer pushes.
+        first = make_job('o/r', 'b', FakeReporter('b1', started, release))
+        assert await queue.put(first) is None
+        await asyncio.sleep(0.05, loop=loop)
+        assert queue.qsize() == 1
+        assert await queue.put(make_job('o/r', 'b', FakeReporter('b2', started, release))) \
+            is first
+
+        # Other repositories are not blocked by them.
+        await queue.put(make_job('o/s', 'a', FakeReporter('c', started, release)))
+        await wait_until(loop, lambda: started == ['a', 'c'])
+        assert queue.qsize() == 1
+
+        release.set()
+        await queue.join()
+        assert started == ['a', 'c', 'b2']
+
+    await run_job_loop(loop, queue, config, 4, body)
@@ -0,0 +1,87 @@
+from testion.jobqueue import Job, JobQueue
+
+
+def make_job(repo_name, ref, reporter):
+    return Job(repo_name, 'unit', ref, {'ref': ref}, reporter)
+
+
+def job_states(queue):
+    return queue._db.execute('SELECT ref, state FROM jobs ORDER BY id').fetchall()
+
+
+async def test_supersede_pending_job(loop):
+    queue = JobQueue(loop=loop)
+    first = make_job('o/r', 'x', None)
+    assert await queue.put(first) is None
+    await queue.put(make_job('o/r', 'y', None))
+    newer = make_job('o/r', 'x', None)
+    assert await queue.put(newer) is first
+    assert first.superseded_by is newer
+    assert newer.id == first.id
+    assert queue.qsize() == 2
+    # The newer job takes the position of the older one.
+    assert (await queue.get()) is newer
+    assert (await queue.get()).ref == 'y'
+    queue.close()
+
+
+async def test_lease_and_finish(loop):
+    queue = JobQueue(loop=loop)
+    job = make_job('o/r', 'x', None)
+    await queue.put(job)
+    assert job_states(queue) == [('x', 'queued')]
+    assert (await queue.get()) is job
+    assert job_states(queue) == [('x', 'leased')]
+    # A push for the branch being tested is queued separately.
+    newer = make_job('o/r', 'x', None)
+    assert await queue.put(newer) is None
+    assert queue.qsize() == 1
+    queue.task_done(job)
+    assert job_states(queue) == [('x', 'queued')]
+    assert (await queue.get()) is newer
+    queue.task_done(newer)
+    assert job_states(queue) == []
+    await queue.join()
+    queue.close()
+
+
+async def test_recover_jobs(loop, tmpdir):
+    path = tmpdir.join('jobs.sqlite3')
+    queue = JobQueue(path, loop=loop)
+    await queue.put(make_job('o/r', 'x', None))
+    await queue.put(make_job('o/r', 'y', None))
+    await queue.put(make_job('o/r', 'z', None))
+    queue.task_done(await queue.get())
+    queue.abandon(await queue.get())
+    queue.close()
+
+    queue = JobQueue(path, loop=loop)
+    assert queue.qsize() == 2
+    job = await queue.get()
+    assert (job.repo_name, job.report_key, job.ref) == ('o/r', 'unit', 'y')
+    assert job.data == {'ref': 'y'}
+    assert job.reporter is None
+    assert (await queue.get()).ref == 'z'
+    queue.close()
+
+
+async def test_recover_duplicate_keys(loop, tmpdir):
+    path = tmpdir.join('jobs.sqlite3')
+    queue = JobQueue(path, loop=loop)
+    await queue.put(make_job('o/r', 'x', None))
+    await queue.get()  # interrupted while running
+    newer = make_job('o/r', 'x', None)
+    newer.data = {'ref': 'x', 'after': 'newer'}
+    await queue.put(newer)
+    await queue.put(make_job('o/r', 'y', None))
+    queue.close()
+
+    # Only the newest job for the same key is recovered.
+    queue = JobQueue(path, loop=loop)
+    assert queue.qsize() == 2
+    job = await queue.get()
+    assert job.data['after'] == 'newer'
+    assert (await queue.get()).ref == 'y'
+    assert job_states(queue) == [('x', 'leased'), ('y', 'leased')]
+    queue.close()
+
@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from testion import livelog, server
+
+
+def test_live_log_registry(monkeypatch):
+    monkeypatch.setattr(livelog, 'MAX_FINISHED_LOGS', 2)
+    monkeypatch.setattr(livelog, '_live_logs', livelog.OrderedDict())
+    for job_id in range(1, 5):
+        livelog.register(job_id, '/tmp/{}.txt'.format(job_id))
+    for job_id in (2, 1, 3):
+        livelog.finish(job_id)
+    # The running job is kept, and only the last two finished ones are.
+    assert livelog.get(2) is None
+    assert livelog.get(1).finished
+    assert livelog.get(3).finished
+    assert not livelog.get(4).finished
+
+
+def test_live_log_url(monkeypatch):
+    monkeypatch.delenv('TESTION_PUBLIC_URL', raising=False)
+    assert livelog.get_live_log_url(3) is None
+    monkeypatch.setenv('TESTION_PUBLIC_URL', 'https://ci.example.com/')
+    assert livelog.get_live_log_url(3) == 'https://ci.example.com/jobs/3/log'
+
+
+@pytest.fixture
+def live_logs(monkeypatch):
+    monkeypatch.setattr(livelog, '_live_logs', livelog.OrderedDict())
+    monkeypatch.setattr(server, 'LOG_POLL_INTERVAL', 0.01)
+
+
+async def finish_later(loop, job_id, log_file=None, text=''):
+    await asyncio.sleep(0.05, loop=loop)
+    if log_file is not None:
+        log_file.write(text, mode='a')
+    livelog.finish(job_id)
+
+
+async def test_job_log_not_found(create_app_and_client, live_logs):
+    app, client = await create_app_and_client()
+    resp = await client.get('/jobs/1/log')
+    assert resp.status == 404
+    resp.close()
+    resp = await client.get('/jobs/x/log')
+    assert resp.status == 404
+    resp.close()
+
+
+async def test_job_log_plain(loop, tmpdir, create_app_and_client, live_logs):
+    app, client = await create_app_and_client()
+    log_file = tmpdir.join('1.txt')
+    log_file.write('first line\n')
+    livelog.register(1, str(log_file))
+    finisher = loop.create_task(finish_later(loop, 1, log_file, 'second line\n'))
+    resp = await client.get('/jobs/1/log')
+    assert resp.status == 200
+    assert resp.headers['Content-Type'].startswith('text/plain')
+    assert await resp.text() == 'first line\nsecond line\n'
+    await finisher
+
+
+async def test_job_log_before_first_line(loop, tmpdir, create_app_and_client, live_logs):
+    app, client = await create_app_and_client()
+    # The log file is created when the first line is written.
+    log_file = tmpdir.join('1.txt')
+    livelog.register(1, str(log_file))
+    finisher = loop.create_task(finish_later(loop, 1, log_file, 'first line\n'))
+    resp = await client.get('/jobs/1/log')
+    assert resp.status == 200
+    assert await resp.text() == 'first line\n'
+    await finisher
+
+
+async def test_job_log_sse(loop, tmpdir, create_app_and_client, live_logs):
+    app, client = await create_app_and_client()
+    log_file = tmpdir.join('1.txt')
+    log_file.write('one\ntwo\n')
+    livelog.register(1, str(log_file))
+    finisher = loop.create_task(finish_later(loop, 1, log_file, 'three\n'))
+    resp = await client.get('/jobs/1/log', headers={'Accept': 'text/event-stream'})
+    assert resp.headers['Content-Type'].startswith('text/event-stream')
+    assert await resp.text() == (
+        'id: 8\ndata: one\ndata: two\n\n'
+        'id: 14\ndata: three\n\n'
+        'event: end\ndata: \n\n')
+    await finisher
+
+    # Reconnecting clients resume from the last event.
+    resp = await client.get('/jobs/1/log', headers={'Accept': 'text/event-stream',
+                                                    'Last-Event-ID': '8'})
+    assert await resp.text() == 'id: 14\ndata: three\n\nevent: end\ndata: \n\n'
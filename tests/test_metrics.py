@@ -0,0 +1,29 @@
+from testion.metrics import Counter, Gauge, Histogram
+
+
+def test_histogram_exposition():
+    hist = Histogram('test_duration_seconds', 'Test durations.', ['stage'],
+                     buckets=(1, 10, float('inf')))
+    hist.observe(0.5, stage='venv')
+    hist.observe(5, stage='venv')
+    hist.observe(50, stage='venv')
+    lines = hist.expose().splitlines()
+    assert lines[:2] == ['# HELP test_duration_seconds Test durations.',
+                         '# TYPE test_duration_seconds histogram']
+    assert lines[2:] == [
+        'test_duration_seconds_bucket{stage="venv",le="1.0"} 1.0',
+        'test_duration_seconds_bucket{stage="venv",le="10.0"} 2.0',
+        'test_duration_seconds_bucket{stage="venv",le="+Inf"} 3.0',
+        'test_duration_seconds_sum{stage="venv"} 55.5',
+        'test_duration_seconds_count{stage="venv"} 3.0',
+    ]
+
+
+def test_counter_and_gauge():
+    counter = Counter('test_jobs_total', 'Jobs.', ['outcome'])
+    counter.inc(outcome='finished')
+    counter.inc(2, outcome='finished')
+    assert counter.expose().splitlines()[-1] == 'test_jobs_total{outcome="finished"} 3.0'
+    gauge = Gauge('test_queue_depth', 'Queue depth.')
+    gauge.set_function(lambda: 7)
+    assert gauge.expose().splitlines()[-1] == 'test_queue_depth 7.0'
@@ -0,0 +1,109 @@
+import asyncio
+from pathlib import Path
+import threading
+
+import pygit2
+
+from testion.cache import git
+from testion.reporter.base import TestReporterBase
+from testion.reporter.parser import TestResult
+
+BRANCHES = ['origin/one', 'origin/two', 'origin/three']
+
+
+def make_remote(path, branches):
+    repo = pygit2.init_repository(str(path), bare=True)
+    sig = pygit2.Signature('test', 'test@example.com')
+    tree = repo.TreeBuilder()
+    tree.insert('README', repo.create_blob(b'hello\n'), pygit2.GIT_FILEMODE_BLOB)
+    master = repo.create_commit('refs/heads/master', sig, sig, 'Initial commit',
+                                tree.write(), [])
+    for name in branches:
+        tree.insert('README', repo.create_blob(name.encode()), pygit2.GIT_FILEMODE_BLOB)
+        repo.create_commit('refs/heads/' + name, sig, sig, 'Change ' + name,
+                           tree.write(), [master])
+    return repo
+
+
+class ParallelReporter(TestReporterBase):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.num_running = 0
+        self.max_running = 0
+        self.wcdirs = set()
+        self.readmes = []
+        self.results = []
+
+    async def prepare_venv(self, wcdir, venvdir, env, python_version):
+        pass
+
+    async def run_case(self, case_idx, ref, repo, wcdir, venvdir, env,
+                       result_key, cached_result=None):
+        self.num_running += 1
+        self.max_running = max(self.max_running, self.num_running)
+        self.wcdirs.add(wcdir)
+        self.readmes.append(Path(wcdir, 'README').read_text())
+        commit = repo.revparse_single(ref).peel(pygit2.Commit)
+        # The later refs finish first.
+        await asyncio.sleep(0.05 * (3 - case_idx), loop=self.loop)
+        self.num_running -= 1
+        return ref, TestResult('success', 1, 1, 0), str(commit.id)
+
+    def add_result(self, case_name, ref, test_result):
+        self.results.append(ref)
+
+
+async def test_parallel_cases(loop, tmpdir, monkeypatch, make_reporter):
+    monkeypatch.setenv('TESTION_CACHE_PATH', str(tmpdir.join('cache')))
+    monkeypatch.setattr(git, '_mirror_cache', None)
+    make_remote(tmpdir.join('remote.git'), ['one', 'two', 'three'])
+    report = {'branches': BRANCHES, 'parallel': 3, 'result_cache': False}
+    reporter = make_reporter(report, cls=ParallelReporter)
+    reporter.data['repository']['clone_url'] = str(tmpdir.join('remote.git'))
+    create_worktree = git.MirrorLease.create_worktree
+    threads = []
+
+    def fake_create_worktree(self, *args):
+        threads.append(threading.get_ident())
+        return create_worktree(self, *args)
+
+    monkeypatch.setattr(git.MirrorLease, 'create_worktree', fake_create_worktree)
+    await reporter.run()
+    # The worktrees are created without blocking the event loop.
+    assert len(threads) == 4
+    assert threading.get_ident() not in threads
+    assert reporter.max_running == 3
+    # Each case has its own working copy created at the ref.
+    assert len(reporter.wcdirs) == 3
+    assert sorted(reporter.readmes) == ['one', 'three', 'two']
+    # The results are reported in the order of refs.
+    assert reporter.results == BRANCHES
+
+
+async def test_serial_cases(loop, tmpdir, monkeypatch, make_reporter):
+    monkeypatch.setenv('TESTION_CACHE_PATH', str(tmpdir.join('cache')))
+    monkeypatch.setattr(git, '_mirror_cache', None)
+    make_remote(tmpdir.join('remote.git'), ['one', 'two', 'three'])
+    report = {'branches': BRANCHES, 'result_cache': False}
+    reporter = make_reporter(report, cls=ParallelReporter)
+    reporter.data['repository']['clone_url'] = str(tmpdir.join('remote.git'))
+    await reporter.run()
+    assert reporter.max_running == 1
+    assert len(reporter.wcdirs) == 1
+    assert reporter.results == BRANCHES
+
+
+async def test_no_parallel_editable_install(loop, tmpdir, monkeypatch, make_reporter):
+    monkeypatch.setenv('TESTION_CACHE_PATH', str(tmpdir.join('cache')))
+    monkeypatch.setattr(git, '_mirror_cache', None)
+    make_remote(tmpdir.join('remote.git'), ['one', 'two', 'three'])
+    report = {'branches': BRANCHES, 'parallel': 3, 'result_cache': False,
+              'install_cmd': 'pip install -e .'}
+    reporter = make_reporter(report, cls=ParallelReporter)
+    reporter.data['repository']['clone_url'] = str(tmpdir.join('remote.git'))
+    await reporter.run()
+    # The virtualenv links to the main working copy, so it is used for all refs.
+    assert reporter.max_running == 1
+    assert len(reporter.wcdirs) == 1
+    assert reporter.results == BRANCHES
@@ -0,0 +1,134 @@
+from testion.reporter.base import parse_test_result
+from testion.reporter.parser import (
+    MAX_LINE_LENGTH, JUnitResultParser, PytestResultParser, TestResult,
+    UnittestResultParser,
+)
+
+unittest_output = '''\
+test_error (test.MyTest.test_error) ... ERROR
+test_failure (test.MyTest.test_failure) ... FAIL
+test_skip (test.MyTest.test_skip) ... skipped 'no reason'
+test_success (test.MyTest.test_success) ... ok
+
+----------------------------------------------------------------------
+Ran 4 tests in 0.001s
+
+FAILED (failures=1, errors=1, skipped=1)
+'''
+
+pytest_output = '''\
+============================= test session starts ==============================
+collected 6 items
+
+test.py .FsxE.                                                           [100%]
+
+=========================== short test summary info ============================
+FAILED test.py::test_failure - AssertionError
+ERROR test.py::test_error - RuntimeError
+==== 1 failed, 2 passed, 1 skipped, 1 xfailed, 1 error in 0.12s ====
+'''
+
+
+def feed_in_chunks(parser, output, chunk_size=7):
+    for idx in range(0, len(output), chunk_size):
+        parser.feed(output[idx:idx + chunk_size])
+    parser.close()
+    return parser
+
+
+def test_unittest_parser_incremental():
+    parser = feed_in_chunks(UnittestResultParser(), unittest_output)
+    assert parser.num_passes == 2
+    assert parser.num_fails == 2
+    assert parser.get_result() == TestResult('failure', 4, 2, 2)
+
+
+def test_unittest_parser_success():
+    output = '..\n-----\nRan 2 tests in 0.000s\n\nOK\n'
+    assert parse_test_result(output, 'unittest') == TestResult('success', 2, 2, 0)
+
+
+def test_pytest_parser_incremental():
+    parser = feed_in_chunks(PytestResultParser(), pytest_output)
+    assert parser.num_passes == 4
+    assert parser.num_fails == 2
+    assert parser.get_result() == TestResult('failure', 6, 4, 2)
+
+
+def test_pytest_parser_test_cases():
+    parser = feed_in_chunks(PytestResultParser(), pytest_output)
+    assert [(case.test_id, case.outcome) for case in parser.test_cases] == [
+        ('test.py::test_failure', 'failed'),
+        ('test.py::test_error', 'error'),
+    ]
+    output = ('tests/test_x.py::TestX::test_a[1] PASSED                  [ 50%]\n'
+              'tests/test_x.py::test_b FAILED                            [100%]\n'
+              'FAILED tests/test_x.py::test_b - assert False\n'
+              '==== 1 failed, 1 passed in 0.03s ====\n')
+    parser = feed_in_chunks(PytestResultParser(), output)
+    assert [(case.test_id, case.outcome) for case in parser.test_cases] == [
+        ('tests/test_x.py::TestX::test_a[1]', 'passed'),
+        ('tests/test_x.py::test_b', 'failed'),
+    ]
+    assert parser.get_result() == TestResult('failure', 2, 1, 1)
+
+
+def test_pytest_parser_legacy_summary():
+    output = '==== 1 failed, 2 passed in 0.03 seconds ====\n'
+    assert parse_test_result(output, 'pytest') == TestResult('failure', 3, 2, 1)
+
+
+def test_parser_no_result():
+    assert parse_test_result('Traceback (most recent call last):', 'pytest') is None
+    assert parse_test_result('Traceback (most recent call last):', 'unittest') is None
+
+
+def test_pytest_parser_no_tests():
+    output = '==== no tests ran in 0.01s ====\n'
+    assert parse_test_result(output, 'pytest') is None
+    output = '==== 3 deselected in 0.01s ====\n'
+    assert parse_test_result(output, 'pytest') is None
+
+
+junit_xml = '''\
+<?xml version="1.0" encoding="utf-8"?>
+<testsuites><testsuite name="pytest" errors="0" failures="1" skipped="1" tests="3" time="0.5">
+<testcase classname="tests.test_x.TestX" file="tests/test_x.py" line="3" name="test_a" time="0.25"/>
+<testcase classname="tests.test_x" file="tests/test_x.py" line="9" name="test_b" time="0.125">
+<failure message="assert False">assert False</failure></testcase>
+<testcase classname="tests.test_x" file="tests/test_x.py" line="12" name="test_c" time="0.0">
+<skipped message="no reason"/></testcase>
+</testsuite></testsuites>
+'''
+
+
+def test_junit_parser(tmpdir):
+    parser = JUnitResultParser(str(tmpdir / 'run-0'))
+    (tmpdir / 'run-0.junit.xml').write(junit_xml)
+    assert parser.prepare_command('python -m pytest') == \
+        'python -m pytest --junitxml={} -o junit_family=xunit1'.format(parser.xml_path)
+    parser.close()
+    assert parser.get_result() == TestResult('failure', 3, 2, 1)
+    assert [(case.test_id, case.outcome, case.duration) for case in parser.test_cases] == [
+        ('tests/test_x.py::TestX::test_a', 'passed', 0.25),
+        ('tests/test_x.py::test_b', 'failed', 0.125),
+        ('tests/test_x.py::test_c', 'skipped', 0.0),
+    ]
+    assert len((tmpdir / 'run-0.tests.jsonl').readlines()) == 3
+
+
+def test_junit_parser_missing_report(tmpdir):
+    parser = JUnitResultParser(str(tmpdir / 'run-0'))
+    parser.close()
+    assert parser.get_result() is None
+
+
+def test_parser_long_lines():
+    parser = PytestResultParser()
+    # Progress bars redrawn with '\r' do not end lines.
+    for _ in range(10000):
+        parser.feed('downloading... 50%\r' * 10)
+    assert len(parser._partial_line) <= MAX_LINE_LENGTH
+    parser.feed('\n')
+    parser = feed_in_chunks(parser, pytest_output)
+    assert parser.get_result() == TestResult('failure', 6, 4, 2)
@@ -0,0 +1,82 @@
+import logging
+
+import pytest
+
+from testion.exceptions import CommandError
+from testion.reporter.base import OUTPUT_CHUNK_SIZE, plugins_path
+from testion.reporter.parser import TestCaseResult, TestResult
+
+
+async def test_run_command_check(loop, make_reporter):
+    reporter = make_reporter({})
+    assert await reporter.run_command('echo hello; exit 3') == 'hello'
+    with pytest.raises(CommandError) as e:
+        await reporter.run_command('echo hello; exit 3', check=True)
+    assert e.value.returncode == 3
+
+
+async def test_run_command_long_lines(loop, make_reporter, caplog):
+    reporter = make_reporter({})
+    cmd = '''python -c "import sys; sys.stdout.write('50%\\r' * 100000)"'''
+    with caplog.at_level(logging.INFO):
+        await reporter.run_command(cmd, verbose=True)
+    # The output without newlines is logged in bounded pieces.
+    messages = [r.getMessage() for r in caplog.records
+                if r.getMessage().startswith('50%')]
+    assert max(len(m) for m in messages) < 2 * OUTPUT_CHUNK_SIZE
+    assert sum(len(m) for m in messages) == 400000
+
+
+async def test_pytest_plugin_env(loop, make_reporter, monkeypatch):
+    monkeypatch.delenv('PYTEST_ADDOPTS', raising=False)
+    reporter = make_reporter({})
+    env = reporter.pytest_plugin_env({'TESTION_SUCCESS': '1'})
+    assert env['PYTEST_ADDOPTS'] == '-p testion_pytest'
+    assert env['PYTHONPATH'].split(':')[0] == str(plugins_path)
+    assert env['TESTION_SUCCESS'] == '1'
+    # The options of the report or the server are kept.
+    env = reporter.pytest_plugin_env({'PYTEST_ADDOPTS': '-x'})
+    assert env['PYTEST_ADDOPTS'] == '-p testion_pytest -x'
+    monkeypatch.setenv('PYTEST_ADDOPTS', '-v')
+    assert reporter.pytest_plugin_env()['PYTEST_ADDOPTS'] == '-p testion_pytest -v'
+
+
+flaky_tests = '''\
+import os
+
+
+def test_ok():
+    pass
+
+
+def test_flaky():
+    # Fails only on the first run.
+    num_runs = int(open('runs.txt').read()) if os.path.exists('runs.txt') else 0
+    with open('runs.txt', 'w') as f:
+        f.write(str(num_runs + 1))
+    assert num_runs > 0
+
+
+def test_broken():
+    assert False
+'''
+
+
+async def test_retry_failed_tests(loop, tmpdir, make_reporter):
+    tmpdir.mkdir('tests').join('test_flaky.py').write(flaky_tests)
+    # The reruns print no per-test results without "-v".
+    reporter = make_reporter({'parser': 'pytest', 'retry_failed': 2,
+                              'test_cmd': 'cd tests && python -m pytest -p no:cacheprovider'})
+    test_cases = [
+        TestCaseResult('test_flaky', 'test_ok', 'test_flaky.py', 'passed', 0.0),
+        TestCaseResult('test_flaky', 'test_flaky', 'test_flaky.py', 'failed', 0.0),
+        TestCaseResult('test_flaky', 'test_broken', 'test_flaky.py', 'failed', 0.0),
+    ]
+    tmpdir.join('tests', 'runs.txt').write('1')
+    test_result, test_cases, flaky = await reporter.retry_failed_tests(
+        0, str(tmpdir), None, None, TestResult('failure', 3, 1, 2), test_cases)
+    assert flaky == ['test_flaky.py::test_flaky']
+    assert test_result == TestResult('failure', 3, 2, 1)
+    assert [case.outcome for case in test_cases] == ['passed', 'flaky', 'failed']
+    # Only the remaining failure is retried again.
+    assert tmpdir.join('tests', 'runs.txt').read() == '2'
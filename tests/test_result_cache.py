@@ -0,0 +1,30 @@
+import time
+
+from testion.cache.result import ResultCache, compute_result_key
+from testion.reporter.parser import TestResult
+
+
+def test_cache_successful_results_only(tmpdir):
+    cache = ResultCache(tmpdir.join('results.sqlite3'))
+    success = TestResult('success', 3, 3, 0)
+    cache.put('a', 'tree-a', success, 'http://log/a')
+    cache.put('b', 'tree-b', TestResult('failure', 3, 2, 1), 'http://log/b')
+    assert cache.get('a') == (success, 'http://log/a')
+    assert cache.get('b') is None
+
+
+def test_cache_expires_results(tmpdir, monkeypatch):
+    cache = ResultCache(tmpdir.join('results.sqlite3'), max_age=60)
+    cache.put('a', 'tree-a', TestResult('success', 1, 1, 0), None)
+    assert cache.get('a') is not None
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 61)
+    assert cache.get('a') is None
+
+
+def test_result_key_options():
+    report = {'cls': 'simple', 'test_cmd': 'pytest'}
+    key = compute_result_key('tree', report, '3.5.2')
+    assert key == compute_result_key('tree', dict(report), '3.5.2')
+    assert key != compute_result_key('tree', dict(report, retry_failed=2), '3.5.2')
+    assert key != compute_result_key('other', report, '3.5.2')
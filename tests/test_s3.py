@@ -0,0 +1,121 @@
+from datetime import datetime
+import gzip
+import hashlib
+import os
+import re
+
+from aiohttp import web
+import pytest
+
+from testion import s3
+from testion.s3 import S3Uploader, sign_request
+
+
+def decode(data):
+    return gzip.decompress(data) if data[:2] == b'\x1f\x8b' else data
+
+
+class S3StandIn:
+    '''
+    A minimal S3-compatible server keeping objects in memory,
+    which verifies the request signatures.
+    '''
+
+    def __init__(self, access_key, secret_key):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.objects = {}
+        self.uploads = {}
+        self.requests = []
+        self.fail_next = 0
+
+    def verify(self, request, body):
+        payload_hash = request.headers['x-amz-content-sha256']
+        # The server may have decoded the gzip-encoded body already.
+        if 'Content-Encoding' not in request.headers and \
+                hashlib.sha256(body).hexdigest() != payload_hash:
+            return False
+        auth = request.headers['Authorization']
+        signed = re.search(r'SignedHeaders=([^,]+)', auth).group(1).split(';')
+        headers = {name: request.headers[name] for name in signed if name != 'host'}
+        now = datetime.strptime(request.headers['x-amz-date'], '%Y%m%dT%H%M%SZ')
+        expected = sign_request(request.method, request.headers['Host'],
+                                request.raw_path.split('?')[0], dict(request.GET),
+                                headers, payload_hash,
+                                self.access_key, self.secret_key, 'us-east-1', now)
+        return expected['Authorization'] == auth
+
+    async def handle(self, request):
+        body = await request.read()
+        self.requests.append((request.method, request.path, dict(request.GET)))
+        if not self.verify(request, body):
+            return web.Response(status=403, text='<Error>SignatureDoesNotMatch</Error>')
+        if self.fail_next > 0:
+            self.fail_next -= 1
+            return web.Response(status=503, text='<Error>SlowDown</Error>')
+        path = request.match_info['path']
+        query = request.GET
+        if request.method == 'POST' and 'uploads' in query:
+            upload_id = 'upload-{}'.format(len(self.uploads))
+            self.uploads[upload_id] = {'headers': dict(request.headers), 'parts': {}}
+            return web.Response(text='<InitiateMultipartUploadResult><UploadId>{}'
+                                     '</UploadId></InitiateMultipartUploadResult>'
+                                     .format(upload_id))
+        if request.method == 'PUT' and 'uploadId' in query:
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            self.uploads[query['uploadId']]['parts'][int(query['partNumber'])] = body
+            return web.Response(headers={'ETag': etag})
+        if request.method == 'POST' and 'uploadId' in query:
+            upload = self.uploads.pop(query['uploadId'])
+            data = b''.join(part for _, part in sorted(upload['parts'].items()))
+            self.objects[path] = (upload['headers'], data)
+            return web.Response(text='<CompleteMultipartUploadResult/>')
+        if request.method == 'PUT':
+            self.objects[path] = (dict(request.headers), body)
+            return web.Response()
+        return web.Response(status=400)
+
+
+@pytest.yield_fixture
+def s3_server(loop, unused_port):
+    stand_in = S3StandIn('testkey', 'testsecret')
+    app = web.Application(loop=loop)
+    app.router.add_route('*', '/{path:.+}', stand_in.handle)
+    handler = app.make_handler()
+    server = loop.run_until_complete(loop.create_server(handler, '127.0.0.1', unused_port))
+    yield stand_in, 'http://127.0.0.1:{}'.format(unused_port)
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.run_until_complete(handler.finish_connections())
+
+
+async def test_upload_small_log(loop, tmpdir, s3_server):
+    stand_in, endpoint = s3_server
+    log_file = tmpdir.join('log.txt')
+    log_file.write('test output\n' * 1000)
+    uploader = S3Uploader('testkey', 'testsecret', endpoint=endpoint, loop=loop)
+    await uploader.submit(str(log_file), 'logs', '20170101/lablup/testion/log.txt')
+    await uploader.close()
+    headers, data = stand_in.objects['logs/20170101/lablup/testion/log.txt']
+    assert headers['Content-Encoding'] == 'gzip'
+    assert int(headers['Content-Length']) < len(log_file.read_binary()) / 10
+    assert decode(data) == log_file.read_binary()
+
+
+async def test_upload_multipart_with_retry(loop, tmpdir, s3_server, monkeypatch):
+    monkeypatch.setattr(s3, 'MULTIPART_THRESHOLD', 1024)
+    monkeypatch.setattr(s3, 'MULTIPART_PART_SIZE', 1024)
+    monkeypatch.setattr(s3, 'MAX_RETRIES', 2)
+    monkeypatch.setattr(s3, 'RETRY_BASE_DELAY', 0)
+    stand_in, endpoint = s3_server
+    log_file = tmpdir.join('log.txt')
+    log_file.write_binary(os.urandom(4096))  # incompressible
+    uploader = S3Uploader('testkey', 'testsecret', endpoint=endpoint, loop=loop)
+    stand_in.fail_next = 1
+    await uploader.upload_file(str(log_file), 'logs', 'big.txt')
+    await uploader.close()
+    _, data = stand_in.objects['logs/big.txt']
+    assert decode(data) == log_file.read_binary()
+    num_parts = sum(1 for method, _, query in stand_in.requests
+                    if method == 'PUT' and 'partNumber' in query)
+    assert num_parts > 1
@@ -0,0 +1,92 @@
+import os
+import signal
+import socket
+
+import pytest
+
+from testion import selenium_pool
+from testion.selenium_pool import SeleniumInstance, SeleniumPool
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def fake_bin(tmpdir, monkeypatch):
+    '''
+    Returns a function installing a fake command which just keeps running.
+    Only the installed ones are found in PATH.
+    '''
+    bin_dir = tmpdir.mkdir('bin')
+    monkeypatch.setenv('PATH', str(bin_dir))
+
+    def install(name):
+        path = bin_dir.join(name)
+        path.write('#!/bin/sh\nexec /bin/sleep 1000\n')
+        path.chmod(0o755)
+
+    return install
+
+
+@pytest.fixture
+def healthy_if_running(monkeypatch):
+    # There is no real Selenium server to ask.
+    async def is_healthy(self):
+        return self._is_running()
+
+    monkeypatch.setattr(SeleniumInstance, 'is_healthy', is_healthy)
+
+
+async def test_warm_up_failure(loop, fake_bin, healthy_if_running):
+    fake_bin('Xvfb')  # but no java
+    pool = SeleniumPool(2, 'selenium.jar', display_base=190, port_base=free_port(),
+                        loop=loop)
+    try:
+        await pool.warm_up()
+        # The instances are kept to be restarted when leased.
+        assert pool._idle.qsize() == 2
+        for instance in pool._instances:
+            # Xvfb is stopped when the Selenium server cannot be started.
+            assert instance._xvfb is None and instance._selenium is None
+        with pytest.raises(RuntimeError):
+            await pool.acquire()
+        assert pool._idle.qsize() == 2
+    finally:
+        await pool.close()
+
+
+async def test_restart_unhealthy_instance(loop, fake_bin, healthy_if_running):
+    fake_bin('Xvfb')
+    fake_bin('java')
+    pool = SeleniumPool(1, 'selenium.jar', display_base=190, port_base=free_port(),
+                        loop=loop)
+    try:
+        async with pool.lease() as env:
+            instance = pool._instances[0]
+            assert env['TESTION_SELENIUM_PORT'] == str(instance.port)
+            old_pid = instance._selenium.pid
+        os.killpg(old_pid, signal.SIGKILL)
+        await instance._selenium.wait()
+        async with pool.lease():
+            assert instance._is_running()
+            assert instance._selenium.pid != old_pid
+    finally:
+        await pool.close()
+
+
+async def test_release_on_exception(loop, fake_bin, healthy_if_running):
+    fake_bin('Xvfb')
+    fake_bin('java')
+    pool = SeleniumPool(1, 'selenium.jar', display_base=190, port_base=free_port(),
+                        loop=loop)
+    try:
+        with pytest.raises(ValueError):
+            async with pool.lease():
+                assert pool._idle.qsize() == 0
+                raise ValueError('test failure')
+        assert pool._idle.qsize() == 1
+    finally:
+        await pool.close()
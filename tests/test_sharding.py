@@ -0,0 +1,40 @@
+from testion.reporter.sharding import parse_collected_files, split_into_shards
+
+
+def test_parse_collected_files():
+    output = '\n'.join([
+        'tests/test_a.py::test_one',
+        'tests/test_a.py::TestCls::test_two',
+        'tests/test_b.py::test_three[1]',
+        '',
+        '3 tests collected in 0.01s',
+    ])
+    assert parse_collected_files(output) == ['tests/test_a.py', 'tests/test_b.py']
+
+
+def test_parse_collected_files_with_spaces():
+    output = '\n'.join([
+        'tests/test_a.py::test_one',
+        'tests/test_c.py::test_x[a b]',
+        'tests/test_c.py::test_x[c d]',
+        '',
+        'warnings summary: see tests/test_a.py::test_one for details',
+        '3 tests collected in 0.01s',
+    ])
+    assert parse_collected_files(output) == ['tests/test_a.py', 'tests/test_c.py']
+
+
+def test_split_into_shards_by_durations():
+    files = ['a.py', 'b.py', 'c.py', 'd.py']
+    durations = {'a.py': 10.0, 'b.py': 6.0, 'c.py': 4.0, 'd.py': 1.0}
+    shards = split_into_shards(files, durations, 2)
+    totals = sorted(sum(durations[f] for f in shard) for shard in shards)
+    assert totals == [10.0, 11.0]
+    assert sorted(f for shard in shards for f in shard) == files
+
+
+def test_split_into_shards_without_durations():
+    files = ['a.py', 'b.py', 'c.py']
+    shards = split_into_shards(files, {}, 5)
+    assert len(shards) == 3
+    assert sorted(f for shard in shards for f in shard) == files
@@ -22,6 +22,11 @@ common_data = {
 }
 
 
+def remote_repo():
+    # The repository object returned by the mocked github3 module.
+    return github3.login.return_value.repository.return_value
+
+
 @pytest.yield_fixture
 def github_mock():
     o = mock.patch('github3.login')
@@ -71,10 +76,10 @@ async def test_unittest_mixed(capsys, create_app_and_client,
         assert resp.status == 204
         resp.close()
         await app._job_queue.join()
-        args, kwargs = app._last_reporter.remote_repo.create_status.call_args_list[0]
+        args, kwargs = remote_repo().create_status.call_args_list[0]
         assert kwargs['sha'] == common_data['after']
         assert kwargs['state'] == 'pending'
-        args, kwargs = app._last_reporter.remote_repo.create_status.call_args_list[-1]
+        args, kwargs = remote_repo().create_status.call_args_list[-1]
         assert kwargs['sha'] == common_data['after']
         assert kwargs['state'] == 'failure'
         assert '(2 / 4) passed' in kwargs['description']
@@ -93,10 +98,10 @@ async def test_unittest_success(capsys, create_app_and_client,
         assert resp.status == 204
         resp.close()
         await app._job_queue.join()
-        args, kwargs = app._last_reporter.remote_repo.create_status.call_args_list[0]
+        args, kwargs = remote_repo().create_status.call_args_list[0]
         assert kwargs['sha'] == common_data['after']
         assert kwargs['state'] == 'pending'
-        args, kwargs = app._last_reporter.remote_repo.create_status.call_args_list[-1]
+        args, kwargs = remote_repo().create_status.call_args_list[-1]
         assert kwargs['sha'] == common_data['after']
         assert kwargs['state'] == 'success'
         assert 'All 2 tests OK' in kwargs['description']
@@ -115,10 +120,10 @@ async def test_unittest_failure(capsys, create_app_and_client,
         assert resp.status == 204
         resp.close()
         await app._job_queue.join()
-        args, kwargs = app._last_reporter.remote_repo.create_status.call_args_list[0]
+        args, kwargs = remote_repo().create_status.call_args_list[0]
         assert kwargs['sha'] == common_data['after']
         assert kwargs['state'] == 'pending'
-        args, kwargs = app._last_reporter.remote_repo.create_status.call_args_list[-1]
+        args, kwargs = remote_repo().create_status.call_args_list[-1]
         assert kwargs['sha'] == common_data['after']
         assert kwargs['state'] == 'failure'
         assert '(0 / 1) passed' in kwargs['description']
@@ -137,10 +142,10 @@ async def test_unittest_errors(capsys, create_app_and_client,
         assert resp.status == 204
         resp.close()
         await app._job_queue.join()
-        args, kwargs = app._last_reporter.remote_repo.create_status.call_args_list[0]
+        args, kwargs = remote_repo().create_status.call_args_list[0]
         assert kwargs['sha'] == common_data['after']
         assert kwargs['state'] == 'pending'
-        args, kwargs = app._last_reporter.remote_repo.create_status.call_args_list[-1]
+        args, kwargs = remote_repo().create_status.call_args_list[-1]
         assert kwargs['sha'] == common_data['after']
         assert kwargs['state'] == 'failure'
         assert '(0 / 1) passed' in kwargs['description']
@@ -159,10 +164,10 @@ async def test_pytest_mixed(capsys, create_app_and_client,
         assert resp.status == 204
         resp.close()
         await app._job_queue.join()
-        args, kwargs = app._last_reporter.remote_repo.create_status.call_args_list[0]
+        args, kwargs = remote_repo().create_status.call_args_list[0]
         assert kwargs['sha'] == common_data['after']
         assert kwargs['state'] == 'pending'
-        args, kwargs = app._last_reporter.remote_repo.create_status.call_args_list[-1]
+        args, kwargs = remote_repo().create_status.call_args_list[-1]
         assert kwargs['sha'] == common_data['after']
         assert kwargs['state'] == 'failure'
         assert '(2 / 4) passed' in kwargs['description']
@@ -181,10 +186,10 @@ async def test_pytest_success(capsys, create_app_and_client,
         assert resp.status == 204
         resp.close()
         await app._job_queue.join()
-        args, kwargs = app._last_reporter.remote_repo.create_status.call_args_list[0]
+        args, kwargs = remote_repo().create_status.call_args_list[0]
         assert kwargs['sha'] == common_data['after']
         assert kwargs['state'] == 'pending'
-        args, kwargs = app._last_reporter.remote_repo.create_status.call_args_list[-1]
+        args, kwargs = remote_repo().create_status.call_args_list[-1]
         assert kwargs['sha'] == common_data['after']
         assert kwargs['state'] == 'success'
         assert 'All 2 tests OK' in kwargs['description']
@@ -203,10 +208,10 @@ async def test_pytest_failure(capsys, create_app_and_client,
         assert resp.status == 204
         resp.close()
         await app._job_queue.join()
-        args, kwargs = app._last_reporter.remote_repo.create_status.call_args_list[0]
+        args, kwargs = remote_repo().create_status.call_args_list[0]
         assert kwargs['sha'] == common_data['after']
         assert kwargs['state'] == 'pending'
-        args, kwargs = app._last_reporter.remote_repo.create_status.call_args_list[-1]
+        args, kwargs = remote_repo().create_status.call_args_list[-1]
         assert kwargs['sha'] == common_data['after']
         assert kwargs['state'] == 'failure'
         assert '(0 / 1) passed' in kwargs['description']
@@ -225,10 +230,10 @@ async def test_pytest_errors(capsys, create_app_and_client,
         assert resp.status == 204
         resp.close()
         await app._job_queue.join()
-        args, kwargs = app._last_reporter.remote_repo.create_status.call_args_list[0]
+        args, kwargs = remote_repo().create_status.call_args_list[0]
         assert kwargs['sha'] == common_data['after']
         assert kwargs['state'] == 'pending'
-        args, kwargs = app._last_reporter.remote_repo.create_status.call_args_list[-1]
+        args, kwargs = remote_repo().create_status.call_args_list[-1]
         assert kwargs['sha'] == common_data['after']
         assert kwargs['state'] == 'failure'
         assert '(0 / 1) passed' in kwargs['description']
@@ -248,10 +253,10 @@ async def test_unit_mixed_branch(capsys, create_app_and_client,
         assert resp.status == 204
         resp.close()
         await app._job_queue.join()
-        args, kwargs = app._last_reporter.remote_repo.create_status.call_args_list[0]
+        args, kwargs = remote_repo().create_status.call_args_list[0]
         assert kwargs['sha'] == common_data['after']
         assert kwargs['state'] == 'pending'
-        args, kwargs = app._last_reporter.remote_repo.create_status.call_args_list[-1]
+        args, kwargs = remote_repo().create_status.call_args_list[-1]
         assert kwargs['sha'] == common_data['after']
         assert kwargs['state'] == 'failure'
         assert '(2 / 4) passed' in kwargs['description']
@@ -270,10 +275,10 @@ async def test_pytest_mixed_branch(capsys, create_app_and_client,
         assert resp.status == 204
         resp.close()
         await app._job_queue.join()
-        args, kwargs = app._last_reporter.remote_repo.create_status.call_args_list[0]
+        args, kwargs = remote_repo().create_status.call_args_list[0]
         assert kwargs['sha'] == common_data['after']
         assert kwargs['state'] == 'pending'
-        args, kwargs = app._last_reporter.remote_repo.create_status.call_args_list[-1]
+        args, kwargs = remote_repo().create_status.call_args_list[-1]
         assert kwargs['sha'] == common_data['after']
         assert kwargs['state'] == 'failure'
         assert '(2 / 4) passed' in kwargs['description']
@@ -0,0 +1,75 @@
+import asyncio
+import json
+import time
+
+import requests
+
+from testion import metrics
+from testion.metrics import Histogram
+from testion.reporter import mixins
+from testion.reporter.base import TestReporterBase
+from testion.reporter.parser import TestResult
+
+
+class SlackReporter(mixins.SlackReportMixin, TestReporterBase):
+    pass
+
+
+async def test_slack_does_not_block_loop(loop, monkeypatch, make_reporter):
+    monkeypatch.setenv('TESTION_SLACK_HOOK_URL', 'http://slack.invalid/hook')
+    posts = []
+
+    def fake_post(url, data=None, timeout=None):
+        time.sleep(0.2)
+        posts.append((url, json.loads(data), timeout))
+
+    monkeypatch.setattr(requests, 'post', fake_post)
+    reporter = make_reporter({}, cls=SlackReporter)
+    reporter.add_result('commit 0000000', '0' * 40, TestResult('success', 3, 3, 0))
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01, loop=loop)
+            ticks += 1
+
+    ticker = loop.create_task(tick())
+    try:
+        await reporter.flush_results()
+    finally:
+        ticker.cancel()
+    assert ticks > 5
+    (url, payload, timeout), = posts
+    assert url == 'http://slack.invalid/hook'
+    assert payload['attachments'][0]['title'] == 'Success!'
+    assert timeout == mixins.SLACK_TIMEOUT
+    assert reporter.slack_items == []
+
+
+async def test_slack_errors_are_ignored(loop, monkeypatch, make_reporter):
+    monkeypatch.setenv('TESTION_SLACK_HOOK_URL', 'http://slack.invalid/hook')
+
+    def fake_post(url, data=None, timeout=None):
+        raise requests.Timeout('timed out')
+
+    monkeypatch.setattr(requests, 'post', fake_post)
+    reporter = make_reporter({}, cls=SlackReporter)
+    await reporter.flush_results()
+    assert reporter.slack_items == []
+
+
+async def test_slack_call_duration(loop, monkeypatch, make_reporter):
+    monkeypatch.setenv('TESTION_SLACK_HOOK_URL', 'http://slack.invalid/hook')
+    monkeypatch.setattr(requests, 'post', lambda *args, **kwargs: time.sleep(0.1))
+    hist = Histogram('test_call_duration_seconds', 'Test call durations.', ['service'])
+    monkeypatch.setattr(metrics, 'external_call_duration', hist)
+    reporter = make_reporter({}, cls=SlackReporter)
+    ticker = loop.create_task(asyncio.sleep(0.05, loop=loop))
+    await reporter.flush_results()
+    # The loop kept running while the call was measured.
+    assert ticker.done()
+    samples = {name: value for name, labels, value in hist.samples()
+               if ('service', 'slack') in labels}
+    assert samples['test_call_duration_seconds_count'] == 1
+    assert samples['test_call_duration_seconds_sum'] >= 0.1
@@ -0,0 +1,93 @@
+import asyncio
+import gc
+import logging
+import os
+import tracemalloc
+from unittest import mock
+
+import pytest
+
+from testion import livelog, server
+from testion.github import clear_clients
+from testion.jobqueue import Job, JobQueue
+from testion.reporter.base import TestReporterBase
+from testion.server import job_loop
+
+
+class SoakReporter(TestReporterBase):
+
+    async def run(self):
+        for i in range(3):
+            self.logger.info('Running step {} of {}'.format(i, self.data['after']))
+
+
+def num_open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+@pytest.yield_fixture
+def github_mock(monkeypatch):
+    monkeypatch.setenv('GH_USERNAME', 'testion')
+    monkeypatch.setenv('GH_TOKEN', 'dummy-token')
+    with mock.patch('github3.login'):
+        yield
+    clear_clients()
+
+
+async def run_jobs(loop, queue, start, count):
+    for i in range(start, start + count):
+        data = {
+            'ref': 'refs/heads/soak-{}'.format(i),
+            'after': '{:040x}'.format(i),
+            'repository': {'full_name': 'lablup/testion', 'name': 'testion',
+                           'owner': {'name': 'lablup'}},
+        }
+        await queue.put(Job('lablup/testion', 'soak', data['ref'], data))
+    await queue.join()
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'),
+                    reason='requires /proc to count open files')
+async def test_soak_no_leaks(loop, tmpdir, github_mock, monkeypatch):
+    monkeypatch.setitem(server.reporter_map, 'soak', SoakReporter)
+    monkeypatch.setattr(livelog, 'MAX_FINISHED_LOGS', 10)
+    config = {
+        'lablup/testion': {
+            'concurrency': 4,
+            'log': {'local_path': str(tmpdir), 's3_bucket': None},
+            'reports': {'soak': {'cls': 'soak'}},
+        },
+    }
+    # Write the logs only to the log files, not to the captured output.
+    run_logger = logging.getLogger('testion.TestRun')
+    run_logger.setLevel(logging.INFO)
+    monkeypatch.setattr(run_logger, 'propagate', False)
+    queue = JobQueue(loop=loop)
+    job_task = asyncio.ensure_future(job_loop(loop, queue, config, max_workers=4))
+    try:
+        # Warm up the caches and the allocator before taking the baseline.
+        # (The bursts are no larger than this so that the grown hash tables
+        # of the queue are not counted as leaks.)
+        await run_jobs(loop, queue, 0, 200)
+        gc.collect()
+        tracemalloc.start()
+        base_fds = num_open_fds()
+        base_mem, _ = tracemalloc.get_traced_memory()
+
+        for start in range(200, 2200, 200):
+            await run_jobs(loop, queue, start, 200)
+        gc.collect()
+        mem, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        assert num_open_fds() <= base_fds
+        assert mem - base_mem < 256 * 1024
+        assert not [name for name in logging.Logger.manager.loggerDict
+                    if name.startswith('testion.TestRun.')]
+        # Every run has written its log file.
+        assert sum(len(d.listdir()) for d in tmpdir.listdir()) == 2200
+    finally:
+        job_task.cancel()
+        await job_task
+        queue.close()
+        run_logger.setLevel(logging.NOTSET)
@@ -0,0 +1,27 @@
+import pytest
+
+from testion.cache import venv as venv_cache, wheel
+from testion.cache.venv import compute_venv_key, get_venv_cache
+
+
+@pytest.mark.parametrize('install_cmd, cached', [('exit 1', False), ('true', True)])
+async def test_cache_only_prepared_venvs(loop, tmpdir, monkeypatch, make_reporter,
+                                         install_cmd, cached):
+    monkeypatch.setenv('TESTION_CACHE_PATH', str(tmpdir.join('cache')))
+    monkeypatch.setattr(venv_cache, '_venv_cache', None)
+    monkeypatch.setattr(wheel, '_wheelhouse', None)
+    reporter = make_reporter({'install_cmd': install_cmd})
+    run_command = reporter.run_command
+
+    async def fake_run_command(cmd, **kwargs):
+        # Skip creating a real virtualenv, which needs the network.
+        if cmd.startswith(('python -m venv', 'pip install')):
+            cmd = 'true'
+        return await run_command(cmd, **kwargs)
+
+    reporter.run_command = fake_run_command
+    wcdir = tmpdir.mkdir('wc')
+    await reporter.prepare_venv(str(wcdir), str(tmpdir.mkdir('venv')), None, '3.5.2')
+    key = compute_venv_key('3.5.2', None, install_cmd, str(wcdir))
+    assert (get_venv_cache().root / key).exists() == cached
+